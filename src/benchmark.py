@@ -0,0 +1,1349 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the pipeline stages, run against a local fake
+Wayback server so that no requests reach the Internet Archive.
+
+`suite` times each stage and the whole pipeline over a synthetic CDC
+corpus, with the dev or prod configuration, and writes the results as
+JSON; `compare` puts two such results side by side.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import resource
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from io import BytesIO
+from time import perf_counter, strftime, time
+
+import yaml
+
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+from clean_urlkey import (
+    CDXDeduplicator, clean_urls, detect_urlkeys_from_subdomains, iter_subdomain_urlkeys,
+    DEFAULT_CDX_FROM, DEFAULT_CDX_PAGE_SIZE, DEFAULT_CDX_TO
+)
+from config_loader import load_config
+from create_leveldb import (
+    WARCLevelDB, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_RECORDS, DEFAULT_BATCH_SECONDS,
+    DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_THRESHOLD
+)
+from fetch_journal import FetchJournal
+from fake_wayback import CDX_HEADERS, FakeWaybackServer, synthetic_cdx_row
+from http_client import HTTPClient
+from parallel_ingest import ingest_parallel
+from rate_limit import HostRateLimiter
+from retrieve_snapshot import FETCH_MODES, process_cdc_urls
+from scheduler import DownloadScheduler, prefetch
+from serve_leveldb import CachedReader, LevelDBServer
+from synthetic_corpus import WORDS, SyntheticCorpus
+from url_list_store import URLListFile, convert_state_file, iter_jsonl
+from value_codec import ValueCodec, zstandard
+from warc_store import IndexedWARCWriter
+
+def synthetic_url_list(subdomain, count):
+    """
+    Build a cleaned URL list like the one detect_urlkeys_from_subdomains() returns
+
+    :param subdomain: The subdomain to generate paths for
+    :param count: Number of paths
+    :return: A list of url_data hashmaps
+    """
+    url_list = []
+    for ix in range(count):
+        path = f"/page/{ix}.html"
+        url_list.append({
+            "urlkey": f"gov,cdc,{subdomain.split('.')[0]})" + path,
+            "timestamp": "20250101000000",
+            "original": f"https://{subdomain}{path}",
+            "mimetype": "text/html",
+            "statuscode": "200",
+            "digest": f"DIGEST{ix:08d}",
+            "length": "1000",
+            "path": path,
+            "originals": [f"https://{subdomain}{path}"],
+        })
+    return url_list
+
+def legacy_clean_urls(url_headers, url_list):
+    """
+    clean_urls() as it was before CDXDeduplicator, kept as the baseline for
+    the clean_urls benchmark.
+    """
+    headers = {}
+    for ix, header in enumerate(url_headers):
+        headers[header] = ix
+
+    url_headers.append("path")
+    headers['path'] = len(url_headers) - 1
+
+    url_headers.append('originals')
+    headers['originals'] = len(url_headers) - 1
+
+    url_timestamps = {}
+    url_collection = {}
+    for url_data in url_list:
+        raw_path = url_data[headers["urlkey"]]
+        timestamp = url_data[headers["timestamp"]]
+        try:
+            if isinstance(raw_path, bytes):
+                raw_path = raw_path.decode("utf-8")
+
+            raw_path = raw_path.strip()
+
+            if ')' in raw_path:
+                _, path = raw_path.split(')', 1)
+            else:
+                path = raw_path
+
+            url_data.append(path)
+            original = url_data[headers['original']]
+            if not (path in url_timestamps):
+                # First time seeing this urlkey-path
+                url_data.append([ original ])
+                url_timestamps[path] = timestamp
+                url_collection[path] = url_data
+            elif timestamp > url_timestamps[path]:
+                originals = url_collection[path][headers['originals']]
+                if not (original in originals):
+                    originals.append(original)
+                url_data.append(originals)
+                url_timestamps[path] = timestamp
+                url_collection[path] = url_data
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.warning(f"Skipping malformed URL entry: {raw_path} — {e}")
+        except Exception as e:
+            logging.critical(f"Unexpected error cleaning URL {raw_path}: {e}")
+    
+    cleaned_paths = []
+    for path, url_data in url_collection.items():
+        cleaned_paths.append(dict(zip(url_headers, url_collection[path])))
+    return cleaned_paths
+
+def synthetic_cdx_rows(count, captures=3, subdomain="bench.cdc.gov"):
+    """
+    Generate `count` CDX rows lazily, `captures` per path.
+    """
+    for index in range(count):
+        yield synthetic_cdx_row(subdomain, index, captures)
+
+def _measure_clean_urls(name, count, captures, queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    if name == "legacy":
+        cleaned = legacy_clean_urls(list(CDX_HEADERS), synthetic_cdx_rows(count, captures))
+        dedup_seconds = time() - start
+        dedup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        deduplicator = CDXDeduplicator(list(CDX_HEADERS))
+        deduplicator.add_rows(synthetic_cdx_rows(count, captures))
+        dedup_seconds = time() - start
+        dedup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cleaned = deduplicator.results()
+    duration = time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "seconds": duration,
+        "dedup_seconds": dedup_seconds,
+        "rows_per_second": count / duration if duration else 0.0,
+        # Memory held once every row has been seen, before the output list is built
+        "dedup_peak_rss_growth_mb": (dedup_rss - rss_before) / 1024,
+        "peak_rss_growth_mb": (rss_after - rss_before) / 1024,
+        "paths": len(cleaned),
+    })
+
+def bench_clean_urls(args):
+    """
+    Compare clean_urls() against the legacy implementation on a synthetic CDX
+    table. Each implementation runs in a fresh process so their memory peaks
+    can be compared; the outputs are first checked to be identical on a sample.
+    """
+    sample = list(synthetic_cdx_rows(args.verify_rows, args.captures))
+    expected = legacy_clean_urls(list(CDX_HEADERS), [list(row) for row in sample])
+    actual = clean_urls(list(CDX_HEADERS), [list(row) for row in sample])
+    if expected != actual:
+        raise AssertionError("clean_urls() output differs from the legacy implementation")
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in ("legacy", "current"):
+        queue = context.Queue()
+        process = context.Process(target=_measure_clean_urls, args=(name, args.rows, args.captures, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+
+    return {
+        "benchmark": "clean_urls",
+        "rows": args.rows,
+        "captures_per_path": args.captures,
+        "verified_rows": args.verify_rows,
+        "legacy": results["legacy"],
+        "current": results["current"],
+    }
+
+def write_synthetic_warc(filename, url, payload, content_type="text/html"):
+    """
+    Write a single-response .warc.gz, shaped like the ones download_warc_cdx_toolkit() writes.
+    """
+    with open(filename, "wb") as warc_fd:
+        writer = WARCWriter(warc_fd, gzip=True)
+        writer.write_record(writer.create_warcinfo_record(filename, {"software": "benchmark"}))
+        http_headers = StatusAndHeaders("200 OK", [("Content-Type", content_type)], protocol="HTTP/1.1")
+        writer.write_record(writer.create_warc_record(url, "response", payload=BytesIO(payload),
+                                                      http_headers=http_headers))
+
+def synthetic_fetched_urls(warc_folder, subdomain, count, payload_size=4096, distinct_payloads=None):
+    """
+    Write `count` synthetic WARC files and return url_data hashmaps pointing
+    at them, as process_cdc_urls() hands them to WARCLevelDB.process_url().
+    With `distinct_payloads` set, the payloads cycle through that many bodies,
+    like shared CSS/JS and boilerplate pages do.
+    """
+    url_list = synthetic_url_list(subdomain, count)
+    for ix, url_data in enumerate(url_list):
+        filename = os.path.join(warc_folder, f"{ix:08d}.warc.gz")
+        body_id = url_data['path'] if not distinct_payloads else ix % distinct_payloads
+        payload = (f"<html>{body_id}</html>".encode("utf-8") * payload_size)[:payload_size]
+        write_synthetic_warc(filename, url_data['original'], payload)
+        url_data['originals'] = [url_data['original'], url_data['original'].replace("https:", "http:")]
+        url_data['fetched'] = {"file": filename, "issues": False}
+    return url_list
+
+def _measure_large_ingest(filename, url, chunk_threshold, chunk_size, queue):
+    with tempfile.TemporaryDirectory() as db_folder:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ldb = WARCLevelDB(db_folder, chunk_threshold=chunk_threshold, chunk_size=chunk_size)
+        url_data = {"path": "/large.bin", "timestamp": "20250101000000", "originals": [url],
+                    "fetched": {"file": filename, "issues": False}}
+        start = time()
+        ldb.process_url("bench.cdc.gov", url_data)
+        ldb.flush()
+        duration = time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Read a 64KB range from the middle, and time it
+        length = ldb.content_length(url)
+        range_start = perf_counter()
+        middle = ldb.read_range(url, length // 2, length // 2 + 65536)
+        range_seconds = perf_counter() - range_start
+        ldb.close()
+    queue.put({
+        "seconds": duration,
+        "mb_per_second": length / duration / 1e6 if duration else 0.0,
+        "peak_rss_growth_mb": (rss_after - rss_before) / 1024,
+        "range_read_ms": range_seconds * 1000,
+        "range_bytes": len(middle),
+    })
+
+def bench_large_ingest(args):
+    """
+    Ingest one large capture with and without chunked streaming, each in a
+    fresh process, and compare their peak memory.
+    """
+    url = "https://bench.cdc.gov/large.bin"
+    size = args.size_mb * 1024 * 1024
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as warc_folder:
+        # Stage the payload on disk, so that not even writing the WARC holds it in memory
+        payload_file = os.path.join(warc_folder, "payload.bin")
+        with open(payload_file, "wb") as payload_fd:
+            for _ in range(args.size_mb):
+                payload_fd.write(os.urandom(1024 * 1024))
+        filename = os.path.join(warc_folder, "large.warc.gz")
+        with open(filename, "wb") as warc_fd, open(payload_file, "rb") as payload_fd:
+            writer = WARCWriter(warc_fd, gzip=True)
+            http_headers = StatusAndHeaders("200 OK", [("Content-Type", "application/zip")], protocol="HTTP/1.1")
+            writer.write_record(writer.create_warc_record(url, "response", payload=payload_fd, length=size,
+                                                          http_headers=http_headers))
+        os.remove(payload_file)
+
+        for mode, chunk_threshold in (("whole", size + 1), ("chunked", args.chunk_threshold)):
+            queue = context.Queue()
+            process = context.Process(target=_measure_large_ingest,
+                                      args=(filename, url, chunk_threshold, args.chunk_size, queue))
+            process.start()
+            results[mode] = queue.get()
+            process.join()
+    return {
+        "benchmark": "large_ingest",
+        "payload_mb": args.size_mb,
+        "chunk_threshold": args.chunk_threshold,
+        "chunk_size": args.chunk_size,
+        **results,
+    }
+
+def bench_ingest(args):
+    """
+    Ingest synthetic WARC files into a fresh LevelDB with per-put writes and
+    with write batches, and compare the records per second.
+    """
+    subdomain = "bench.cdc.gov"
+    results = {}
+    with tempfile.TemporaryDirectory() as warc_folder:
+        url_list = synthetic_fetched_urls(warc_folder, subdomain, args.count, args.payload_size,
+                                          args.distinct_payloads)
+        # Alternate the modes and keep each one's best run, so neither is
+        # favoured by a warmer page cache
+        for _ in range(args.repeat):
+            for mode, batch_records in (("per_put", 0), ("batched", args.batch_records)):
+                with tempfile.TemporaryDirectory() as db_folder:
+                    ldb = WARCLevelDB(db_folder, batch_records=batch_records,
+                                      content_addressed=args.content_addressed)
+                    start = time()
+                    for url_data in url_list:
+                        ldb.process_url(subdomain, url_data)
+                    ldb.flush()
+                    duration = time() - start
+                    dedup = ldb.dedup_report()
+                    ldb.close()
+                if mode in results and results[mode]["seconds"] <= duration:
+                    continue
+                results[mode] = {
+                    "seconds": duration,
+                    "records_per_second": ldb.total_url / duration if duration else 0.0,
+                    "flushes": ldb.flush_count,
+                    "dedup": dedup,
+                }
+    return {
+        "benchmark": "ingest",
+        "paths": args.count,
+        "payload_size": args.payload_size,
+        "batch_records": args.batch_records,
+        "content_addressed": args.content_addressed,
+        **results,
+    }
+
+def synthetic_payloads(count, seed=0):
+    """
+    Payloads shaped like a CDC site's: HTML pages sharing their header, nav and
+    footer boilerplate, some CSS/JS/JSON, and incompressible PDFs and images.
+
+    :param count: Number of payloads
+    :param seed: Seed for the random text
+    :return: A list of (mimetype, payload bytes)
+    """
+    rng = random.Random(seed)
+    boilerplate = ("<!DOCTYPE html><html lang=\"en-us\"><head><meta charset=\"utf-8\">"
+                   "<link rel=\"stylesheet\" href=\"/TemplatePackage/4.0/assets/css/app.min.css\">"
+                   "<script src=\"/TemplatePackage/4.0/assets/js/app.min.js\"></script></head><body>"
+                   "<header class=\"cdc-header\"><nav>" +
+                   "".join(f"<a href=\"/{word}/index.html\">{word.title()}</a>" for word in WORDS) +
+                   "</nav></header>")
+    footer = ("<footer class=\"cdc-footer\"><p>Centers for Disease Control and Prevention. "
+              "1600 Clifton Rd. Atlanta, GA 30329-4027 USA 800-CDC-INFO (800-232-4636)</p></footer></body></html>")
+    payloads = []
+    for ix in range(count):
+        kind = ix % 10
+        if kind < 6:
+            body = "".join(f"<p>{' '.join(rng.choices(WORDS, k=rng.randint(20, 80)))}</p>"
+                           for _ in range(rng.randint(3, 30)))
+            payloads.append(("text/html; charset=utf-8",
+                             f"{boilerplate}<main><h1>Page {ix}</h1>{body}</main>{footer}".encode("utf-8")))
+        elif kind == 6:
+            rules = "".join(f".{rng.choice(WORDS)}-{n}{{margin:{n}px;color:#{rng.randrange(0xffffff):06x}}}\n"
+                            for n in range(rng.randint(50, 300)))
+            payloads.append(("text/css", rules.encode("utf-8")))
+        elif kind == 7:
+            rows = [{"state": rng.choice(WORDS), "year": 2000 + n % 25, "value": rng.random()}
+                    for n in range(rng.randint(20, 200))]
+            payloads.append(("application/json", json.dumps(rows).encode("utf-8")))
+        elif kind == 8:
+            payloads.append(("application/pdf", b"%PDF-1.7\n" + rng.randbytes(rng.randint(20000, 200000))))
+        else:
+            payloads.append(("image/png", b"\x89PNG\r\n\x1a\n" + rng.randbytes(rng.randint(2000, 50000))))
+    return payloads
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_compression(args):
+    """
+    Encode synthetic payloads with each codec, with and without a trained
+    dictionary, and report the size reduction against the decode latency.
+    """
+    payloads = synthetic_payloads(args.count)
+    training = [payload for mimetype, payload in synthetic_payloads(args.train_count, seed=1)
+                if mimetype.startswith("text/html")]
+    raw_bytes = sum(len(payload) for _, payload in payloads)
+
+    setups = [("none", None, False), ("zlib", "zlib", False), ("zlib+dict", "zlib", True)]
+    if zstandard is not None:
+        setups += [("zstd", "zstd", False), ("zstd+dict", "zstd", True)]
+    results = {}
+    for name, compression, use_dictionary in setups:
+        codec = ValueCodec(compression, args.level)
+        if use_dictionary:
+            codec.add_dictionary(1, codec.train_dictionary(training))
+        start = time()
+        values = [codec.encode(payload, mimetype) for mimetype, payload in payloads]
+        encode_seconds = time() - start
+        stored_bytes = sum(len(value) for value in values)
+
+        latencies = []
+        for value, (_, payload) in zip(values, payloads):
+            start = perf_counter()
+            decoded = codec.decode(value)
+            latencies.append(perf_counter() - start)
+            if decoded != payload:
+                raise AssertionError(f"{name} did not round-trip a payload")
+        text_values = [value for value, (mimetype, _) in zip(values, payloads) if mimetype.startswith("text/html")]
+        results[name] = {
+            "stored_bytes": stored_bytes,
+            "ratio": raw_bytes / stored_bytes if stored_bytes else 0.0,
+            "html_ratio": (sum(len(payload) for mimetype, payload in payloads if mimetype.startswith("text/html"))
+                           / sum(len(value) for value in text_values)) if text_values else 0.0,
+            "encode_mb_per_second": raw_bytes / encode_seconds / 1e6 if encode_seconds else 0.0,
+            "decode_p50_us": _percentile(latencies, 0.5) * 1e6,
+            "decode_p99_us": _percentile(latencies, 0.99) * 1e6,
+        }
+    return {
+        "benchmark": "compression",
+        "payloads": args.count,
+        "raw_bytes": raw_bytes,
+        "zstandard_installed": zstandard is not None,
+        **results,
+    }
+
+def bench_parallel_ingest(args):
+    """
+    Ingest synthetic WARC files serially with process_url(), then with the
+    process pool at each worker count, and report the speedup.
+    """
+    subdomain = "bench.cdc.gov"
+    results = {}
+    with tempfile.TemporaryDirectory() as warc_folder:
+        url_list = synthetic_fetched_urls(warc_folder, subdomain, args.count, args.payload_size)
+        runs = [("serial", None)] + [(f"workers_{workers}", workers) for workers in args.workers]
+        for name, workers in runs:
+            with tempfile.TemporaryDirectory() as db_folder:
+                ldb = WARCLevelDB(db_folder)
+                jobs = [(subdomain, dict(url_data, originals=list(url_data['originals']))) for url_data in url_list]
+                start = time()
+                if workers is None:
+                    for _, url_data in jobs:
+                        ldb.process_url(subdomain, url_data)
+                    ldb.flush()
+                else:
+                    ingest_parallel(ldb, jobs, workers, args.batch_files)
+                duration = time() - start
+                ldb.close()
+            results[name] = {
+                "seconds": duration,
+                "files_per_second": args.count / duration if duration else 0.0,
+                "speedup": results["serial"]["seconds"] / duration if results else 1.0,
+            }
+    return {
+        "benchmark": "parallel_ingest",
+        "files": args.count,
+        "payload_size": args.payload_size,
+        "cpus": os.cpu_count(),
+        **results,
+    }
+
+def bench_resume(args):
+    """
+    Time a restart of process_cdc_urls() over captures that were all fetched
+    and ingested before: with the ingest ledger skipping them, and with
+    --reingest parsing and writing every WARC again.
+    """
+    subdomain = "bench.cdc.gov"
+    results = {}
+    with tempfile.TemporaryDirectory() as state_folder, tempfile.TemporaryDirectory() as warc_folder, \
+            tempfile.TemporaryDirectory() as db_folder:
+        url_list = synthetic_fetched_urls(warc_folder, subdomain, args.count, args.payload_size)
+        fetched_state = FetchJournal(state_folder, subdomain)
+        for url_data in url_list:
+            fetched_state.record(url_data['path'], url_data.pop('fetched'))
+        fetched_state.close()
+
+        ldb = WARCLevelDB(db_folder)
+        for name, reingest in (("first_run", False), ("resume", False), ("reingest", True)):
+            total_path = ldb.total_path
+            start = time()
+            process_cdc_urls(state_folder, warc_folder, True, False, None, {subdomain: url_list}, ldb,
+                             reingest=reingest)
+            ldb.flush()
+            duration = time() - start
+            results[name] = {"seconds": duration, "ingested": ldb.total_path - total_path}
+        ldb.close()
+    return {
+        "benchmark": "resume",
+        "paths": args.count,
+        **results,
+    }
+
+def bench_refresh(args):
+    """
+    Refresh captures whose CDX digest hasn't changed, so each path's own
+    stored URL is the copy source, and compare copy_capture() with ingesting
+    the WARC files again. Every URL of every path must then carry the new
+    timestamp, in the DB and in the ingest ledger alike. Last, every path is
+    refreshed to a capture with other content, after which the digest index
+    must no longer offer it as a source of the old payload.
+    """
+    subdomain = "bench.cdc.gov"
+    results = {}
+    with tempfile.TemporaryDirectory() as warc_folder, tempfile.TemporaryDirectory() as db_folder:
+        url_list = synthetic_fetched_urls(warc_folder, subdomain, args.count, args.payload_size)
+        ldb = WARCLevelDB(db_folder, chunk_threshold=args.chunk_threshold)
+        for url_data in url_list:
+            ldb.process_url(subdomain, url_data)
+        ldb.flush()
+        expected = {url_data['original']: ldb.get_content(url_data['original']) for url_data in url_list}
+
+        for name, timestamp in (("copy", "20250601000000"), ("reingest", "20250701000000")):
+            refreshed = [dict(url_data, timestamp=timestamp, originals=list(url_data['originals']),
+                              fetched=dict(url_data['fetched']) if name == "reingest" else
+                              {"file": None, "issues": False})
+                         for url_data in url_list]
+            start = time()
+            for url_data in refreshed:
+                if name == "copy":
+                    ldb.copy_capture(subdomain, url_data, ldb.find_cdx_digest(url_data['digest']))
+                else:
+                    ldb.process_url(subdomain, url_data)
+            ldb.flush()
+            duration = time() - start
+            for url_data in refreshed:
+                ledger = ldb.ingested_db.get(f"{subdomain}{url_data['path']}".encode("utf-8"))
+                if ledger.decode("utf-8").partition(" ")[0] != timestamp:
+                    raise AssertionError(f"Ingest ledger of {url_data['path']} holds {ledger} after the {name}")
+                for url in url_data['originals']:
+                    stored = ldb.timestamp_db.get(url.encode("utf-8"))
+                    if stored != timestamp.encode("utf-8"):
+                        raise AssertionError(f"{url} has timestamp {stored} after the {name}, not {timestamp}")
+                    if ldb.get_content(url) != expected[url_data['original']]:
+                        raise AssertionError(f"{url} lost its payload after the {name}")
+            results[name] = {"seconds": duration, "paths_per_second": args.count / duration if duration else 0.0}
+
+        changed_folder = os.path.join(warc_folder, "changed")
+        os.mkdir(changed_folder)
+        changed = []
+        for ix, url_data in enumerate(url_list):
+            filename = os.path.join(changed_folder, f"{ix:08d}.warc.gz")
+            payload = (f"<html>changed {url_data['path']}</html>".encode("utf-8") * args.payload_size)
+            write_synthetic_warc(filename, url_data['original'], payload[:args.payload_size])
+            changed.append(dict(url_data, timestamp="20250801000000", digest=url_data['digest'] + "V2",
+                                originals=list(url_data['originals']), fetched={"file": filename, "issues": False}))
+        start = time()
+        for url_data in changed:
+            ldb.process_url(subdomain, url_data)
+        ldb.flush()
+        duration = time() - start
+        for old, url_data in zip(url_list, changed):
+            source = ldb.find_cdx_digest(old['digest'])
+            if source is not None:
+                raise AssertionError(f"Digest {old['digest']} still names {source} after it was refreshed")
+            source = ldb.find_cdx_digest(url_data['digest'])
+            if source is None or ldb.get_content(source) == expected[url_data['original']]:
+                raise AssertionError(f"Digest {url_data['digest']} doesn't name the changed payload")
+        results["changed_digest"] = {"seconds": duration,
+                                     "paths_per_second": args.count / duration if duration else 0.0}
+        chunks = sum(1 for _ in ldb.chunk_db.iterator(include_value=False))
+        ldb.close()
+    return {
+        "benchmark": "refresh",
+        "paths": args.count,
+        "payload_size": args.payload_size,
+        "chunks": chunks,
+        **results,
+    }
+
+def bench_warc_store(args):
+    """
+    Write synthetic captures one WARC file each and to rolling WARC files,
+    then ingest both, and compare the file counts and timings.
+    """
+    subdomain = "bench.cdc.gov"
+    url_list = synthetic_url_list(subdomain, args.count)
+    payloads = [(f"<html>{url_data['path']}</html>".encode("utf-8") * args.payload_size)[:args.payload_size]
+                for url_data in url_list]
+    http_headers = StatusAndHeaders("200 OK", [("Content-Type", "text/html")], protocol="HTTP/1.1")
+    results = {}
+    for mode in ("per_capture", "rolling"):
+        with tempfile.TemporaryDirectory() as warc_folder, tempfile.TemporaryDirectory() as db_folder:
+            jobs = []
+            start = time()
+            if mode == "rolling":
+                store = IndexedWARCWriter(warc_folder, {"software": "benchmark"}, args.rolling_bytes)
+                # Only used to build records; IndexedWARCWriter writes them
+                record_factory = WARCWriter(BytesIO(), gzip=True)
+                for url_data, payload in zip(url_list, payloads):
+                    record = record_factory.create_warc_record(
+                        url_data['original'], "response", payload=BytesIO(payload), http_headers=http_headers)
+                    filename, offset, length = store.write_capture(record, url_data, subdomain)
+                    jobs.append(dict(url_data, fetched={"file": filename, "offset": offset, "length": length,
+                                                        "issues": False}))
+                store.close()
+            else:
+                for ix, (url_data, payload) in enumerate(zip(url_list, payloads)):
+                    filename = os.path.join(warc_folder, f"{ix:08d}.warc.gz")
+                    write_synthetic_warc(filename, url_data['original'], payload)
+                    jobs.append(dict(url_data, fetched={"file": filename, "issues": False}))
+            write_seconds = time() - start
+            files = len(os.listdir(warc_folder))
+
+            ldb = WARCLevelDB(db_folder)
+            start = time()
+            for url_data in jobs:
+                ldb.process_url(subdomain, url_data)
+            ldb.flush()
+            ingest_seconds = time() - start
+            ldb.close()
+        results[mode] = {
+            "files": files,
+            "write_seconds": write_seconds,
+            "ingest_seconds": ingest_seconds,
+            "ingest_per_second": args.count / ingest_seconds if ingest_seconds else 0.0,
+        }
+    return {
+        "benchmark": "warc_store",
+        "captures": args.count,
+        "rolling_bytes": args.rolling_bytes,
+        **results,
+    }
+
+def bench_downloads(args):
+    """
+    Download synthetic captures from a fake wayback server and report the
+    achieved request rate.
+    """
+    server = FakeWaybackServer(("127.0.0.1", 0), latency=args.latency, throttle_rps=args.throttle_rps)
+    server.start()
+    subdomain = "bench.cdc.gov"
+    url_list = {subdomain: synthetic_url_list(subdomain, args.count)}
+
+    scheduler = DownloadScheduler(max_workers=args.workers)
+    limiter = HostRateLimiter(args.rate, args.burst, max_rate=args.max_rate)
+    client = HTTPClient(limiter, pool_maxsize=max(args.workers, 1))
+    with tempfile.TemporaryDirectory() as state_folder, tempfile.TemporaryDirectory() as warc_folder:
+        start = time()
+        failed_urls = process_cdc_urls(
+            state_folder, warc_folder, True, False, None, url_list, None,
+            scheduler=scheduler, client=client, wayback_url=f"{server.base_url}/web",
+            transient_backoff=args.backoff
+        )
+        duration = time() - start
+    scheduler.close()
+    client_stats = client.stats()
+    client.close()
+    server.shutdown()
+
+    return {
+        "benchmark": "downloads",
+        "workers": args.workers,
+        "rate_limit": args.rate,
+        "latency": args.latency,
+        "captures": args.count,
+        "failed": len(failed_urls),
+        "seconds": duration,
+        "captures_per_second": args.count / duration if duration else 0.0,
+        "server": server.stats(),
+        "rate_limiter": limiter.state(),
+        "client": client_stats,
+    }
+
+def bench_end_to_end(args):
+    """
+    Fetch synthetic captures from a fake wayback server into a LevelDB in
+    each fetch mode, and report URLs per second. "warc" counts the time to
+    both download and ingest the WARC files, as the pipeline does.
+    With `distinct_digests` set, the paths' CDX digests cycle through that
+    many values, and only one capture per digest may be fetched.
+    """
+    server = FakeWaybackServer(("127.0.0.1", 0), latency=args.latency)
+    server.start()
+    subdomain = "bench.cdc.gov"
+    results = {}
+    for mode in args.modes:
+        url_list = {subdomain: synthetic_url_list(subdomain, args.count)}
+        if args.distinct_digests:
+            for ix, url_data in enumerate(url_list[subdomain]):
+                url_data['digest'] = f"DIGEST{ix % args.distinct_digests:08d}"
+        scheduler = DownloadScheduler(max_workers=args.workers)
+        client = HTTPClient(HostRateLimiter(args.rate), pool_maxsize=max(args.workers, 1))
+        requests_before = server.stats()["requests"]
+        with tempfile.TemporaryDirectory() as state_folder, tempfile.TemporaryDirectory() as warc_folder, \
+                tempfile.TemporaryDirectory() as db_folder:
+            ldb = WARCLevelDB(db_folder)
+            start = time()
+            failed_urls = process_cdc_urls(
+                state_folder, warc_folder, True, False, None, url_list, ldb,
+                scheduler=scheduler, client=client, wayback_url=f"{server.base_url}/web",
+                warc_rolling_bytes=args.rolling_bytes, fetch_mode=mode
+            )
+            ldb.flush()
+            duration = time() - start
+            ingested = ldb.total_url
+            copied = ldb.copied_captures
+            ldb.close()
+            warc_files = len([name for name in os.listdir(warc_folder) if ".warc" in name])
+        scheduler.close()
+        client.close()
+        fetches = server.stats()["requests"] - requests_before
+        if args.distinct_digests and not failed_urls and fetches > args.distinct_digests:
+            raise AssertionError(f"{fetches} captures fetched in {mode} mode for {args.distinct_digests} digests")
+        results[mode] = {
+            "seconds": duration,
+            "urls_per_second": args.count / duration if duration else 0.0,
+            "urls_ingested": ingested,
+            "captures_fetched": fetches,
+            "captures_copied": copied,
+            "failed": len(failed_urls),
+            "warc_files": warc_files,
+        }
+    server.shutdown()
+    return {
+        "benchmark": "end_to_end",
+        "captures": args.count,
+        "workers": args.workers,
+        "latency": args.latency,
+        **results,
+    }
+
+def _measure_streaming(mode, base_url, subdomains, workers, queue):
+    with tempfile.TemporaryDirectory() as state_folder, tempfile.TemporaryDirectory() as db_folder:
+        # One more connection for the enumeration running ahead
+        client = HTTPClient(HostRateLimiter(1000.0), pool_maxsize=workers + 1)
+        scheduler = DownloadScheduler(max_workers=workers)
+        ldb = WARCLevelDB(db_folder)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time()
+        cdx_url = f"{base_url}/cdx/search/cdx"
+        if mode == "whole_run":
+            url_lists = detect_urlkeys_from_subdomains(state_folder, subdomains, client, cdx_url=cdx_url)
+        else:
+            url_lists = prefetch(iter_subdomain_urlkeys(state_folder, subdomains, client, cdx_url=cdx_url))
+        failed_urls = process_cdc_urls(state_folder, None, True, False, None, url_lists, ldb,
+                                       scheduler=scheduler, client=client, wayback_url=f"{base_url}/web",
+                                       fetch_mode="db_only")
+        ldb.flush()
+        duration = time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        scheduler.close()
+        client.close()
+        paths = ldb.total_path
+        ldb.close()
+    queue.put({
+        "seconds": duration,
+        "paths": paths,
+        "failed": len(failed_urls),
+        "peak_rss_growth_mb": (rss_after - rss_before) / 1024,
+    })
+
+def bench_streaming(args):
+    """
+    Enumerate, fetch and ingest a growing number of subdomains from the fake
+    wayback server, loading every URL list up front ("whole_run") or
+    streaming them one subdomain at a time, each run in a fresh process,
+    and compare their peak memory.
+    """
+    server = FakeWaybackServer(("127.0.0.1", 0), cdx_paths=args.paths, cdx_captures=1)
+    server.start()
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for count in args.subdomains:
+        subdomains = [f"bench{ix}.cdc.gov" for ix in range(count)]
+        for mode in ("whole_run", "streaming"):
+            queue = context.Queue()
+            process = context.Process(target=_measure_streaming,
+                                      args=(mode, server.base_url, subdomains, args.workers, queue))
+            process.start()
+            results[f"{mode}_{count}"] = queue.get()
+            process.join()
+    server.shutdown()
+    return {
+        "benchmark": "streaming",
+        "paths_per_subdomain": args.paths,
+        **results,
+    }
+
+def _measure_url_list(mode, filename, lookups, queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {}
+    start = perf_counter()
+    if mode == "jsonl":
+        # What a resume used to do: load the whole list before anything else
+        url_list = list(iter_jsonl(filename))
+        result["startup_seconds"] = perf_counter() - start
+        by_path = {url_data['path']: url_data for url_data in url_list}
+        result["scan_seconds"] = result["startup_seconds"]
+        start = perf_counter()
+        for path in lookups:
+            by_path[path]
+    else:
+        url_list = URLListFile(filename)
+        len(url_list)
+        result["startup_seconds"] = perf_counter() - start
+        start = perf_counter()
+        for _ in url_list:
+            pass
+        result["scan_seconds"] = perf_counter() - start
+        start = perf_counter()
+        for path in lookups:
+            url_list.get(path)
+    result["lookups_per_second"] = len(lookups) / (perf_counter() - start)
+    result["peak_rss_growth_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    queue.put(result)
+
+def _write_url_list_files(state_folder, paths, captures, lookups, queue):
+    deduplicator = CDXDeduplicator(list(CDX_HEADERS))
+    deduplicator.add_rows(synthetic_cdx_rows(paths * captures, captures))
+    jsonl_file = os.path.join(state_folder, "url_list.bench.cdc.gov.list")
+    written = []
+    with open(jsonl_file, "w", encoding="utf-8") as state_fd:
+        for url_data in deduplicator.iter_results(drain=True):
+            state_fd.write(json.dumps(url_data) + "\n")
+            written.append(url_data['path'])
+    start = time()
+    bin_file, _ = convert_state_file(jsonl_file)
+    queue.put((jsonl_file, bin_file, time() - start, random.Random(0).sample(written, min(lookups, len(written)))))
+
+def bench_url_list(args):
+    """
+    Compare a url_list state file as JSON lines with the binary format:
+    file size, the time to open it, to read every row, and to look paths up,
+    and the memory that takes, each in a fresh process.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as state_folder:
+        # Written by another process too: a child's peak RSS starts from its parent's
+        queue = context.Queue()
+        process = context.Process(target=_write_url_list_files,
+                                  args=(state_folder, args.paths, args.captures, args.lookups, queue))
+        process.start()
+        jsonl_file, bin_file, convert_seconds, lookups = queue.get()
+        process.join()
+        for mode, filename in (("jsonl", jsonl_file), ("binary", bin_file)):
+            queue = context.Queue()
+            process = context.Process(target=_measure_url_list, args=(mode, filename, lookups, queue))
+            process.start()
+            results[mode] = dict(queue.get(), file_bytes=os.path.getsize(filename))
+            process.join()
+    return {
+        "benchmark": "url_list",
+        "paths": args.paths,
+        "convert_seconds": convert_seconds,
+        **results,
+    }
+
+def _serve_db(db_folder, cache_bytes, queue, stop):
+    ldb = WARCLevelDB(db_folder)
+    server = LevelDBServer(("127.0.0.1", 0), CachedReader(ldb, cache_bytes))
+    server.start()
+    queue.put(server.server_address[1])
+    stop.wait()
+    queue.put(server.stats())
+    server.shutdown()
+    ldb.close()
+
+def _load_client(port, urls, requests, conditional, ranges, seed, latencies):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    etags = {}
+    for url in urls[:requests]:
+        headers = {}
+        draw = rng.random()
+        if draw < conditional and url in etags:
+            headers["If-None-Match"] = etags[url]
+        elif draw < conditional + ranges:
+            headers["Range"] = "bytes=0-1023"
+        start = perf_counter()
+        connection.request("GET", f"/{url}", headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(perf_counter() - start)
+        if response.status not in (200, 206, 304):
+            raise AssertionError(f"Got {response.status} for {url}")
+        etags[url] = response.getheader("ETag")
+    connection.close()
+
+def bench_serve(args):
+    """
+    Load-test the HTTP server over a LevelDB of synthetic pages: concurrent
+    keep-alive clients request pages with a skewed popularity (a few hot
+    pages, a long tail), some of them conditionally or as a byte range.
+    The server runs in its own process, once per cache size, and the
+    latency percentiles and requests per second are reported.
+    """
+    subdomain = "bench.cdc.gov"
+    urls = [f"https://{subdomain}/page/{ix:07d}.html" for ix in range(args.pages)]
+    rng = random.Random(0)
+    # Zipf-like: the page of rank r is requested in proportion to 1 / r ** skew
+    weights = [1 / (rank + 1) ** args.skew for rank in range(args.pages)]
+    per_client = args.requests // args.clients
+    client_urls = [rng.choices(urls, weights, k=per_client) for _ in range(args.clients)]
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as db_folder:
+        ldb = WARCLevelDB(db_folder, compression=args.compression)
+        for url, (mimetype, payload) in zip(urls, synthetic_payloads(args.pages)):
+            url_data = {"originals": [url], "timestamp": "20240101000000", "path": url[len(subdomain) + 8:],
+                        "fetched": {"file": None}}
+            ldb.store_record(subdomain, url_data, url, mimetype, payload)
+        ldb.close()
+
+        for cache_mb in args.cache_mb:
+            queue = context.Queue()
+            stop = context.Event()
+            process = context.Process(target=_serve_db, args=(db_folder, cache_mb * 1024 * 1024, queue, stop))
+            process.start()
+            port = queue.get()
+            latencies = []
+            threads = [threading.Thread(target=_load_client,
+                                        args=(port, client_urls[ix], per_client, args.conditional,
+                                              args.ranges, ix, latencies))
+                       for ix in range(args.clients)]
+            start = time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time() - start
+            stop.set()
+            server_stats = queue.get()
+            process.join()
+            results[f"cache_{cache_mb}mb"] = {
+                "requests": len(latencies),
+                "seconds": duration,
+                "requests_per_second": len(latencies) / duration if duration else 0.0,
+                "p50_ms": _percentile(latencies, 0.5) * 1e3,
+                "p90_ms": _percentile(latencies, 0.9) * 1e3,
+                "p99_ms": _percentile(latencies, 0.99) * 1e3,
+                "max_ms": max(latencies) * 1e3,
+                "server": server_stats,
+            }
+    return {
+        "benchmark": "serve",
+        "pages": args.pages,
+        "clients": args.clients,
+        "compression": args.compression,
+        **results,
+    }
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "date": strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def suite_config(section, run_folder, base_url, rate):
+    """
+    A copy of a run_config.yaml section pointed at the fake wayback server
+    and at folders under `run_folder`.
+
+    :param section: The dev or prod section of the configuration
+    :param run_folder: Folder the run's data goes to
+    :param base_url: The fake wayback server's URL
+    :param rate: Requests per second allowed, instead of the section's; its
+                 lower and upper bounds are scaled to keep their proportions
+    :return: The configuration section
+    """
+    data_folder = os.path.join(run_folder, "data")
+    scale = rate / section.get('requests_per_second', rate)
+    config = dict(section)
+    config.update({
+        "csv_file": os.path.join(data_folder, "subdomains.txt"),
+        "warc_folder": os.path.join(data_folder, "warcs") + "/",
+        "db_folder": os.path.join(data_folder, "db") + "/",
+        "state_folder": os.path.join(data_folder, "state") + "/",
+        "failed_url_list": os.path.join(data_folder, "failed_URLs.txt"),
+        "wayback_url": f"{base_url}/web",
+        "cdx_url": f"{base_url}/cdx/search/cdx",
+        "requests_per_second": rate,
+        "metrics_file": os.path.join(run_folder, "metrics.prom"),
+    })
+    for key in ("min_requests_per_second", "max_requests_per_second"):
+        if section.get(key):
+            config[key] = section[key] * scale
+    return config
+
+def read_metrics_file(filename):
+    """
+    :param filename: A metrics file written by metrics.MetricsReporter
+    :return: {sample: value}, the samples keyed by their name and labels as written
+    """
+    samples = {}
+    with open(filename, "r", encoding="utf-8") as metrics_fd:
+        for line in metrics_fd:
+            if line.startswith("#") or not line.strip():
+                continue
+            sample, _, value = line.rstrip("\n").rpartition(" ")
+            samples[sample] = float(value)
+    return samples
+
+def _best(runs, key="seconds"):
+    return min(runs, key=lambda run: run[key])
+
+def _suite_enumerate(config, corpus, subdomains, repeat):
+    rows = sum(corpus.row_count(subdomain) for subdomain in subdomains)
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as state_folder:
+            client = HTTPClient(HostRateLimiter(config['requests_per_second']))
+            start = time()
+            paths = 0
+            for _, url_list in iter_subdomain_urlkeys(
+                    state_folder, subdomains, client, cdx_url=config['cdx_url'],
+                    page_size=config.get('cdx_page_size', DEFAULT_CDX_PAGE_SIZE),
+                    ts_from=str(config.get('cdx_from', DEFAULT_CDX_FROM)),
+                    ts_to=str(config.get('cdx_to', DEFAULT_CDX_TO)),
+                    url_list_format=config.get('url_list_format', "jsonl")):
+                paths += sum(1 for _ in url_list)
+            duration = time() - start
+            client.close()
+        runs.append({"seconds": duration, "rows": rows, "rows_per_second": rows / duration if duration else 0.0,
+                     "paths": paths})
+    return _best(runs)
+
+def _suite_clean_urls(corpus, subdomains, repeat):
+    rows = [row for subdomain in subdomains for row in corpus.iter_rows(subdomain)]
+    runs = []
+    for _ in range(repeat):
+        start = time()
+        deduplicator = CDXDeduplicator(list(CDX_HEADERS))
+        deduplicator.add_rows(rows)
+        cleaned = deduplicator.results()
+        runs.append({"seconds": time() - start, "rows": len(rows), "paths": len(cleaned)})
+    run = _best(runs)
+    run["rows_per_second"] = run["rows"] / run["seconds"] if run["seconds"] else 0.0
+    return run, cleaned
+
+def _suite_ingest(config, corpus, cleaned, repeat):
+    with tempfile.TemporaryDirectory() as warc_folder:
+        payload_bytes = 0
+        url_lists = {}
+        for ix, url_data in enumerate(cleaned):
+            subdomain = url_data['original'].split("/")[2]
+            mimetype, payload = corpus.capture(subdomain, url_data['path'], url_data['timestamp'])
+            filename = os.path.join(warc_folder, f"{ix:08d}.warc.gz")
+            write_synthetic_warc(filename, url_data['original'], payload, mimetype)
+            url_data['fetched'] = {"file": filename, "issues": False}
+            url_lists.setdefault(subdomain, []).append(url_data)
+            payload_bytes += len(payload)
+        runs = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as db_folder:
+                ldb = WARCLevelDB(
+                    db_folder,
+                    batch_records=config.get('db_batch_records', DEFAULT_BATCH_RECORDS),
+                    batch_bytes=config.get('db_batch_bytes', DEFAULT_BATCH_BYTES),
+                    batch_seconds=config.get('db_batch_seconds', DEFAULT_BATCH_SECONDS),
+                    content_addressed=config.get('db_content_addressed', False),
+                    compression=config.get('db_compression'),
+                    compression_level=config.get('db_compression_level'),
+                    chunk_threshold=config.get('db_chunk_threshold', DEFAULT_CHUNK_THRESHOLD),
+                    chunk_size=config.get('db_chunk_size', DEFAULT_CHUNK_SIZE)
+                )
+                start = time()
+                for subdomain, url_list in url_lists.items():
+                    for url_data in url_list:
+                        ldb.process_url(subdomain, url_data)
+                ldb.flush()
+                duration = time() - start
+                dedup = ldb.dedup_report()
+                ldb.close()
+            runs.append({
+                "seconds": duration,
+                "paths": len(cleaned),
+                "paths_per_second": len(cleaned) / duration if duration else 0.0,
+                "payload_mb_per_second": payload_bytes / 1e6 / duration if duration else 0.0,
+                "bytes_written": ldb.bytes_written,
+                "dedup": dedup,
+            })
+    return _best(runs)
+
+def _suite_end_to_end(config, run_mode, subdomains, run_folder):
+    os.makedirs(os.path.dirname(config['csv_file']), exist_ok=True)
+    with open(config['csv_file'], "w", encoding="utf-8") as csv_fd:
+        csv_fd.write("".join(f"{subdomain}\n" for subdomain in subdomains))
+    config_file = os.path.join(run_folder, "run_config.yaml")
+    with open(config_file, "w", encoding="utf-8") as config_fd:
+        yaml.safe_dump({run_mode: config}, config_fd)
+    # pipeline.py writes its log to ../logs, so it runs from a src folder of its own
+    work_folder = os.path.join(run_folder, "src")
+    os.makedirs(work_folder, exist_ok=True)
+    pipeline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline.py")
+    start = time()
+    completed = subprocess.run([sys.executable, pipeline, "--run_mode", run_mode, "--config", config_file],
+                               cwd=work_folder, capture_output=True, text=True)
+    duration = time() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"pipeline.py failed with exit code {completed.returncode}:\n{completed.stderr[-4000:]}")
+    samples = read_metrics_file(config['metrics_file'])
+    captures = {}
+    for sample, value in samples.items():
+        if sample.startswith("restore_captures_total"):
+            result = sample.split('result="')[1].split('"')[0]
+            captures[result] = captures.get(result, 0) + value
+    paths = samples.get("restore_leveldb_paths_total", 0)
+    return {
+        "seconds": duration,
+        "paths": paths,
+        "paths_per_second": paths / duration if duration else 0.0,
+        "urls": samples.get("restore_leveldb_urls_total", 0),
+        "captures": captures,
+        "cdx_rows": sum(value for sample, value in samples.items() if sample.startswith("restore_cdx_rows_total")),
+        "http_requests": samples.get("restore_http_requests_total", 0),
+        "bytes_written": samples.get("restore_leveldb_bytes_written_total", 0),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+SUITE_STAGES = ("enumerate", "clean_urls", "ingest", "end_to_end")
+# Settings that only point the run at its temporary folders and the fake server
+SUITE_RUN_PATHS = ("csv_file", "warc_folder", "db_folder", "state_folder", "failed_url_list",
+                   "wayback_url", "cdx_url", "metrics_file")
+
+def bench_suite(args):
+    """
+    Time each stage, then the whole pipeline, over a synthetic corpus served
+    by the fake wayback server, with a dev or prod section of
+    run_config.yaml pointed at it. The results carry the environment and
+    every setting, so that two runs can be put side by side with `compare`.
+    """
+    section = load_config(args.config_file)[args.config]
+    corpus = SyntheticCorpus(args.paths, args.captures, args.duplicate_ratio, args.unchanged_ratio,
+                             size_scale=args.size_scale, seed=args.seed)
+    subdomains = [f"bench{ix}.cdc.gov" for ix in range(args.subdomains)]
+    server = FakeWaybackServer(("127.0.0.1", 0), latency=args.latency, retry_after=args.retry_after, corpus=corpus,
+                               jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    server.start()
+    stages = {}
+    with tempfile.TemporaryDirectory() as run_folder:
+        config = suite_config(section, run_folder, server.base_url, args.rate)
+        config['transient_backoff'] = args.backoff
+        if "enumerate" in args.stages:
+            stages["enumerate"] = _suite_enumerate(config, corpus, subdomains, args.repeat)
+        if "clean_urls" in args.stages or "ingest" in args.stages:
+            stages["clean_urls"], cleaned = _suite_clean_urls(corpus, subdomains, args.repeat)
+            if "ingest" in args.stages:
+                stages["ingest"] = _suite_ingest(config, corpus, cleaned, args.repeat)
+        if "end_to_end" in args.stages:
+            server.reset_stats()
+            stages["end_to_end"] = _suite_end_to_end(config, args.config, subdomains, run_folder)
+            stages["end_to_end"]["server"] = server.stats()
+    server.shutdown()
+    return {
+        "benchmark": "suite",
+        "environment": _environment(),
+        "config": args.config,
+        "settings": {key: value for key, value in config.items() if key not in SUITE_RUN_PATHS},
+        "corpus": {
+            "subdomains": args.subdomains,
+            "paths": args.paths,
+            "captures": args.captures,
+            "duplicate_ratio": args.duplicate_ratio,
+            "unchanged_ratio": args.unchanged_ratio,
+            "size_scale": args.size_scale,
+            "seed": args.seed,
+            "rows": sum(corpus.row_count(subdomain) for subdomain in subdomains),
+        },
+        "server": {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+                   "retry_after": args.retry_after},
+        "stages": stages,
+    }
+
+def _ratios(baseline, candidate):
+    ratios = {}
+    for key, value in baseline.items():
+        other = candidate.get(key)
+        if isinstance(value, dict) and isinstance(other, dict):
+            nested = _ratios(value, other)
+            if nested:
+                ratios[key] = nested
+        elif (isinstance(value, (int, float)) and isinstance(other, (int, float))
+              and not isinstance(value, bool) and value):
+            ratios[key] = other / value
+    return ratios
+
+def compare_results(args):
+    """
+    Put two `suite` results side by side: each stage's numbers in the
+    candidate divided by the baseline's (below 1 is faster for seconds,
+    above 1 is faster for the rates). Differences in the settings, the
+    corpus or the environment are listed, as they make the ratios moot.
+    """
+    with open(args.baseline, "r", encoding="utf-8") as baseline_fd:
+        baseline = json.load(baseline_fd)
+    with open(args.candidate, "r", encoding="utf-8") as candidate_fd:
+        candidate = json.load(candidate_fd)
+    differences = {}
+    for part in ("settings", "corpus", "server", "environment"):
+        for key in sorted(set(baseline.get(part, {})) | set(candidate.get(part, {}))):
+            before, after = baseline.get(part, {}).get(key), candidate.get(part, {}).get(key)
+            if before != after and key != "date":
+                differences[f"{part}.{key}"] = [before, after]
+    return {
+        "benchmark": "compare",
+        "baseline": args.baseline,
+        "candidate": args.candidate,
+        "differences": differences,
+        "ratios": _ratios(baseline.get("stages", {}), candidate.get("stages", {})),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    downloads = subparsers.add_parser("downloads", help="Concurrent capture downloads")
+    downloads.add_argument("--count", type=int, default=200, help="Number of captures")
+    downloads.add_argument("--workers", type=int, default=8, help="Download worker threads")
+    downloads.add_argument("--rate", type=float, default=50.0, help="Requests per second per host")
+    downloads.add_argument("--burst", type=int, default=1, help="Token bucket burst size")
+    downloads.add_argument("--max-rate", type=float, default=None, help="Rate the limiter may speed up to")
+    downloads.add_argument("--latency", type=float, default=0.1, help="Fake server latency in seconds")
+    downloads.add_argument("--throttle-rps", type=float, default=None, help="Fake server sends 429s above this rate")
+    downloads.add_argument("--backoff", type=float, default=1.0, help="Seconds before retrying throttled captures")
+    downloads.set_defaults(func=bench_downloads)
+
+    cleaning = subparsers.add_parser("clean_urls", help="CDX row deduplication")
+    cleaning.add_argument("--rows", type=int, default=5000000, help="Number of synthetic CDX rows")
+    cleaning.add_argument("--captures", type=int, default=3, help="Captures per path")
+    cleaning.add_argument("--verify-rows", type=int, default=100000, help="Rows used to check the outputs match")
+    cleaning.set_defaults(func=bench_clean_urls)
+
+    ingest = subparsers.add_parser("ingest", help="WARC ingestion into the LevelDB")
+    ingest.add_argument("--count", type=int, default=5000, help="Number of WARC files")
+    ingest.add_argument("--payload-size", type=int, default=4096, help="Bytes per payload")
+    ingest.add_argument("--batch-records", type=int, default=1000, help="Paths per write batch")
+    ingest.add_argument("--repeat", type=int, default=3, help="Runs per mode; the best is reported")
+    ingest.add_argument("--content-addressed", action="store_true", help="Store payloads by digest")
+    ingest.add_argument("--distinct-payloads", type=int, default=None,
+                        help="Number of distinct bodies the payloads cycle through")
+    ingest.set_defaults(func=bench_ingest)
+
+    parallel = subparsers.add_parser("parallel_ingest", help="WARC parsing in a process pool")
+    parallel.add_argument("--count", type=int, default=5000, help="Number of WARC files")
+    parallel.add_argument("--payload-size", type=int, default=16384, help="Bytes per payload")
+    parallel.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to try")
+    parallel.add_argument("--batch-files", type=int, default=32, help="WARC files per worker task")
+    parallel.set_defaults(func=bench_parallel_ingest)
+
+    resume = subparsers.add_parser("resume", help="Restarting over already ingested captures")
+    resume.add_argument("--count", type=int, default=5000, help="Number of fetched captures")
+    resume.add_argument("--payload-size", type=int, default=16384, help="Bytes per payload")
+    resume.set_defaults(func=bench_resume)
+
+    refresh = subparsers.add_parser("refresh", help="Refreshing captures, with and without a new digest")
+    refresh.add_argument("--count", type=int, default=2000, help="Number of paths")
+    refresh.add_argument("--payload-size", type=int, default=16384, help="Bytes per payload")
+    refresh.add_argument("--chunk-threshold", type=int, default=8 * 1024 * 1024,
+                         help="Chunking threshold in bytes (below the payload size to copy chunked payloads)")
+    refresh.set_defaults(func=bench_refresh)
+
+    store = subparsers.add_parser("warc_store", help="Rolling WARC files against a file per capture")
+    store.add_argument("--count", type=int, default=5000, help="Number of captures")
+    store.add_argument("--payload-size", type=int, default=4096, help="Bytes per payload")
+    store.add_argument("--rolling-bytes", type=int, default=100000000, help="Size cap of the rolling files")
+    store.set_defaults(func=bench_warc_store)
+
+    large = subparsers.add_parser("large_ingest", help="Memory use ingesting one large capture")
+    large.add_argument("--size-mb", type=int, default=256, help="Payload size in MB")
+    large.add_argument("--chunk-threshold", type=int, default=8 * 1024 * 1024, help="Chunking threshold in bytes")
+    large.add_argument("--chunk-size", type=int, default=1024 * 1024, help="Chunk size in bytes")
+    large.set_defaults(func=bench_large_ingest)
+
+    compression = subparsers.add_parser("compression", help="Payload size against decode latency per codec")
+    compression.add_argument("--count", type=int, default=2000, help="Number of synthetic payloads")
+    compression.add_argument("--train-count", type=int, default=500, help="Payloads to train dictionaries on")
+    compression.add_argument("--level", type=int, default=None, help="Compression level")
+    compression.set_defaults(func=bench_compression)
+
+    end_to_end = subparsers.add_parser("end_to_end", help="Fetching and ingesting in each fetch mode")
+    end_to_end.add_argument("--count", type=int, default=2000, help="Number of captures")
+    end_to_end.add_argument("--workers", type=int, default=8, help="Download worker threads")
+    end_to_end.add_argument("--rate", type=float, default=1000.0, help="Requests per second per host")
+    end_to_end.add_argument("--latency", type=float, default=0.0, help="Fake server latency in seconds")
+    end_to_end.add_argument("--rolling-bytes", type=int, default=100000000, help="Size cap of the rolling files")
+    end_to_end.add_argument("--distinct-digests", type=int, default=0,
+                            help="Cycle the paths' CDX digests through this many values (0: all distinct)")
+    end_to_end.add_argument("--modes", nargs="+", choices=FETCH_MODES, default=list(FETCH_MODES),
+                            help="Fetch modes to run")
+    end_to_end.set_defaults(func=bench_end_to_end)
+
+    streaming = subparsers.add_parser("streaming", help="Peak memory against the number of subdomains")
+    streaming.add_argument("--paths", type=int, default=1000, help="Paths per subdomain")
+    streaming.add_argument("--subdomains", type=int, nargs="+", default=[1, 4, 8], help="Subdomain counts to try")
+    streaming.add_argument("--workers", type=int, default=8, help="Download worker threads")
+    streaming.set_defaults(func=bench_streaming)
+
+    url_list = subparsers.add_parser("url_list", help="Loading url_list state files, JSON lines against binary")
+    url_list.add_argument("--paths", type=int, default=1000000, help="Paths in the state file")
+    url_list.add_argument("--captures", type=int, default=1, help="CDX captures per path")
+    url_list.add_argument("--lookups", type=int, default=10000, help="Random paths to look up")
+    url_list.set_defaults(func=bench_url_list)
+
+    serve = subparsers.add_parser("serve", help="Load test of the HTTP server over the LevelDB")
+    serve.add_argument("--pages", type=int, default=2000, help="Number of pages in the DB")
+    serve.add_argument("--requests", type=int, default=20000, help="Total requests")
+    serve.add_argument("--clients", type=int, default=8, help="Concurrent keep-alive clients")
+    serve.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of page popularity")
+    serve.add_argument("--conditional", type=float, default=0.2,
+                       help="Fraction of requests revalidating a page the client has seen")
+    serve.add_argument("--ranges", type=float, default=0.1, help="Fraction of requests for a byte range")
+    serve.add_argument("--compression", choices=["zlib", "zstd"], default="zlib", help="Payload compression")
+    serve.add_argument("--cache-mb", type=int, nargs="+", default=[0, 64], help="Cache sizes to try")
+    serve.set_defaults(func=bench_serve)
+
+    suite = subparsers.add_parser("suite", help="Every stage and the whole pipeline over a synthetic corpus")
+    suite.add_argument("--config", choices=["dev", "prod"], default="dev", help="run_config.yaml section to use")
+    suite.add_argument("--config-file", default="../run_config.yaml", help="The configuration file")
+    suite.add_argument("--stages", nargs="+", choices=SUITE_STAGES, default=list(SUITE_STAGES),
+                       help="Stages to run")
+    suite.add_argument("--subdomains", type=int, default=2, help="Number of subdomains")
+    suite.add_argument("--paths", type=int, default=1000, help="Paths per subdomain")
+    suite.add_argument("--captures", type=float, default=3.0, help="Average captures per path")
+    suite.add_argument("--duplicate-ratio", type=float, default=0.2, help="Share of paths with shared content")
+    suite.add_argument("--unchanged-ratio", type=float, default=0.5,
+                       help="Chance a capture is the same as the one before")
+    suite.add_argument("--size-scale", type=float, default=0.25, help="Factor applied to the payload sizes")
+    suite.add_argument("--seed", type=int, default=0, help="Seed of the corpus and the server's random errors")
+    suite.add_argument("--rate", type=float, default=1000.0,
+                       help="Requests per second, instead of the config's (which are for the real thing)")
+    suite.add_argument("--latency", type=float, default=0.0, help="Fake server latency in seconds")
+    suite.add_argument("--jitter", type=float, default=0.0, help="Mean seconds of random extra latency")
+    suite.add_argument("--error-rate", type=float, default=0.0, help="Share of captures answered with a 429")
+    suite.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s (0 for none)")
+    suite.add_argument("--backoff", type=float, default=1.0, help="Seconds before retrying throttled captures")
+    suite.add_argument("--repeat", type=int, default=3, help="Runs of each single stage; the best is reported")
+    suite.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser("compare", help="Ratios between two suite results")
+    compare.add_argument("baseline", help="JSON results of the baseline")
+    compare.add_argument("candidate", help="JSON results to compare with it")
+    compare.set_defaults(func=compare_results)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = args.func(args)
+    if getattr(args, "output", None):
+        with open(args.output, "w", encoding="utf-8") as output_fd:
+            json.dump(results, output_fd, indent=2)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
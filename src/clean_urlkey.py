@@ -1,154 +1,674 @@
-"""
-Utility functions for processing archived URLs from the Wayback Machine.
-"""
-
-import os
-import csv
-import json
-import logging
-
-import requests
-from urllib.parse import urlparse
-
-def read_urls_from_csv(file_path):
-    """
-    Reads URLs from a CSV file and returns them as a list.
-    Assumes URLs are in the first column.
-    
-    :param file_path: a single file path pointing to CSV file
-    :return: List of URL strings
-    """
-    urls = []
-    try:
-        with open(file_path, mode="r", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if row:  # Ensure row is not empty
-                    urls.append(row[0].strip())  
-        logging.debug(f"Successfully loaded {len(urls)} URLs from {file_path}")
-    except FileNotFoundError:
-        logging.critical(f"CSV file not found: {file_path}")
-    except Exception as e:
-        logging.critical(f"Error reading CSV file {file_path}: {e}")
-    return urls
-
-def clean_urls(url_headers, url_list):
-    """
-    Remove archival prefix (e.g., timestamps or metadata) before the close parenthesis ')'.
-    
-    :param url_list: A list of lists of URLs and timestamps
-    :return: A list of cleaned URL paths.
-    """
-    headers = {}
-    for ix, header in enumerate(url_headers):
-        headers[header] = ix
-
-    url_headers.append("path")
-    headers['path'] = len(url_headers) - 1
-
-    url_headers.append('originals')
-    headers['originals'] = len(url_headers) - 1
-
-    url_timestamps = {}
-    url_collection = {}
-    for url_data in url_list:
-        raw_path = url_data[headers["urlkey"]]
-        timestamp = url_data[headers["timestamp"]]
-        try:
-            if isinstance(raw_path, bytes):
-                raw_path = raw_path.decode("utf-8")
-
-            raw_path = raw_path.strip()
-
-            if ')' in raw_path:
-                _, path = raw_path.split(')', 1)
-            else:
-                print(f"raw_path = {raw_path}")
-                path = raw_path
-
-            url_data.append(path)
-            original = url_data[headers['original']]
-            if not (path in url_timestamps):
-                # First time seeing this urlkey-path
-                url_data.append([ original ])
-                url_timestamps[path] = timestamp
-                url_collection[path] = url_data
-            elif timestamp > url_timestamps[path]:
-                originals = url_collection[path][headers['originals']]
-                if not (original in originals):
-                    originals.append(original)
-                url_data.append(originals)
-                url_timestamps[path] = timestamp
-                url_collection[path] = url_data
-        except (ValueError, UnicodeDecodeError) as e:
-            logging.warning(f"Skipping malformed URL entry: {raw_path} — {e}")
-        except Exception as e:
-            logging.critical(f"Unexpected error cleaning URL {raw_path}: {e}")
-    
-    cleaned_paths = []
-    for path, url_data in url_collection.items():
-        cleaned_paths.append(dict(zip(url_headers, url_collection[path])))
-    return cleaned_paths
-
-def detect_urlkeys_from_subdomains(state_folder, subdomains):
-    """
-    Fetches URL keys from the Internet Archive's CDX API for a list of subdomains.
-
-    :param state_folder: Folder in which to track/cache the list of URLs found on a previous run
-    :param subdomains: List of subdomains (e.g., ["example.com", "blog.example.com"])
-    :return: Dictionary {subdomain: set of urlkeys}
-    """
-    urlkeys = {}
-    for sdomain in subdomains:
-        parsed_url = urlparse(sdomain)
-        netloc = parsed_url.netloc or parsed_url.path  # handle just subdomain strings
-
-        # Check if we've already fetched this subdomain's list of URLs
-        state_file = f"{state_folder}/url_list.{netloc}.list"
-        if os.path.exists(state_file):
-            with open(state_file, 'r', encoding='utf-8') as state_fd:
-                cleaned_data = []
-                for line in state_fd:
-                    line = line.rstrip()
-                    cleaned_data.append(json.loads(line))
-                urlkeys[netloc] = cleaned_data
-                state_fd.close()
-            logging.info(f"Retrieved {len(urlkeys[netloc])} URLs for {netloc} from state file.")
-            continue
-
-        url = f"{netloc}/"
-
-        cdx_call = (
-            f"https://web.archive.org/cdx/search/cdx?"
-            f"url={url}"
-            f"&matchType=prefix"
-            f"&from=20200101"
-            f"&to=20250119"
-            f"&filter=statuscode:200"
-            f"&output=json"
-        )
-
-        try:
-            response = requests.get(cdx_call)
-            if response.status_code == 200:
-                raw_data = json.loads(response.text)
-                if len(raw_data) == 0:
-                    logging.error(f"No data found at all for {netloc}!")
-                    cleaned_data = []
-                else:
-                    raw_headers = raw_data[0]
-                    raw_data = raw_data[1:]
-                    cleaned_data = clean_urls(raw_headers, raw_data)
-                urlkeys[netloc] = cleaned_data
-
-                # Preserve the list in the appropriate state_file
-                with open(state_file, 'w', encoding='utf-8') as state_fd:
-                    for url in cleaned_data:
-                        state_fd.write(json.dumps(url) + "\n")
-                    state_fd.close()
-            else:
-                logging.error(f"Error retrieving urlkeys for subdomain: {netloc} — Status code: {response.status_code}")
-        except Exception as e:
-            logging.exception(f"Exception retrieving urlkeys for subdomain: {netloc} — {str(e)}")
-        logging.info(f"Retrieved {len(urlkeys[netloc])} URLs for {netloc}")
-    return urlkeys
+"""
+Utility functions for processing archived URLs from the Wayback Machine.
+"""
+
+import os
+import csv
+import json
+import logging
+
+from time import sleep
+from urllib.parse import urlparse
+
+import metrics
+from constants import TARGET_DATE
+from http_client import HTTPClient
+from rate_limit import TransientFetchError
+from url_list_store import URLListFile, iter_binary, iter_jsonl, url_list_files, write_url_list
+
+# How many times a throttled CDX query is retried, and the initial backoff
+CDX_MAX_ATTEMPTS = 6
+CDX_BACKOFF_SECONDS = 30
+
+DEFAULT_CDX_URL = "https://web.archive.org/cdx/search/cdx"
+# Rows per CDX request; each page is a separate request with its own resumeKey
+DEFAULT_CDX_PAGE_SIZE = 50000
+# The window of captures we consider, as CDX from/to timestamps
+DEFAULT_CDX_FROM = "20200101"
+DEFAULT_CDX_TO = TARGET_DATE.strftime("%Y%m%d")
+
+def read_urls_from_csv(file_path):
+    """
+    Reads URLs from a CSV file and returns them as a list.
+    Assumes URLs are in the first column.
+    
+    :param file_path: a single file path pointing to CSV file
+    :return: List of URL strings
+    """
+    urls = []
+    try:
+        with open(file_path, mode="r", encoding="utf-8") as file:
+            reader = csv.reader(file)
+            for row in reader:
+                if row:  # Ensure row is not empty
+                    urls.append(row[0].strip())  
+        logging.debug(f"Successfully loaded {len(urls)} URLs from {file_path}")
+    except FileNotFoundError:
+        logging.critical(f"CSV file not found: {file_path}")
+    except Exception as e:
+        logging.critical(f"Error reading CSV file {file_path}: {e}")
+    return urls
+
+class _SurtPrefix(str):
+    """
+    Stands in for a urlkey that is just "{prefix}){path}", so the prefix can be
+    shared by every row of a subdomain instead of being stored once per row.
+    """
+    __slots__ = ()
+
+class _PathRecord:
+    """
+    The newest capture seen so far for one path: its compacted CDX row (as a
+    tuple) and the originals collected along the way.
+    """
+    __slots__ = ("row", "originals")
+
+    def __init__(self, row, originals):
+        self.row = row
+        self.originals = originals
+
+class CDXDeduplicator:
+    # Columns with only a handful of distinct values, worth interning
+    INTERNED_COLUMNS = ("mimetype", "statuscode")
+    # Columns that are always decimal strings, stored as ints while in memory
+    NUMERIC_COLUMNS = ("timestamp", "length")
+
+    def __init__(self, url_headers):
+        """
+        Incrementally reduce CDX rows to the newest capture of each path.
+        Rows can be fed in any number of batches; only one compact record per
+        path is kept in memory, and it is expanded back to exactly the original
+        values when the results are read.
+
+        Like clean_urls(), this appends "path" and "originals" to url_headers.
+
+        :param url_headers: The CDX header row
+        """
+        self.headers = {}
+        for ix, header in enumerate(url_headers):
+            self.headers[header] = ix
+        self.urlkey_ix = self.headers["urlkey"]
+        self.timestamp_ix = self.headers["timestamp"]
+        self.original_ix = self.headers["original"]
+        self.interned_ix = [self.headers[column] for column in self.INTERNED_COLUMNS if column in self.headers]
+        self.numeric_ix = [self.headers[column] for column in self.NUMERIC_COLUMNS if column in self.headers]
+
+        url_headers.append("path")
+        url_headers.append("originals")
+        self.url_headers = url_headers
+
+        self.interned = {}
+        self.prefixes = {}
+        self.records = {}
+
+        # The newest timestamp seen in any row
+        self.high_water = None
+        # Paths created or replaced since track_changes() was called
+        self.changed = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def _surt_prefix(self, prefix):
+        shared = self.prefixes.get(prefix)
+        if shared is None:
+            shared = self.prefixes[prefix] = _SurtPrefix(prefix)
+        return shared
+
+    def _compact(self, url_data, prefix):
+        url_data = list(url_data)
+        size = len(url_data)
+        if prefix is not None:
+            url_data[self.urlkey_ix] = prefix
+        interned = self.interned
+        for ix in self.interned_ix:
+            if ix < size:
+                value = url_data[ix]
+                url_data[ix] = interned.setdefault(value, value)
+        for ix in self.numeric_ix:
+            if ix < size:
+                value = url_data[ix]
+                # Only values that survive a round trip through int()
+                if (type(value) is str and value.isascii() and value.isdigit()
+                        and (value[0] != '0' or value == '0')):
+                    url_data[ix] = int(value)
+        return tuple(url_data)
+
+    def _expand(self, row, path):
+        url_data = list(row)
+        for ix in self.numeric_ix:
+            if ix < len(url_data) and type(url_data[ix]) is int:
+                url_data[ix] = str(url_data[ix])
+        urlkey = url_data[self.urlkey_ix]
+        if type(urlkey) is _SurtPrefix:
+            url_data[self.urlkey_ix] = str.__add__(urlkey, ')' + path)
+        return url_data
+
+    def track_changes(self):
+        """
+        Start recording which paths are created or replaced from now on, in
+        self.changed.
+        """
+        self.changed = set()
+
+    def add_cleaned(self, cleaned_data):
+        """
+        Seed the records with url_data hashmaps from an earlier run (as returned
+        by clean_urls()), so that further rows are merged into them.
+
+        :param cleaned_data: An iterable of url_data hashmaps
+        """
+        base_headers = self.url_headers[:-2]
+        for cleaned in cleaned_data:
+            path = cleaned['path']
+            url_data = [cleaned.get(header) for header in base_headers]
+            timestamp = url_data[self.timestamp_ix]
+            if self.high_water is None or timestamp > self.high_water:
+                self.high_water = timestamp
+            urlkey = url_data[self.urlkey_ix]
+            prefix = None
+            if type(urlkey) is str and urlkey.endswith(')' + path) and urlkey == urlkey.strip():
+                prefix = self._surt_prefix(urlkey[:-len(path) - 1])
+            self.records[path] = _PathRecord(self._compact(url_data, prefix), list(cleaned['originals']))
+
+    def add_rows(self, url_list):
+        """
+        Fold a batch of CDX rows into the per-path records. A row replaces the
+        current record for its path only if its timestamp is strictly newer, and
+        its original is then added to the path's originals.
+
+        :param url_list: An iterable of CDX rows (lists of values in header order)
+        """
+        records = self.records
+        changed = self.changed
+        urlkey_ix = self.urlkey_ix
+        timestamp_ix = self.timestamp_ix
+        original_ix = self.original_ix
+        for url_data in url_list:
+            raw_path = url_data[urlkey_ix]
+            timestamp = url_data[timestamp_ix]
+            if self.high_water is None or timestamp > self.high_water:
+                self.high_water = timestamp
+            try:
+                urlkey = raw_path
+                if isinstance(raw_path, bytes):
+                    raw_path = raw_path.decode("utf-8")
+
+                raw_path = raw_path.strip()
+
+                prefix = None
+                if ')' in raw_path:
+                    prefix, path = raw_path.split(')', 1)
+                    if type(urlkey) is str and len(urlkey) == len(raw_path):
+                        prefix = self._surt_prefix(prefix)
+                    else:
+                        prefix = None
+                else:
+                    logging.debug("urlkey without a SURT prefix: %s", raw_path)
+                    path = raw_path
+
+                original = url_data[original_ix]
+                record = records.get(path)
+                if record is None:
+                    # First time seeing this urlkey-path
+                    records[path] = _PathRecord(self._compact(url_data, prefix), [ original ])
+                    if changed is not None:
+                        changed.add(path)
+                else:
+                    newest = record.row[timestamp_ix]
+                    if type(newest) is int:
+                        newest = str(newest)
+                    if timestamp > newest:
+                        if not (original in record.originals):
+                            record.originals.append(original)
+                        record.row = self._compact(url_data, prefix)
+                        if changed is not None:
+                            changed.add(path)
+            except (ValueError, UnicodeDecodeError) as e:
+                logging.warning("Skipping malformed URL entry: %s — %s", raw_path, e)
+            except Exception as e:
+                logging.critical("Unexpected error cleaning URL %s: %s", raw_path, e)
+
+    def iter_results(self, drain=False):
+        """
+        :param drain: Release each record once it has been yielded, so that the
+                      results can be built without holding two copies; the
+                      deduplicator can't be used afterwards
+        :return: A generator of url_data hashmaps, one per path, in the order
+                 the paths were first seen
+        """
+        url_headers = self.url_headers
+        records = self.records
+        for path, record in records.items():
+            url_data = self._expand(record.row, path)
+            url_data.append(path)
+            url_data.append(record.originals)
+            if drain:
+                records[path] = None
+            yield dict(zip(url_headers, url_data))
+        if drain:
+            self.records = {}
+
+    def results(self):
+        """
+        Build the list of url_data hashmaps, one per path, draining the deduplicator.
+
+        :return: A list of url_data hashmaps
+        """
+        return list(self.iter_results(drain=True))
+
+def clean_urls(url_headers, url_list):
+    """
+    Remove archival prefix (e.g., timestamps or metadata) before the close parenthesis ')'.
+    
+    :param url_headers: The CDX header row; "path" and "originals" are appended to it
+    :param url_list: An iterable of CDX rows (lists of URLs and timestamps)
+    :return: A list of cleaned URL paths.
+    """
+    deduplicator = CDXDeduplicator(url_headers)
+    deduplicator.add_rows(url_list)
+    return deduplicator.results()
+
+def cdx_get(cdx_call, client, **kwargs):
+    """
+    Run a CDX query, backing off and retrying while the server throttles us.
+
+    :param cdx_call: The CDX API URL
+    :param client: The shared HTTPClient
+    :param kwargs: Passed through to HTTPClient.get()
+    :return: The requests.Response
+    :raises TransientFetchError: if we were still throttled after CDX_MAX_ATTEMPTS tries
+    """
+    backoff = CDX_BACKOFF_SECONDS
+    for attempt in range(CDX_MAX_ATTEMPTS):
+        try:
+            return client.get(cdx_call, **kwargs)
+        except TransientFetchError as e:
+            if attempt == CDX_MAX_ATTEMPTS - 1:
+                raise
+            delay = max(backoff, e.retry_after or 0)
+            logging.info(f"CDX query throttled ({e}); retrying in {delay:.0f}s")
+            sleep(delay)
+            backoff *= 2
+
+def iter_json_array(chunks):
+    """
+    Incrementally parse a JSON array of arrays (the CDX API's output=json),
+    yielding each inner array as soon as it has been received, so the body
+    never has to be held in memory as a whole.
+
+    :param chunks: An iterable of str fragments of the response body
+    :return: A generator of rows
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a JSON array, got {buffer[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The row isn't complete yet; wait for the next chunk
+                break
+            yield row
+        buffer = buffer[pos:]
+
+def _load_cdx_resume(resume_file):
+    if not os.path.exists(resume_file):
+        return None
+    with open(resume_file, 'r', encoding='utf-8') as resume_fd:
+        return json.load(resume_fd)
+
+def _save_cdx_resume(resume_file, resume):
+    tmp_file = resume_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as resume_fd:
+        json.dump(resume, resume_fd)
+        resume_fd.flush()
+        os.fsync(resume_fd.fileno())
+    os.replace(tmp_file, resume_file)
+
+def iter_cdx_rows(client, state_folder, netloc, cdx_url=DEFAULT_CDX_URL, page_size=DEFAULT_CDX_PAGE_SIZE,
+                  ts_from=DEFAULT_CDX_FROM, ts_to=DEFAULT_CDX_TO):
+    """
+    Enumerate every capture under a subdomain, one CDX page at a time, using the
+    API's resumeKey. Rows are also appended to url_list.{netloc}.partial, and the
+    resume point is saved to cdx_resume.{netloc}.json after each page, so an
+    interrupted enumeration replays the partial file and carries on from the
+    last complete page.
+
+    The first item yielded is the header row; every following item is a capture row.
+
+    :param client: The shared HTTPClient
+    :param state_folder: Folder holding the partial and resume files
+    :param netloc: The subdomain to enumerate
+    :param cdx_url: The CDX API endpoint
+    :param page_size: Number of rows to ask for per request
+    :param ts_from: Only captures at or after this timestamp (or timestamp prefix)
+    :param ts_to: Only captures at or before this timestamp (or timestamp prefix)
+    :return: A generator of rows
+    :raises RuntimeError: if the CDX API answers with an unexpected status
+    """
+    partial_file = f"{state_folder}/url_list.{netloc}.partial"
+    resume_file = f"{state_folder}/cdx_resume.{netloc}.json"
+
+    resume = _load_cdx_resume(resume_file)
+    if resume and (resume['headers'] is None or resume.get('from') != ts_from or resume.get('to') != ts_to):
+        # Nothing worth replaying, or it belongs to a different query
+        resume = None
+    if resume and os.path.exists(partial_file):
+        logging.info(f"Resuming CDX enumeration for {netloc} after {resume['rows']} rows")
+        with open(partial_file, 'r+', encoding='utf-8') as partial_fd:
+            # Drop anything written after the last complete page
+            partial_fd.truncate(resume['offset'])
+        yield resume['headers']
+        with open(partial_file, 'r', encoding='utf-8') as partial_fd:
+            for line in partial_fd:
+                yield json.loads(line)
+    else:
+        resume = {"headers": None, "resume_key": None, "offset": 0, "rows": 0, "from": ts_from, "to": ts_to}
+        open(partial_file, 'w', encoding='utf-8').close()
+
+    if resume['headers'] is not None and resume['resume_key'] is None:
+        # The enumeration had already finished
+        return
+
+    with open(partial_file, 'a', encoding='utf-8') as partial_fd:
+        while True:
+            params = {
+                "url": f"{netloc}/",
+                "matchType": "prefix",
+                "from": ts_from,
+                "to": ts_to,
+                "filter": "statuscode:200",
+                "output": "json",
+                "limit": page_size,
+                "showResumeKey": "true",
+            }
+            if resume['resume_key']:
+                params["resumeKey"] = resume['resume_key']
+
+            response = cdx_get(cdx_url, client, params=params, stream=True)
+            with response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"CDX query for {netloc} failed with status code {response.status_code}")
+
+                response.encoding = "utf-8"
+                next_key = None
+                page_headers = None
+                end_of_rows = False
+                page_rows = 0
+                for row in iter_json_array(response.iter_content(chunk_size=65536, decode_unicode=True)):
+                    if page_headers is None:
+                        # Every page starts with the header row
+                        page_headers = row
+                        if resume['headers'] is None:
+                            resume['headers'] = row
+                            yield row
+                        continue
+                    if end_of_rows:
+                        next_key = row[0] if row else None
+                        break
+                    if not row:
+                        # An empty row separates the captures from the resume key
+                        end_of_rows = True
+                        continue
+                    partial_fd.write(json.dumps(row) + "\n")
+                    resume['rows'] += 1
+                    page_rows += 1
+                    yield row
+
+            partial_fd.flush()
+            os.fsync(partial_fd.fileno())
+            resume['offset'] = partial_fd.tell()
+            resume['resume_key'] = next_key
+            _save_cdx_resume(resume_file, resume)
+            metrics.inc("restore_cdx_rows_total", page_rows, subdomain=netloc)
+            metrics.inc("restore_cdx_pages_total", subdomain=netloc)
+            logging.debug("CDX page done for %s: %d rows so far", netloc, resume['rows'])
+            if not next_key:
+                break
+
+def _load_high_water(state_folder, netloc):
+    refresh_file = f"{state_folder}/cdx_refresh.{netloc}.json"
+    if not os.path.exists(refresh_file):
+        return None
+    with open(refresh_file, 'r', encoding='utf-8') as refresh_fd:
+        return json.load(refresh_fd).get('high_water')
+
+def _save_high_water(state_folder, netloc, high_water):
+    refresh_file = f"{state_folder}/cdx_refresh.{netloc}.json"
+    _save_cdx_resume(refresh_file, {"high_water": high_water})
+
+def _mark_changed_paths(state_folder, netloc, changed):
+    """
+    Add paths to changed.{netloc}.json, which process_cdc_urls() reads to know
+    which already-fetched paths have a newer capture to download and ingest.
+    """
+    changed_file = f"{state_folder}/changed.{netloc}.json"
+    if os.path.exists(changed_file):
+        with open(changed_file, 'r', encoding='utf-8') as changed_fd:
+            changed = set(changed) | set(json.load(changed_fd))
+    _save_cdx_resume(changed_file, sorted(changed))
+
+def find_state_file(state_folder, netloc):
+    """
+    :param state_folder: The pipeline's state folder
+    :param netloc: The subdomain
+    :return: The subdomain's url_list state file (the binary one if there is one), or None
+    """
+    for state_file in reversed(url_list_files(state_folder, netloc)):
+        if os.path.exists(state_file):
+            return state_file
+    return None
+
+def iter_state_file(state_file):
+    """
+    :param state_file: A url_list.{netloc}.list or .bin state file
+    :return: A generator of its url_data hashmaps, decoded one at a time
+    """
+    if state_file.endswith(".bin"):
+        return iter_binary(state_file)
+    return iter_jsonl(state_file)
+
+def count_state_file(state_file):
+    """
+    :param state_file: A url_list.{netloc}.list or .bin state file
+    :return: The number of URLs in it, without decoding them
+    """
+    if os.path.getsize(state_file) == 0:
+        return 0
+    if state_file.endswith(".bin"):
+        with URLListFile(state_file) as url_list:
+            return len(url_list)
+    count = 0
+    with open(state_file, 'rb') as state_fd:
+        while True:
+            block = state_fd.read(1 << 20)
+            if not block:
+                return count
+            count += block.count(b"\n")
+
+def save_state_file(state_folder, netloc, url_list, url_list_format="jsonl"):
+    """
+    Write a subdomain's url_list state file, replacing it (in either format)
+    only once the new one is complete.
+
+    :param state_folder: The pipeline's state folder
+    :param netloc: The subdomain
+    :param url_list: An iterable of url_data hashmaps
+    :param url_list_format: "jsonl", or "binary" for the url_list_store format
+    :return: (the state file, number of URLs written)
+    """
+    jsonl_file, bin_file = url_list_files(state_folder, netloc)
+    if url_list_format == "binary":
+        state_file, stale_file = bin_file, jsonl_file
+        count = write_url_list(bin_file, url_list)
+    else:
+        state_file, stale_file = jsonl_file, bin_file
+        count = 0
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as state_fd:
+            for url in url_list:
+                state_fd.write(json.dumps(url) + "\n")
+                count += 1
+        os.replace(tmp_file, state_file)
+    if os.path.exists(stale_file):
+        os.remove(stale_file)
+    return state_file, count
+
+def enumerate_subdomain(state_folder, netloc, client, cdx_url=DEFAULT_CDX_URL, page_size=DEFAULT_CDX_PAGE_SIZE,
+                        refresh=False, ts_from=DEFAULT_CDX_FROM, ts_to=DEFAULT_CDX_TO, url_list_format="jsonl"):
+    """
+    Make sure a subdomain's url_list state file holds its deduplicated URL
+    list, querying the CDX API if there isn't one yet (or, with `refresh`,
+    for captures newer than the ones it has). A JSON lines list is written
+    out as it is drained from the deduplicator; a binary one has to be
+    sorted by path first.
+
+    :param state_folder: Folder in which to track/cache the list of URLs found on a previous run
+    :param netloc: The subdomain
+    :param client: The HTTPClient to query the CDX API through
+    :param cdx_url: The CDX API endpoint
+    :param page_size: Number of CDX rows to ask for per request
+    :param refresh: Query for captures newer than the last enumeration of the subdomain
+    :param ts_from: Oldest capture timestamp to consider
+    :param ts_to: Newest capture timestamp to consider
+    :param url_list_format: Format of new state files: "jsonl", or "binary" (see url_list_store)
+    :return: The state file, or None if no URLs were found
+    """
+    # Check if we've already fetched this subdomain's list of URLs
+    state_file = find_state_file(state_folder, netloc)
+    existing = state_file is not None
+    if existing:
+        logging.info(f"Using the URL list of {netloc} from its state file.")
+        if not refresh:
+            return state_file
+
+    query_from = ts_from
+    if existing:
+        high_water = _load_high_water(state_folder, netloc)
+        if high_water is None:
+            high_water = max((url_data['timestamp'] for url_data in iter_state_file(state_file)), default=ts_from)
+        # The CDX from= is inclusive; rows we already have are no-ops in the merge
+        query_from = max(ts_from, high_water)
+        logging.info(f"Refreshing {netloc} with captures since {query_from}")
+
+    try:
+        rows = iter_cdx_rows(client, state_folder, netloc, cdx_url, page_size, query_from, ts_to)
+        raw_headers = next(rows, None)
+        high_water = None
+        if raw_headers is None:
+            if not existing:
+                logging.error(f"No data found at all for {netloc}!")
+                # An empty list, so the subdomain isn't queried again on every run
+                state_file, _ = save_state_file(state_folder, netloc, [], url_list_format)
+            else:
+                logging.info(f"No new captures for {netloc}")
+                high_water = query_from
+            deduplicator = None
+        else:
+            deduplicator = CDXDeduplicator(raw_headers)
+            if existing:
+                deduplicator.add_cleaned(iter_state_file(state_file))
+                deduplicator.track_changes()
+            deduplicator.add_rows(rows)
+            high_water = deduplicator.high_water
+            changed = deduplicator.changed
+            if changed:
+                logging.info(f"{len(changed)} paths of {netloc} are new or have newer captures")
+                _mark_changed_paths(state_folder, netloc, changed)
+
+        if deduplicator is not None:
+            # Preserve the list in the appropriate state_file
+            state_file, count = save_state_file(state_folder, netloc, deduplicator.iter_results(drain=True),
+                                                url_list_format)
+            logging.info(f"Retrieved {count} URLs for {netloc}")
+        if high_water is not None:
+            _save_high_water(state_folder, netloc, high_water)
+
+        # The enumeration is complete; the resume point is no longer needed
+        for leftover in (f"{state_folder}/url_list.{netloc}.partial",
+                         f"{state_folder}/cdx_resume.{netloc}.json"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    except Exception as e:
+        logging.exception(f"Exception retrieving urlkeys for subdomain: {netloc} — {str(e)}")
+        if not existing:
+            return None
+    return state_file
+
+def iter_subdomain_urlkeys(state_folder, subdomains, client=None, **kwargs):
+    """
+    Enumerate the subdomains one at a time, yielding each as soon as its
+    URL list is ready. The URL lists are read lazily from the state files,
+    so only the subdomain being enumerated is ever held in memory.
+
+    :param state_folder: Folder in which to track/cache the list of URLs found on a previous run
+    :param subdomains: List of subdomains (e.g., ["example.com", "blog.example.com"])
+    :param client: The HTTPClient shared with the capture downloads; a private one is used if omitted
+    :param kwargs: Passed on to enumerate_subdomain()
+    :return: A generator of (subdomain, generator of url_data hashmaps)
+    """
+    if client is None:
+        client = HTTPClient()
+    for sdomain in subdomains:
+        parsed_url = urlparse(sdomain)
+        netloc = parsed_url.netloc or parsed_url.path  # handle just subdomain strings
+        state_file = enumerate_subdomain(state_folder, netloc, client, **kwargs)
+        if not state_file:
+            yield netloc, iter(())
+            continue
+        # For the progress report's ETA
+        metrics.set_gauge("restore_subdomain_paths", count_state_file(state_file), subdomain=netloc)
+        yield netloc, iter_state_file(state_file)
+
+def detect_urlkeys_from_subdomains(state_folder, subdomains, client=None,
+                                   cdx_url=DEFAULT_CDX_URL, page_size=DEFAULT_CDX_PAGE_SIZE,
+                                   refresh=False, ts_from=DEFAULT_CDX_FROM, ts_to=DEFAULT_CDX_TO,
+                                   url_list_format="jsonl"):
+    """
+    Fetches URL keys from the Internet Archive's CDX API for a list of subdomains.
+    The CDX rows are streamed page by page into a CDXDeduplicator, so only the
+    surviving row for each path is ever held in memory.
+
+    With `refresh`, subdomains that already have a state file are not reused as-is:
+    only captures newer than the subdomain's high-water timestamp are queried, and
+    merged into the existing list with the same newest-timestamp-wins rule. Paths
+    that gained a newer capture are recorded in changed.{netloc}.json so that
+    process_cdc_urls() downloads and ingests them again.
+
+    This holds every subdomain's list at once; the pipeline streams them
+    with iter_subdomain_urlkeys() instead.
+
+    :param state_folder: Folder in which to track/cache the list of URLs found on a previous run
+    :param subdomains: List of subdomains (e.g., ["example.com", "blog.example.com"])
+    :param client: The HTTPClient shared with the capture downloads; a private one is used if omitted
+    :param cdx_url: The CDX API endpoint
+    :param page_size: Number of CDX rows to ask for per request
+    :param refresh: Query for captures newer than the last enumeration of each subdomain
+    :param ts_from: Oldest capture timestamp to consider
+    :param ts_to: Newest capture timestamp to consider
+    :param url_list_format: Format of new state files: "jsonl", or "binary" (see url_list_store)
+    :return: Dictionary {subdomain: list of url_data hashmaps}
+    """
+    urlkeys = {}
+    for netloc, url_list in iter_subdomain_urlkeys(state_folder, subdomains, client, cdx_url=cdx_url,
+                                                   page_size=page_size, refresh=refresh,
+                                                   ts_from=ts_from, ts_to=ts_to,
+                                                   url_list_format=url_list_format):
+        urlkeys[netloc] = list(url_list)
+    return urlkeys
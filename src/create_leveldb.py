@@ -1,39 +1,739 @@
+import base64
 import gzip
+import hashlib
 import logging
 import os
 import re
+from io import BytesIO
+from time import monotonic
 
 import plyvel
 from warcio.archiveiterator import ArchiveIterator
 
+from value_codec import (
+    DEFAULT_DICTIONARY_SIZE, ValueCodec, chunk_manifest, is_compressible, parse_manifest, zstandard
+)
+
+# Key prefixes of the different keyspaces
+CONTENT_PREFIX = b"c-"
+MIMETYPE_PREFIX = b"m-"
+TIMESTAMP_PREFIX = b"t-"
+INGESTED_PREFIX = b"i-"
+# Content-addressed mode: each distinct payload once, and a pointer per URL
+DIGEST_PREFIX = b"d-"
+POINTER_PREFIX = b"p-"
+# Compression dictionaries, by the id stored in compressed values' headers
+DICTIONARY_PREFIX = b"z-"
+# Chunks of large payloads: k-{object id}{chunk number}
+CHUNK_PREFIX = b"k-"
+# CDX digests of the captures ingested, each with a URL that holds the payload
+CDX_DIGEST_PREFIX = b"x-"
+
+# Default limits for the write batch; whichever is reached first flushes it
+DEFAULT_BATCH_RECORDS = 1000
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+DEFAULT_BATCH_SECONDS = 5.0
+
+# Payloads larger than the threshold are streamed into chunks
+DEFAULT_CHUNK_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+def payload_digest(payload):
+    """
+    Digest of a payload as stored, in the same "sha1:BASE32" form as WARC-Payload-Digest.
+    The record's own WARC-Payload-Digest isn't used, since it is computed over
+    the payload before any transfer/content encoding is removed.
+
+    :param payload: The payload bytes
+    :return: The digest, as bytes
+    """
+    return b"sha1:" + base64.b32encode(hashlib.sha1(payload).digest())
+
+def read_up_to(stream, size):
+    """
+    Read `size` bytes, or fewer only if the stream ends first
+
+    :param stream: A file-like object
+    :param size: Number of bytes wanted
+    :return: The bytes read
+    """
+    data = stream.read(size)
+    if len(data) >= size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+def open_warc(filename):
+    """
+    :param filename: A .warc or .warc.gz file
+    :return: A binary stream of the WARC, or None if it isn't a WARC file
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith(".warc"):
+        return open(filename, 'rb')
+    return None
+
+def open_capture(fetched):
+    """
+    Open the WARC a capture was saved in. A capture in a rolling WARC file
+    has the offset of its record, and the stream is positioned right at it.
+
+    :param fetched: The fetch result: {"file": ..., "issues": ...}, plus "offset" and "length" if the file is a rolling one
+    :return: (binary stream, number of records to read, or None for the whole file);
+             the stream is None if the file isn't a WARC file
+    """
+    offset = fetched.get('offset')
+    if offset is None:
+        return open_warc(fetched['file']), None
+    # Each record is its own gzip member, which ArchiveIterator can start reading at
+    stream = open(fetched['file'], 'rb')
+    stream.seek(offset)
+    return stream, 1
+
+def iter_warc_payloads(stream, max_payload, max_records=None):
+    """
+    Yield the response records of a WARC that have a target URI and HTTP headers.
+    Only the first `max_payload` + 1 bytes of each payload are read; when the
+    payload is longer, the rest is still to be read from its content stream,
+    which is only valid until the next record is asked for.
+
+    :param stream: A binary stream of the WARC, from open_warc() or open_capture()
+    :param max_payload: How much of each payload to read up front
+    :param max_records: Stop after this many records (None reads to the end of the file)
+    :return: A generator of (uri, content_type, payload, content_stream)
+    """
+    for count, record in enumerate(ArchiveIterator(stream, no_record_parse=False, ensure_http_headers=True)):
+        if max_records is not None and count >= max_records:
+            break
+        if record.rec_type != 'response':
+            if record.rec_type != "warcinfo":
+                logging.debug("Record type '%s' skipped.", record.rec_type)
+            continue
+        uri = record.rec_headers.get_header('WARC-Target-URI')
+        content_stream = record.content_stream()
+        payload = read_up_to(content_stream, max_payload + 1)
+        logging.debug("uri = %s", uri)
+        if uri and payload is not None:
+            if not record.http_headers:
+                logging.info("No http_headers for this warc record")
+                continue
+            yield uri, record.http_headers.get_header('Content-Type'), payload, content_stream
+        else:
+            logging.debug("Payload: %s", payload)
+
 class WARCLevelDB:
-    def __init__(self, dbfolder):
+    def __init__(self, dbfolder, batch_records=DEFAULT_BATCH_RECORDS, batch_bytes=DEFAULT_BATCH_BYTES,
+                 batch_seconds=DEFAULT_BATCH_SECONDS, content_addressed=False, compression=None,
+                 compression_level=None, chunk_threshold=DEFAULT_CHUNK_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE):
         """
         Initialize the WARCLevelDB class.
 
+        Writes are collected in a write batch that is flushed once it holds
+        `batch_records` paths, `batch_bytes` bytes, or is `batch_seconds` old.
+        A path's content, mimetype and timestamp entries, and its ingested mark,
+        always land in the same batch, so they are committed together or not at all.
+        With batch_records=0 every value is put on its own, as it used to be.
+
+        With content_addressed set, payloads are stored once under their digest
+        (d-{digest}) and each URL gets a pointer to it (p-{url}) instead of its
+        own copy under c-{url}. get_content() reads either layout.
+
+        With compression set ("zstd" or "zlib"), text payloads are stored
+        compressed behind a small header (see value_codec); PDFs, images and
+        other already compressed types are stored as they are. get_content()
+        decompresses transparently, whatever the setting, so databases
+        written with and without compression read the same.
+
+        Payloads larger than `chunk_threshold` are streamed from the WARC
+        record into `chunk_size` chunks (k-{object id}{n}), and the URL (or
+        digest) gets a small manifest in place of the payload, so ingesting
+        a large capture never holds more than about `chunk_threshold` bytes.
+        read_range() and iter_content() serve byte ranges of either kind of
+        value, reading only the chunks they need.
+
         :param dbfolder: Target directory for the WARCLevelDB
+        :param batch_records: Paths per write batch (0 disables batching)
+        :param batch_bytes: Flush once the batch holds this many bytes
+        :param batch_seconds: Flush once the batch is this many seconds old
+        :param content_addressed: Store payloads by digest rather than per URL
+        :param compression: Codec for new payloads: "zstd", "zlib", or None
+        :param compression_level: The codec's compression level (its default if None)
+        :param chunk_threshold: Payloads larger than this many bytes are stored in chunks
+        :param chunk_size: Bytes per chunk
         """
         self.dbfolder = dbfolder
         self.db = plyvel.DB(os.path.join(dbfolder, 'cdc_database'), create_if_missing=True)
 
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.batch_seconds = batch_seconds
+        self.batch = None
+        self.batch_count = 0
+        self.batch_size = 0
+        self.batch_started = 0.0
+        self.flush_count = 0
+        self.flush_time = 0.0
+        # Bytes handed to LevelDB (keys and values), and time spent parsing and storing captures
+        self.bytes_written = 0
+        self.ingest_count = 0
+        self.ingest_time = 0.0
+        self.content_addressed = content_addressed
+        # Digests put in the pending batch, which a lookup in the DB can't see
+        # yet, with the chunked object each refers to (None if not chunked)
+        self.batch_digests = {}
+        # Likewise for CDX digests, with the URL each was stored under,
+        # and for the timestamps of URLs
+        self.batch_cdx_digests = {}
+        self.batch_timestamps = {}
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+
         # The actual content (could be binary or text)
-        self.content_db = self.db.prefixed_db(b"c-")
+        self.content_db = self.db.prefixed_db(CONTENT_PREFIX)
 
         # The mimetype of the content, if it is known
-        self.mimetype_db = self.db.prefixed_db(b"m-")
+        self.mimetype_db = self.db.prefixed_db(MIMETYPE_PREFIX)
 
         # The date/time of the version we fetched from the IA
-        self.timestamp_db = self.db.prefixed_db(b"t-")
+        self.timestamp_db = self.db.prefixed_db(TIMESTAMP_PREFIX)
+
+        # The ingest ledger: "{timestamp} {warc file}" of the capture ingested for each {subdomain}{path}
+        self.ingested_db = self.db.prefixed_db(INGESTED_PREFIX)
+
+        # Content-addressed payloads, and the digest each URL points to
+        self.digest_db = self.db.prefixed_db(DIGEST_PREFIX)
+        self.pointer_db = self.db.prefixed_db(POINTER_PREFIX)
+
+        self.dictionary_db = self.db.prefixed_db(DICTIONARY_PREFIX)
+        dictionaries = {}
+        for dict_id, data in self.dictionary_db.iterator():
+            dictionaries[int.from_bytes(dict_id, 'big')] = data
+        if compression == "zstd" and zstandard is None:
+            logging.warning("zstd compression was requested, but the zstandard package isn't installed: "
+                            "new payloads will be compressed with zlib instead")
+        self.codec = ValueCodec(compression, compression_level, dictionaries)
+
+        self.chunk_db = self.db.prefixed_db(CHUNK_PREFIX)
+
+        # CDX digest index, shared by every subdomain, so a capture whose
+        # payload is already stored never has to be downloaded again:
+        # "{timestamp} {url}" of the capture that was stored with the digest
+        self.cdx_digest_db = self.db.prefixed_db(CDX_DIGEST_PREFIX)
 
         self.total_path = 0
         self.total_url = 0
+        self.new_payloads = 0
+        self.duplicate_payloads = 0
+        self.payload_bytes = 0
+        self.stored_payload_bytes = 0
+        self.chunked_payloads = 0
+        self.copied_captures = 0
 
     def close(self):
         """
-        Close the handle for the DB
+        Flush any pending writes and close the handle for the DB
         """
+        self.flush()
         self.db.close()
 
+    def put(self, prefix, key, value):
+        """
+        Write one value, through the write batch unless batching is disabled.
+
+        :param prefix: The keyspace prefix (CONTENT_PREFIX, etc)
+        :param key: The key within the keyspace, as bytes
+        :param value: The value, as bytes
+        """
+        if not self.batch_records:
+            self.db.put(prefix + key, value)
+            self.bytes_written += len(key) + len(value)
+            return
+        if self.batch is None:
+            self.batch = self.db.write_batch()
+            self.batch_started = monotonic()
+        self.batch.put(prefix + key, value)
+        self.batch_size += len(key) + len(value)
+        if prefix == TIMESTAMP_PREFIX:
+            self.batch_timestamps[key] = value
+
+    def delete(self, prefix, key):
+        """
+        Delete one key, through the write batch unless batching is disabled.
+
+        :param prefix: The keyspace prefix (CONTENT_PREFIX, etc)
+        :param key: The key within the keyspace, as bytes
+        """
+        if not self.batch_records:
+            self.db.delete(prefix + key)
+            self.bytes_written += len(key)
+            return
+        if self.batch is None:
+            self.batch = self.db.write_batch()
+            self.batch_started = monotonic()
+        self.batch.delete(prefix + key)
+        self.batch_size += len(key)
+
+    def has_key(self, prefix, key):
+        """
+        Whether a key exists in the DB, without reading its value
+
+        :param prefix: The keyspace prefix (CONTENT_PREFIX, etc)
+        :param key: The key within the keyspace, as bytes
+        """
+        full_key = prefix + key
+        with self.db.iterator(start=full_key, include_value=False) as it:
+            for found in it:
+                return found == full_key
+        return False
+
+    def put_content(self, keys, payload, mimetype=None):
+        """
+        Store the payload of one capture for each of its URLs, in whichever
+        layout this DB uses. The payload is encoded (or, in content-addressed
+        mode, digested) once, however many URLs it is stored under. In
+        content-addressed mode it is only written if no other capture has
+        stored the same bytes yet, and any per-URL copies left over from
+        before are dropped.
+
+        :param keys: The URLs, as bytes
+        :param payload: The payload bytes
+        :param mimetype: The payload's Content-Type, which decides whether it is compressed
+        :return: The payload's digest in content-addressed mode, else None
+        """
+        if not self.content_addressed:
+            value = self._encode(payload, mimetype)
+            for key in keys:
+                self._put_url_value(key, value)
+            return None
+
+        digest = payload_digest(payload)
+        if self._is_new_digest(digest):
+            self.put(DIGEST_PREFIX, digest, self._encode(payload, mimetype))
+            self._added_digest(digest)
+        for key in keys:
+            self._put_pointer(key, digest)
+        return digest
+
+    def put_chunked_content(self, keys, manifest, digest, drop_duplicate=True):
+        """
+        Store the manifest of a payload already written by put_chunks() for
+        each of `keys`. In content-addressed mode the manifest goes under the
+        digest, unless that payload is stored already, in which case the
+        chunks just written are dropped again.
+
+        :param keys: The URLs, as bytes
+        :param manifest: The manifest returned by put_chunks()
+        :param digest: The digest returned by put_chunks()
+        :param drop_duplicate: Whether to delete the chunks when the payload is a duplicate
+        """
+        if not self.content_addressed:
+            for key in keys:
+                self._put_url_value(key, manifest)
+            return
+
+        object_id, chunk_size, length = parse_manifest(manifest)
+        if self._is_new_digest(digest):
+            self.put(DIGEST_PREFIX, digest, manifest)
+            self._added_digest(digest, object_id)
+        else:
+            # Unless it is this very object, stored by an earlier ingest of the same capture
+            if digest in self.batch_digests:
+                existing = self.batch_digests[digest]
+            else:
+                existing = parse_manifest(self.digest_db.get(digest))
+                existing = existing[0] if existing else None
+            if drop_duplicate and existing != object_id:
+                self.delete_chunks(object_id, length, chunk_size)
+        for key in keys:
+            self._put_pointer(key, digest)
+
+    def _is_new_digest(self, digest):
+        if digest in self.batch_digests or self.has_key(DIGEST_PREFIX, digest):
+            self.duplicate_payloads += 1
+            return False
+        self.new_payloads += 1
+        return True
+
+    def _added_digest(self, digest, object_id=None):
+        if self.batch is not None:
+            self.batch_digests[digest] = object_id
+
+    def _put_url_value(self, key, value):
+        self.put(CONTENT_PREFIX, key, value)
+        self.delete(POINTER_PREFIX, key)
+
+    def _put_pointer(self, key, digest):
+        self.put(POINTER_PREFIX, key, digest)
+        self.delete(CONTENT_PREFIX, key)
+
+    def put_chunks(self, object_id, head, stream, mimetype=None):
+        """
+        Write a payload as a run of chunks, reading the rest of it from the
+        stream as it goes. Chunks are committed in their own write batches of
+        at most `batch_bytes`, ahead of the manifest that makes them visible.
+
+        :param object_id: Id to store the chunks under, as bytes
+        :param head: The start of the payload, already read from the stream
+        :param stream: The rest of the payload
+        :param mimetype: The payload's Content-Type, which decides whether chunks are compressed
+        :return: (manifest, digest of the whole payload)
+        """
+        hasher = hashlib.sha1()
+        chunk_batch = self.db.write_batch()
+        batch_size = 0
+        index = 0
+        length = 0
+        buffer = head
+        while True:
+            while len(buffer) >= self.chunk_size:
+                chunk, buffer = buffer[:self.chunk_size], buffer[self.chunk_size:]
+                batch_size += self._put_chunk(chunk_batch, object_id, index, chunk, hasher, mimetype)
+                index += 1
+                length += len(chunk)
+                if batch_size >= self.batch_bytes:
+                    chunk_batch.write()
+                    chunk_batch = self.db.write_batch()
+                    batch_size = 0
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            buffer += data
+        if buffer:
+            self._put_chunk(chunk_batch, object_id, index, buffer, hasher, mimetype)
+            length += len(buffer)
+        chunk_batch.write()
+        self.chunked_payloads += 1
+        digest = b"sha1:" + base64.b32encode(hasher.digest())
+        return chunk_manifest(object_id, self.chunk_size, length), digest
+
+    def _put_chunk(self, chunk_batch, object_id, index, chunk, hasher, mimetype):
+        hasher.update(chunk)
+        value = self._encode(chunk, mimetype)
+        chunk_batch.put(CHUNK_PREFIX + object_id + index.to_bytes(4, 'big'), value)
+        self.bytes_written += len(value)
+        return len(value)
+
+    def copy_chunks(self, manifest, object_id):
+        """
+        Copy the chunks of a stored object under another id, as they are
+        (still encoded), in write batches of their own committed ahead of the
+        manifest, like put_chunks() does.
+
+        :param manifest: The manifest of the object to copy
+        :param object_id: Id to store the copy under, as bytes
+        :return: The manifest of the copy
+        """
+        source_id, chunk_size, length = parse_manifest(manifest)
+        chunk_batch = self.db.write_batch()
+        batch_size = 0
+        for index in range((length + chunk_size - 1) // chunk_size):
+            chunk = self.chunk_db.get(source_id + index.to_bytes(4, 'big'))
+            if chunk is None:
+                raise RuntimeError(f"Chunk {index} of object {source_id.hex()} is missing")
+            chunk_batch.put(CHUNK_PREFIX + object_id + index.to_bytes(4, 'big'), chunk)
+            self.bytes_written += len(chunk)
+            batch_size += len(chunk)
+            if batch_size >= self.batch_bytes:
+                chunk_batch.write()
+                chunk_batch = self.db.write_batch()
+                batch_size = 0
+        chunk_batch.write()
+        return chunk_manifest(object_id, chunk_size, length)
+
+    def delete_chunks(self, object_id, length, chunk_size):
+        """
+        Delete the chunks of an object
+
+        :param object_id: Id the chunks are stored under
+        :param length: Payload length, from the manifest
+        :param chunk_size: Chunk size, from the manifest
+        """
+        for index in range((length + chunk_size - 1) // chunk_size):
+            self.delete(CHUNK_PREFIX, object_id + index.to_bytes(4, 'big'))
+
+    @staticmethod
+    def _object_id(subdomain, url_data):
+        # The same capture always gets the same object id, so ingesting it again overwrites its chunks
+        capture = f"{subdomain}{url_data['path']}@{url_data['timestamp']}"
+        return hashlib.sha1(capture.encode('utf-8')).digest()[:16]
+
+    def _drop_replaced_chunks(self, subdomain, url_data, keys):
+        """
+        Delete, in the pending batch, the chunks of the per-URL manifest that
+        a newer capture of the path is about to replace. Only an object the
+        path owns (stored under the id of the capture the ingest ledger
+        holds) is deleted; content-addressed manifests live under their
+        digest, which other URLs may still point to, and are kept until
+        sweep_chunks() finds nothing does.
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain
+        :param keys: The URLs about to be overwritten, as bytes
+        """
+        entry = self.ingested_db.get(f"{subdomain}{url_data['path']}".encode('utf-8'))
+        if entry is None:
+            return
+        previous = entry.decode('utf-8').partition(" ")[0]
+        if previous == url_data['timestamp']:
+            return
+        owned = self._object_id(subdomain, dict(url_data, timestamp=previous))
+        for key in keys:
+            manifest = parse_manifest(self.content_db.get(key))
+            if manifest and manifest[0] == owned:
+                self.delete_chunks(owned, manifest[2], manifest[1])
+                return
+
+    def _encode(self, payload, mimetype):
+        value = self.codec.encode(payload, mimetype)
+        self.payload_bytes += len(payload)
+        self.stored_payload_bytes += len(value)
+        return value
+
+    def get_value(self, url):
+        """
+        :param url: The URL, as str or bytes
+        :return: The value stored for the URL (possibly compressed, or a
+                 chunk manifest), following its digest pointer if it has one,
+                 or None if the URL isn't in the DB
+        """
+        key = url.encode('utf-8') if isinstance(url, str) else url
+        digest = self.pointer_db.get(key)
+        if digest is not None:
+            return self.digest_db.get(digest)
+        return self.content_db.get(key)
+
+    def value_length(self, value):
+        """
+        :param value: A value returned by get_value()
+        :return: The length of the payload it holds or describes
+        """
+        manifest = parse_manifest(value)
+        if manifest:
+            return manifest[2]
+        return self.codec.decoded_length(value)
+
+    def value_digest(self, value):
+        """
+        :param value: A value returned by get_value()
+        :return: The digest of the payload, as payload_digest() computes it
+        """
+        if not parse_manifest(value):
+            return payload_digest(self.codec.decode(value))
+        hasher = hashlib.sha1()
+        for data in self.iter_value(value):
+            hasher.update(data)
+        return b"sha1:" + base64.b32encode(hasher.digest())
+
+    def iter_value(self, value, start=0, end=None):
+        """
+        Yield the bytes [start, end) of the payload held in a value. For a
+        chunk manifest, only the chunks overlapping the range are read.
+
+        :param value: A value returned by get_value()
+        :param start: First byte offset
+        :param end: Offset just past the last byte (None for the end of the payload)
+        """
+        manifest = parse_manifest(value)
+        if not manifest:
+            payload = self.codec.decode(value)
+            if start or (end is not None and end < len(payload)):
+                payload = payload[start:end]
+            if payload:
+                yield payload
+            return
+
+        object_id, chunk_size, length = manifest
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return
+        first = start // chunk_size
+        last = (end - 1) // chunk_size
+        for index in range(first, last + 1):
+            chunk = self.chunk_db.get(object_id + index.to_bytes(4, 'big'))
+            if chunk is None:
+                raise RuntimeError(f"Chunk {index} of object {object_id.hex()} is missing")
+            chunk = self.codec.decode(chunk)
+            offset = index * chunk_size
+            if start > offset or end < offset + len(chunk):
+                chunk = chunk[max(start - offset, 0):end - offset]
+            yield chunk
+
+    def iter_content(self, url, start=0, end=None):
+        """
+        Yield the bytes [start, end) of the payload stored for a URL, a chunk
+        at a time, without loading the whole payload
+
+        :param url: The URL, as str or bytes
+        :param start: First byte offset
+        :param end: Offset just past the last byte (None for the end of the payload)
+        """
+        value = self.get_value(url)
+        if value is not None:
+            yield from self.iter_value(value, start, end)
+
+    def content_length(self, url):
+        """
+        :param url: The URL, as str or bytes
+        :return: The length of the payload stored for the URL, or None if it isn't in the DB
+        """
+        value = self.get_value(url)
+        if value is None:
+            return None
+        return self.value_length(value)
+
+    def read_range(self, url, start=0, end=None):
+        """
+        :param url: The URL, as str or bytes
+        :param start: First byte offset
+        :param end: Offset just past the last byte (None for the end of the payload)
+        :return: Those bytes of the URL's payload, or None if it isn't in the DB
+        """
+        value = self.get_value(url)
+        if value is None:
+            return None
+        return b"".join(self.iter_value(value, start, end))
+
+    def get_content(self, url):
+        """
+        Read the payload stored for a URL, in either layout, decompressed
+        (and reassembled, if it was stored in chunks)
+
+        :param url: The URL, as str or bytes
+        :return: The payload bytes, or None if the URL isn't in the DB
+        """
+        return self.read_range(url)
+
+    def lookup(self, url):
+        """
+        Read what is stored for a URL in one call, from a single snapshot of
+        the DB, so the value, mimetype and timestamp always belong to the same
+        capture. The payload isn't decoded: hand the value to iter_value(),
+        for the whole payload or a range of it.
+
+        :param url: The URL, as str or bytes
+        :return: A hashmap with the url, value, length, mimetype and timestamp
+                 (mimetype and timestamp are None if not stored), or None if
+                 the URL isn't in the DB
+        """
+        key = url.encode('utf-8') if isinstance(url, str) else url
+        with self.db.snapshot() as snapshot:
+            digest = snapshot.get(POINTER_PREFIX + key)
+            if digest is not None:
+                value = snapshot.get(DIGEST_PREFIX + digest)
+            else:
+                value = snapshot.get(CONTENT_PREFIX + key)
+            if value is None:
+                return None
+            mimetype = snapshot.get(MIMETYPE_PREFIX + key)
+            timestamp = snapshot.get(TIMESTAMP_PREFIX + key)
+        return {
+            "url": key.decode('utf-8'),
+            "value": value,
+            "length": self.value_length(value),
+            "mimetype": mimetype.decode('utf-8') if mimetype is not None else None,
+            "timestamp": timestamp.decode('utf-8') if timestamp is not None else None,
+        }
+
+    def get(self, url):
+        """
+        :param url: The URL, as str or bytes
+        :return: A hashmap with the url, payload, mimetype and timestamp, or
+                 None if the URL isn't in the DB
+        """
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        return {
+            "url": entry['url'],
+            "payload": b"".join(self.iter_value(entry['value'])),
+            "mimetype": entry['mimetype'],
+            "timestamp": entry['timestamp'],
+        }
+
+    def iter_subdomain(self, subdomain):
+        """
+        The URLs stored for a subdomain, under either scheme and with or
+        without a port, in key order.
+
+        :param subdomain: The subdomain, e.g. www.cdc.gov
+        :return: A generator of (url, timestamp)
+        """
+        for scheme in ("http://", "https://"):
+            prefix = f"{scheme}{subdomain}".encode('utf-8')
+            for key, timestamp in self.timestamp_db.iterator(prefix=prefix):
+                # Skip other hosts that merely start with the name, e.g. www.cdc.gov.example
+                if len(key) > len(prefix) and key[len(prefix)] not in b"/:?#":
+                    continue
+                yield key.decode('utf-8'), timestamp.decode('utf-8')
+
+    def train_dictionary(self, sample_count=2000, size=DEFAULT_DICTIONARY_SIZE):
+        """
+        Train a compression dictionary on stored text payloads, save it in the
+        DB, and compress new payloads with it. Values compressed with earlier
+        dictionaries stay readable, since those are kept.
+
+        :param sample_count: Maximum number of payloads to sample
+        :param size: Target dictionary size in bytes
+        :return: The new dictionary's id, or None if there were no text payloads
+        """
+        self.flush()
+        samples = []
+        for url, mimetype in self.mimetype_db.iterator():
+            if len(samples) >= sample_count:
+                break
+            if not is_compressible(mimetype.decode('utf-8', 'replace')):
+                continue
+            value = self.get_value(url)
+            if value is None or parse_manifest(value):
+                continue
+            payload = self.codec.decode(value)
+            if payload:
+                samples.append(payload)
+        if not samples:
+            return None
+        data = self.codec.train_dictionary(samples, size)
+        dict_id = max(self.codec.dictionaries, default=0) + 1
+        self.dictionary_db.put(dict_id.to_bytes(4, 'big'), data)
+        self.codec.add_dictionary(dict_id, data)
+        logging.info(f"Trained compression dictionary {dict_id} ({len(data)} bytes) on {len(samples)} payloads")
+        return dict_id
+
+    def _maybe_flush(self):
+        if self.batch is None:
+            return
+        self.batch_count += 1
+        if (self.batch_count >= self.batch_records
+                or self.batch_size >= self.batch_bytes
+                or monotonic() - self.batch_started >= self.batch_seconds):
+            self.flush()
+
+    def flush(self):
+        """
+        Commit the pending write batch, if there is one
+        """
+        if self.batch is None:
+            return
+        start = monotonic()
+        self.batch.write()
+        self.flush_time += monotonic() - start
+        self.flush_count += 1
+        self.bytes_written += self.batch_size
+        logging.debug("Flushed %d paths (%d bytes) to the LevelDB", self.batch_count, self.batch_size)
+        self.batch = None
+        self.batch_digests = {}
+        self.batch_cdx_digests = {}
+        self.batch_timestamps = {}
+        self.batch_count = 0
+        self.batch_size = 0
+
     def process_url(self, subdomain, url_data):
         """
         Extract the WARC file associated with the url, and insert data
@@ -45,45 +745,302 @@ class WARCLevelDB:
         self.total_path += 1
         filename = url_data['fetched']['file']
         if not filename:
-            logging.debug(f"Missing warc file for {url_data}")
+            logging.debug("Missing warc file for %s", url_data)
             return
-        logging.debug(f"Opening file{filename}")
-        file_contents = None
+        logging.debug("Opening file %s", filename)
 
-        if filename.endswith(".gz"):
-            stream = gzip.open(filename, 'rb')
-        elif filename.endswith(".warc"):
-            stream = open(filename, 'rb')
-        else:
+        start = monotonic()
+        stream, max_records = open_capture(url_data['fetched'])
+        if stream is None:
+            return
+
+        # Anything longer than the threshold is streamed into chunks by store_record()
+        for uri, content_type, payload, content_stream in iter_warc_payloads(stream, self.chunk_threshold,
+                                                                             max_records):
+            self.store_record(subdomain, url_data, uri, content_type, payload, content_stream)
+        stream.close()
+        self.ingest_time += monotonic() - start
+        self.ingest_count += 1
+        self._maybe_flush()
+
+    def store_parsed(self, subdomain, url_data, records):
+        """
+        Insert the response records of a WARC file parsed elsewhere (the
+        parallel ingest parses them in worker processes), with the same
+        bookkeeping as process_url().
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain, including 'fetched'
+        :param records: A list of (uri, content_type, payload), with whole payloads
+        """
+        self.total_path += 1
+        start = monotonic()
+        for uri, content_type, payload in records:
+            self.store_record(subdomain, url_data, uri, content_type, payload)
+        self.ingest_time += monotonic() - start
+        self.ingest_count += 1
+        self._maybe_flush()
+
+    def ingest_record(self, subdomain, url_data, record):
+        """
+        Insert a capture fetched straight from the wayback server, without
+        going through a WARC file. The record's stream is rewound afterwards,
+        so it can still be written to a WARC.
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain, including 'fetched'
+        :param record: The warcio response record from fetch_capture_record()
+        """
+        self.total_path += 1
+        uri = record.rec_headers.get_header('WARC-Target-URI')
+        if record.rec_type != 'response' or not uri or not record.http_headers:
+            logging.info("Nothing to ingest in the record for %s", url_data['original'])
             return
+        started = monotonic()
+        start = record.raw_stream.tell()
+        content_stream = record.content_stream()
+        payload = read_up_to(content_stream, self.chunk_threshold + 1)
+        self.store_record(subdomain, url_data, uri, record.http_headers.get_header('Content-Type'),
+                          payload, content_stream)
+        record.raw_stream.seek(start)
+        self.ingest_time += monotonic() - started
+        self.ingest_count += 1
+        self._maybe_flush()
 
-        for record in ArchiveIterator(stream, no_record_parse=False, ensure_http_headers=True):
-            if record.rec_type != 'response':
-                if record.rec_type != "warcinfo":
-                    logging.debug(f"Record type '{record.rec_type}' skipped.")
+    def find_cdx_digest(self, digest):
+        """
+        Look a CDX digest up in the digest index. The URL it names only still
+        holds that payload if it still holds the same capture: one refreshed
+        since to a capture with other content isn't a source any more.
+
+        :param digest: The 'digest' field of a CDX row
+        :return: A URL (as bytes) whose stored payload has that digest, or None
+        """
+        if not digest:
+            return None
+        key = digest.encode('utf-8')
+        if key in self.batch_cdx_digests:
+            # The source's entries are still in the pending batch, where they can't be checked
+            self.flush()
+        entry = self.cdx_digest_db.get(key)
+        if entry is None:
+            return None
+        timestamp, _, source = entry.partition(b" ")
+        if not source:
+            return None
+        current = self.batch_timestamps.get(source)
+        if current is None:
+            current = self.timestamp_db.get(source)
+        if current != timestamp or self.get_value(source) is None:
+            return None
+        return source
+
+    def copy_capture(self, subdomain, url_data, source):
+        """
+        Store a capture whose payload is already in the DB under another URL,
+        without fetching it: every URL of the path gets the source's value
+        (its pointer, in content-addressed mode) and mimetype.
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain, including 'fetched'
+        :param source: The URL find_cdx_digest() returned
+        """
+        if url_data['digest'].encode('utf-8') in self.batch_cdx_digests:
+            # The source's own entries are still in the pending batch
+            self.flush()
+        self.total_path += 1
+        digest = self.pointer_db.get(source)
+        value = None if digest is not None else self.content_db.get(source)
+        mimetype = self.mimetype_db.get(source)
+        timestamp = url_data['timestamp'].encode('utf-8')
+        keys = [url.encode('utf-8') for url in url_data['originals']]
+        relocated = False
+        if not (digest is not None and self.content_addressed):
+            if digest is not None:
+                value = self.digest_db.get(digest)
+            if parse_manifest(value):
+                # Per-URL manifests own their chunks, so a newer capture can delete them
+                value = self.copy_chunks(value, self._object_id(subdomain, url_data))
+                relocated = True
+            self._drop_replaced_chunks(subdomain, url_data, keys)
+        for key in keys:
+            # On a refresh whose digest hasn't changed, the source is one of
+            # the path's own URLs: its value stays, but it is the new capture now
+            if key != source or relocated:
+                if digest is not None and self.content_addressed:
+                    self._put_pointer(key, digest)
+                else:
+                    self._put_url_value(key, value)
+            if mimetype:
+                self.put(MIMETYPE_PREFIX, key, mimetype)
+            self.put(TIMESTAMP_PREFIX, key, timestamp)
+            self.total_url += 1
+        self.put(INGESTED_PREFIX, f"{subdomain}{url_data['path']}".encode('utf-8'), timestamp)
+        if keys:
+            # The source may be this very path, whose old index entry no longer matches its timestamp
+            self._put_cdx_digest(url_data['digest'].encode('utf-8'), timestamp, keys[0])
+        self.copied_captures += 1
+        logging.debug("Copied %s from %s, which has the same digest", url_data['original'],
+                      source.decode('utf-8'))
+        self._maybe_flush()
+
+    def is_ingested(self, subdomain, url_data):
+        """
+        Whether the ingest ledger says this path's current capture, from this
+        WARC file, is already in the DB. Only committed writes count, so a
+        path whose write batch was lost in a crash is ingested again.
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain, including 'fetched'
+        """
+        entry = self.ingested_db.get(f"{subdomain}{url_data['path']}".encode('utf-8'))
+        if entry is None:
+            return False
+        timestamp, _, filename = entry.decode('utf-8').partition(" ")
+        # Entries written before the ledger recorded the file only hold the timestamp
+        return timestamp == url_data['timestamp'] and (not filename or filename == url_data['fetched']['file'])
+
+    def store_record(self, subdomain, url_data, uri, content_type, payload, content_stream=None):
+        """
+        Insert one parsed WARC response record under every URL of the path.
+        process_url() parses the WARC itself; store_parsed() takes records
+        parsed in another process.
+
+        :param subdomain: The subdomain that we're processing
+        :param url_data: A hashmap with information about a URL in the subdomain
+        :param uri: The record's WARC-Target-URI
+        :param content_type: The record's Content-Type, or None
+        :param payload: The payload, or its first chunk_threshold + 1 bytes if it is longer
+        :param content_stream: The rest of a longer payload
+        """
+        urls = url_data['originals']
+        if not (uri in urls):
+            urls.append(uri)
+        # logging.debug(f"urls: {urls}; uri: {uri}; path: {url_data['path']}; originals: {url_data['originals']}")
+
+        timestamp = url_data['timestamp'].encode('utf-8')
+        keys = [url.encode('utf-8') for url in urls]
+        self._drop_replaced_chunks(subdomain, url_data, keys)
+        if len(payload) > self.chunk_threshold:
+            object_id = self._object_id(subdomain, url_data)
+            manifest, digest = self.put_chunks(object_id, payload, content_stream or BytesIO(), content_type)
+            self.put_chunked_content(keys, manifest, digest)
+        else:
+            self.put_content(keys, payload, content_type)
+        for key in keys:
+            if content_type:
+                self.put(MIMETYPE_PREFIX, key, content_type.encode('utf-8'))
+            self.put(TIMESTAMP_PREFIX, key, timestamp)
+            self.total_url += 1
+        if url_data.get('digest'):
+            self._put_cdx_digest(url_data['digest'].encode('utf-8'), timestamp, uri.encode('utf-8'))
+        ledger_entry = url_data['timestamp']
+        if url_data['fetched']['file']:
+            ledger_entry += f" {url_data['fetched']['file']}"
+        # Captures ingested without a WARC file (or before its write) are matched on timestamp alone
+        self.put(INGESTED_PREFIX, f"{subdomain}{url_data['path']}".encode('utf-8'), ledger_entry.encode('utf-8'))
+        logging.debug("Saved record: %s [%s]", uri, content_type)
+
+    def _put_cdx_digest(self, cdx_digest, timestamp, source):
+        self.put(CDX_DIGEST_PREFIX, cdx_digest, timestamp + b" " + source)
+        if self.batch is not None:
+            self.batch_cdx_digests[cdx_digest] = source
+
+    def sweep_chunks(self):
+        """
+        Delete the chunks no manifest refers to any more, along with the
+        content-addressed payloads no URL points to: the digests a newer
+        capture replaced, and the duplicate objects a migration leaves in
+        place. Pending writes are flushed first, and nothing else may write
+        to the DB while the sweep runs, since chunks are committed ahead of
+        their manifest.
+
+        :return: A dict with the number of digests and chunks deleted, and the stored bytes they held
+        """
+        self.flush()
+        stats = {"digests": 0, "chunks": 0, "bytes": 0}
+        sweep_batch = self.db.write_batch()
+        batch_size = 0
+        def sweep(key, value, kind):
+            nonlocal sweep_batch, batch_size
+            sweep_batch.delete(key)
+            stats[kind] += 1
+            stats["bytes"] += len(value)
+            batch_size += len(key)
+            if batch_size >= self.batch_bytes:
+                sweep_batch.write()
+                sweep_batch = self.db.write_batch()
+                batch_size = 0
+
+        referenced = {digest for _, digest in self.pointer_db.iterator()}
+        # Object ids of the chunks some manifest still refers to
+        live = set()
+        for digest, value in self.digest_db.iterator():
+            if digest not in referenced:
+                sweep(DIGEST_PREFIX + digest, value, "digests")
                 continue
-            uri = record.rec_headers.get_header('WARC-Target-URI')
-            payload = record.content_stream().read()
-            logging.debug(f"uri = {uri}")
-            if uri and payload is not None:
-                if not record.http_headers:
-                    logging.info("No http_headers for this warc record")
-                    continue
+            manifest = parse_manifest(value)
+            if manifest:
+                live.add(manifest[0])
+        referenced = None
+        for _, value in self.content_db.iterator():
+            manifest = parse_manifest(value)
+            if manifest:
+                live.add(manifest[0])
+        for key, value in self.chunk_db.iterator():
+            if key[:-4] not in live:
+                sweep(CHUNK_PREFIX + key, value, "chunks")
+        sweep_batch.write()
+        logging.info(f"Swept {stats['chunks']} chunks and {stats['digests']} unreferenced payloads "
+                     f"({stats['bytes']} bytes)")
+        return stats
 
-                urls = url_data['originals']
-                if not (uri in urls):
-                    urls.append(uri)
-                # logging.debug(f"urls: {urls}; uri: {uri}; path: {url_data['path']}; originals: {url_data['originals']}")
+    def dedup_report(self):
+        """
+        Walk the content keyspaces and compare the bytes the URLs refer to with
+        the bytes actually stored, after deduplication and compression.
+        Pending writes are flushed first.
 
-                content_type = record.http_headers.get_header('Content-Type')
-                for url in urls:
-                    self.content_db.put(url.encode('utf-8'), payload)
+        :return: A dict with URL and payload counts, logical and stored bytes,
+                 and the dedup ratio (logical / stored)
+        """
+        self.flush()
+        digest_sizes = {}
+        stored_bytes = 0
+        for digest, value in self.digest_db.iterator():
+            digest_sizes[digest] = self.value_length(value)
+            stored_bytes += len(value)
 
-                    if content_type:
-                        self.mimetype_db.put(url.encode('utf-8'), content_type.encode('utf-8'))
-                    self.timestamp_db.put(url.encode('utf-8'), url_data['timestamp'].encode('utf-8'))
-                    self.total_url += 1
-                logging.info(f"Saved record: {uri} [{content_type}]")
-            else:
-                logging.debug(f"Payload: {payload}")
-        stream.close()
+        logical_bytes = 0
+        legacy_urls = 0
+        for _, value in self.content_db.iterator():
+            legacy_urls += 1
+            logical_bytes += self.value_length(value)
+            stored_bytes += len(value)
+
+        chunks = 0
+        for _, value in self.chunk_db.iterator():
+            chunks += 1
+            stored_bytes += len(value)
+
+        pointer_urls = 0
+        dangling = 0
+        for _, digest in self.pointer_db.iterator():
+            pointer_urls += 1
+            size = digest_sizes.get(digest)
+            if size is None:
+                dangling += 1
+                continue
+            logical_bytes += size
+
+        return {
+            "urls": legacy_urls + pointer_urls,
+            "per_url_payloads": legacy_urls,
+            "content_addressed_urls": pointer_urls,
+            "unique_payloads": len(digest_sizes),
+            "chunks": chunks,
+            "dangling_pointers": dangling,
+            "logical_bytes": logical_bytes,
+            "stored_bytes": stored_bytes,
+            "dedup_ratio": logical_bytes / stored_bytes if stored_bytes else 1.0,
+        }
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Wayback Machine, for exercising the pipeline
+without touching the Internet Archive.
+
+Captures are served from /web/{timestamp}id_/{url}, a synthetic CDX index
+(with limit/resumeKey paging) from /cdx/search/cdx, and /stats reports
+how many requests were served and the requests per second achieved.
+With a throttle set, requests beyond that many per second get a 429 with
+a Retry-After header, like the real thing; an error rate adds 429s at
+random on top. Jitter adds a random, exponentially distributed delay to
+the fixed latency of each capture.
+
+Given a SyntheticCorpus, the CDX index and the captures are the corpus'
+(with its mimetypes, sizes and duplicate digests) rather than a page per
+path of small, unique HTML.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+from collections import deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import parse_qs, unquote, urlparse
+
+from synthetic_corpus import SyntheticCorpus
+
+CDX_HEADERS = ["urlkey", "timestamp", "original", "mimetype", "statuscode", "digest", "length"]
+
+def synthetic_cdx_row(netloc, index, captures):
+    """
+    The `index`-th row of a subdomain's synthetic CDX index, in urlkey order.
+    Each path has `captures` captures, alternating between http and https originals.
+
+    :param netloc: The subdomain, e.g. bench.cdc.gov
+    :param index: Row number
+    :param captures: Captures per path
+    :return: A list of values matching CDX_HEADERS
+    """
+    path_ix, version = divmod(index, captures)
+    surt_host = ",".join(reversed(netloc.split(".")))
+    path = f"/page/{path_ix:07d}.html"
+    scheme = "https" if version % 2 == 0 else "http"
+    timestamp = f"2024{1 + version % 12:02d}01000000"
+    return [
+        f"{surt_host}){path}",
+        timestamp,
+        f"{scheme}://{netloc}{path}",
+        "text/html",
+        "200",
+        f"SYNTH{path_ix:07d}V{version:03d}",
+        str(1000 + path_ix % 5000),
+    ]
+
+class FakeWaybackServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, throttle_rps=None, retry_after=1, cdx_paths=100, cdx_captures=3,
+                 corpus=None, jitter=0.0, error_rate=0.0, seed=0):
+        """
+        :param address: (host, port) tuple to listen on; port 0 picks a free port
+        :param latency: Seconds to sleep before answering each capture request
+        :param throttle_rps: Answer 429 to requests beyond this many per second
+        :param retry_after: Retry-After value sent with each 429 (none if 0)
+        :param cdx_paths: Number of distinct paths in each subdomain's CDX index
+        :param cdx_captures: Number of captures of each path
+        :param corpus: A SyntheticCorpus to serve instead of cdx_paths/cdx_captures
+        :param jitter: Mean seconds of random latency added to `latency`
+        :param error_rate: Share of capture requests answered with a 429 at random
+        :param seed: Seed of the jitter and random errors
+        """
+        super().__init__(address, FakeWaybackHandler)
+        self.latency = latency
+        self.corpus = corpus
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.cdx_paths = cdx_paths
+        self.cdx_captures = cdx_captures
+        self.throttle_rps = throttle_rps
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self):
+        with self.lock:
+            self.request_count = 0
+            self.connection_count = 0
+            self.cdx_request_count = 0
+            self.throttled_count = 0
+            self.error_count = 0
+            self.not_found_count = 0
+            self.bytes_sent = 0
+            self.recent = deque()
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.first_request = None
+            self.last_request = None
+
+    def stats(self):
+        """
+        :return: A dict describing the traffic served so far
+        """
+        with self.lock:
+            elapsed = 0.0
+            if self.first_request is not None:
+                elapsed = self.last_request - self.first_request
+            rps = self.request_count / elapsed if elapsed > 0 else 0.0
+            return {
+                "requests": self.request_count,
+                "throttled": self.throttled_count,
+                "errors": self.error_count,
+                "not_found": self.not_found_count,
+                "bytes_sent": self.bytes_sent,
+                "connections": self.connection_count,
+                "cdx_requests": self.cdx_request_count,
+                "elapsed": elapsed,
+                "requests_per_second": rps,
+                "max_in_flight": self.max_in_flight,
+            }
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (e.g. an interrupted enumeration) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def should_throttle(self, now):
+        """
+        Sliding one-second window of accepted requests. Call with the lock held.
+        """
+        if not self.throttle_rps:
+            return False
+        while self.recent and self.recent[0] <= now - 1.0:
+            self.recent.popleft()
+        if len(self.recent) >= self.throttle_rps:
+            self.throttled_count += 1
+            return True
+        self.recent.append(now)
+        return False
+
+    def capture_delay(self):
+        """
+        Seconds to wait before answering a capture. Call with the lock held.
+        """
+        if not self.jitter:
+            return self.latency
+        return self.latency + self.rng.expovariate(1 / self.jitter)
+
+    def start(self):
+        """
+        Serve in a background thread
+
+        :return: The background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+class FakeWaybackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            body = json.dumps(self.server.stats()).encode("utf-8")
+            self.send_body(200, body, "application/json")
+            return
+        if self.path.startswith("/web/"):
+            self.serve_capture()
+            return
+        if self.path.startswith("/cdx/search/cdx"):
+            self.serve_cdx()
+            return
+        self.send_body(404, b"not found", "text/plain")
+
+    def serve_capture(self):
+        server = self.server
+        with server.lock:
+            now = monotonic()
+            if server.first_request is None:
+                server.first_request = now
+            server.request_count += 1
+            throttled = server.should_throttle(now)
+            if not throttled and server.error_rate and server.rng.random() < server.error_rate:
+                server.error_count += 1
+                throttled = True
+            delay = server.capture_delay()
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if throttled:
+                self.send_body(429, b"Too Many Requests", "text/plain",
+                               {"Retry-After": str(server.retry_after)} if server.retry_after else None)
+                return
+            if delay:
+                sleep(delay)
+            # /web/{timestamp}id_/{url}
+            _, _, rest = self.path.partition("/web/")
+            timestamp, _, url = rest.partition("id_/")
+            if server.corpus is None:
+                content_type = "text/html"
+                body = (f"<html><body><h1>{url}</h1><p>captured {timestamp}</p></body></html>").encode("utf-8")
+            else:
+                parsed = urlparse(unquote(url))
+                path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+                capture = server.corpus.capture(parsed.netloc, path, timestamp)
+                if capture is None:
+                    with server.lock:
+                        server.not_found_count += 1
+                    self.send_body(404, b"not found", "text/plain")
+                    return
+                content_type, body = capture
+            self.send_body(200, body, content_type, {
+                "X-Archive-Orig-Date": "Mon, 13 Jan 2025 00:00:00 GMT",
+            })
+            with server.lock:
+                server.bytes_sent += len(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.last_request = monotonic()
+
+    def serve_cdx(self):
+        server = self.server
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        netloc = params.get("url", "").split("/")[0]
+        ts_from = params.get("from", "").ljust(14, "0")
+        ts_to = params.get("to", "").ljust(14, "9")
+        start = int(params.get("resumeKey", 0))
+        limit = int(params.get("limit", 0)) or None
+        if server.corpus is None:
+            total = server.cdx_paths * server.cdx_captures
+            row_at = partial(synthetic_cdx_row, netloc, captures=server.cdx_captures)
+        else:
+            total = server.corpus.row_count(netloc)
+            row_at = partial(server.corpus.row, netloc)
+
+        rows = []
+        index = start
+        while index < total and (limit is None or len(rows) < limit):
+            row = row_at(index)
+            index += 1
+            if ts_from <= row[1] <= ts_to:
+                rows.append(row)
+
+        lines = [json.dumps(CDX_HEADERS)] + [json.dumps(row) for row in rows]
+        if params.get("showResumeKey") == "true" and index < total:
+            lines += ["[]", json.dumps([str(index)])]
+        body = ("[" + ",\n".join(lines) + "]\n").encode("utf-8")
+        with server.lock:
+            server.cdx_request_count += 1
+        self.send_body(200, body, "application/json")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake Wayback Machine")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency per capture")
+    parser.add_argument("--throttle-rps", type=float, default=None, help="Send 429s above this request rate")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s (0 for none)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Mean seconds of random extra latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of captures answered with a 429")
+    parser.add_argument("--corpus-paths", type=int, default=None,
+                        help="Serve a synthetic corpus with this many paths per subdomain")
+    parser.add_argument("--captures", type=float, default=3.0, help="Average captures per path of the corpus")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2, help="Share of corpus paths with shared content")
+    parser.add_argument("--size-scale", type=float, default=1.0, help="Factor applied to the corpus' payload sizes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and the random errors")
+    args = parser.parse_args()
+
+    corpus = None
+    if args.corpus_paths:
+        corpus = SyntheticCorpus(args.corpus_paths, args.captures, args.duplicate_ratio,
+                                 size_scale=args.size_scale, seed=args.seed)
+    server = FakeWaybackServer((args.host, args.port), latency=args.latency, throttle_rps=args.throttle_rps,
+                               retry_after=args.retry_after, corpus=corpus, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    print(f"Serving fake wayback at {server.base_url}/web")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Crash-safe, append-only record of fetch results for one subdomain.
+"""
+
+import json
+import logging
+import os
+from time import monotonic
+
+DEFAULT_FSYNC_EVERY = 100
+DEFAULT_FSYNC_INTERVAL = 5.0
+
+class FetchJournal:
+    def __init__(self, state_folder, subdomain, fsync_every=DEFAULT_FSYNC_EVERY,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, read_only=False):
+        """
+        Fetch results are appended to fetched.{subdomain}.journal as JSON lines,
+        on top of a snapshot in fetched.{subdomain}.json (the format the fetched
+        state has always been saved in). Opening the journal loads the snapshot
+        and replays the journal; compact() folds the journal back into the snapshot.
+
+        Writes are fsync'ed in batches: after `fsync_every` records or
+        `fsync_interval` seconds, whichever comes first. A crash can lose at most
+        that last batch, which just means those paths are fetched again.
+
+        :param state_folder: Folder holding the snapshot and journal files
+        :param subdomain: The subdomain whose fetch results are recorded
+        :param fsync_every: Number of records per fsync
+        :param fsync_interval: Maximum seconds between fsyncs
+        :param read_only: Only load the state; the files are left as they are
+        """
+        self.snapshot_file = f"{state_folder}/fetched.{subdomain}.json"
+        self.journal_file = f"{state_folder}/fetched.{subdomain}.journal"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        # {path: {"file": ..., "issues": ...}}
+        self.state = {}
+        self.journal_entries = 0
+        self.unsynced = 0
+        self.last_sync = monotonic()
+        self.read_only = read_only
+
+        self._load()
+        self.fd = None
+        if not read_only:
+            self.fd = open(self.journal_file, "a", encoding="utf-8")
+
+    def _load(self):
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, "r", encoding="utf-8") as snapshot_fd:
+                self.state = json.load(snapshot_fd)
+        if not os.path.exists(self.journal_file):
+            return
+
+        good_offset = 0
+        with open(self.journal_file, "rb") as journal_fd:
+            for line in journal_fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn write from a crash; everything after it is discarded
+                    logging.warning(f"Discarding damaged tail of {self.journal_file} at byte {good_offset}")
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self._apply(entry)
+                self.journal_entries += 1
+                good_offset += len(line)
+        if good_offset != os.path.getsize(self.journal_file) and not self.read_only:
+            with open(self.journal_file, "r+b") as journal_fd:
+                journal_fd.truncate(good_offset)
+
+    def _apply(self, entry):
+        path = entry.pop("path")
+        if entry.get("deleted"):
+            self.state.pop(path, None)
+        else:
+            self.state[path] = entry
+
+    def __contains__(self, path):
+        return path in self.state
+
+    def get(self, path, default=None):
+        return self.state.get(path, default)
+
+    def _append(self, entry):
+        self.fd.write(json.dumps(entry) + "\n")
+        self.journal_entries += 1
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def record(self, path, result):
+        """
+        Record the fetch result for a path.
+
+        :param path: The path within the subdomain
+        :param result: A {"file": ..., "issues": ...} hashmap
+        """
+        self.state[path] = result
+        entry = dict(result)
+        entry["path"] = path
+        self._append(entry)
+
+    def forget(self, path):
+        """
+        Drop the recorded result for a path, so it is fetched again.
+
+        :param path: The path within the subdomain
+        """
+        if path in self.state:
+            del self.state[path]
+            self._append({"path": path, "deleted": True})
+
+    def sync(self):
+        """
+        Flush buffered records and fsync the journal
+        """
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.unsynced = 0
+        self.last_sync = monotonic()
+
+    def compact(self):
+        """
+        Atomically write the current state as the snapshot, then empty the journal.
+        A crash in between is harmless: replaying the journal over the new
+        snapshot gives the same state.
+        """
+        self.sync()
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as snapshot_fd:
+            json.dump(self.state, snapshot_fd)
+            snapshot_fd.flush()
+            os.fsync(snapshot_fd.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self.fd.truncate(0)
+        self.fd.seek(0)
+        self.journal_entries = 0
+
+    def close(self, compact=True):
+        """
+        Sync the journal, optionally compact it, and close it.
+
+        :param compact: Fold the journal into the snapshot first
+        """
+        if self.fd is None:
+            return
+        if compact and self.journal_entries:
+            self.compact()
+        else:
+            self.sync()
+        self.fd.close()
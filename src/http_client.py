@@ -0,0 +1,116 @@
+"""
+A shared, pooled HTTP client for everything the pipeline fetches from the
+Wayback Machine (CDX queries and captures alike).
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import THROTTLE_STATUS_CODES, TransientFetchError, parse_retry_after
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 8
+DEFAULT_CONNECT_TIMEOUT = 30.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+class HTTPClient:
+    def __init__(self, limiter=None, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, compression=True, user_agent=None):
+        """
+        Wraps one requests.Session with a connection pool per host, so that
+        connections (and their TLS sessions) are kept alive across requests.
+
+        :param limiter: An optional HostRateLimiter to pace and report every request
+        :param pool_connections: Number of per-host pools to keep
+        :param pool_maxsize: Connections kept per host; should be at least the number of download workers
+        :param connect_timeout: Seconds to wait for a connection
+        :param read_timeout: Seconds to wait between bytes of the response
+        :param compression: Whether to ask for gzip/deflate compressed responses
+        :param user_agent: User-Agent header to send
+        """
+        self.limiter = limiter
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                   max_retries=0, pool_block=False)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if not compression:
+            self.session.headers['Accept-Encoding'] = 'identity'
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        """
+        GET through the shared session, paced by and reporting back to the limiter.
+
+        :param url: The URL to fetch
+        :param kwargs: Passed through to requests.Session.get()
+        :return: The requests.Response, for any status that isn't a throttling one
+        :raises TransientFetchError: on throttling statuses and connection failures
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.limiter:
+            self.limiter.acquire(url)
+        with self.lock:
+            self.request_count += 1
+        try:
+            resp = self.session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if self.limiter:
+                self.limiter.record(url, None)
+            raise TransientFetchError(f"connection failure for {url}: {e}") from e
+
+        retry_after = None
+        if resp.status_code in THROTTLE_STATUS_CODES:
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        if self.limiter:
+            self.limiter.record(url, resp.status_code, retry_after)
+        if resp.status_code in THROTTLE_STATUS_CODES:
+            # Hand the connection back to the pool; a streamed response would hold it until
+            # collected. Reading the (short) error body first lets the connection be reused.
+            try:
+                resp.content
+            except requests.exceptions.RequestException:
+                pass
+            resp.close()
+            raise TransientFetchError(f"status {resp.status_code} for {url}", retry_after)
+        return resp
+
+    def stats(self):
+        """
+        :return: A dict with the number of requests made, connections opened,
+                 and the fraction of requests that reused a pooled connection
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        for key in pools.keys():
+            try:
+                connections += pools[key].num_connections
+            except KeyError:
+                # Evicted while we were looking
+                continue
+        with self.lock:
+            requests_made = self.request_count
+        reused = max(0, requests_made - connections)
+        return {
+            "requests": requests_made,
+            "connections": connections,
+            "reused": reused,
+            "reuse_ratio": reused / requests_made if requests_made else 0.0,
+        }
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        self.session.close()
@@ -0,0 +1,299 @@
+"""
+Run metrics for the pipeline stages.
+
+Counters and gauges are kept in memory, and a MetricsReporter writes them
+every few seconds in the Prometheus text format, so a run can be watched
+with `cat`, or scraped through node_exporter's textfile collector. The same
+reporter logs a progress line with the throughput and an ETA per subdomain.
+
+Stages report events with the module level inc(), set_gauge() and
+observe(). Objects that already count what they do (the LevelDB, the HTTP
+client, the rate limiter) are read by collectors when a report is written
+instead, so the hot paths don't pay for the metrics at all.
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+from time import monotonic
+
+DEFAULT_METRICS_INTERVAL = 15.0
+# Seconds of progress the ETA's rate is measured over
+ETA_WINDOW = 120.0
+
+# Every metric the pipeline reports: name -> (type, help)
+METRICS = {
+    "restore_run_seconds": ("gauge", "Seconds since the run started"),
+    "restore_cdx_rows_total": ("counter", "CDX rows received, by subdomain"),
+    "restore_cdx_pages_total": ("counter", "CDX result pages received, by subdomain"),
+    "restore_cdx_rows_per_second": ("gauge", "CDX rows received per second since the last report"),
+    "restore_subdomain_paths": ("gauge", "Paths in the subdomain's URL list"),
+    "restore_subdomain_paths_done": ("gauge", "Paths of the subdomain processed so far"),
+    "restore_subdomain_eta_seconds": ("gauge", "Estimated seconds left for the subdomain, at its recent rate"),
+    "restore_captures_total": ("counter", "Paths processed, by subdomain and result"),
+    "restore_captures_per_second": ("gauge", "Paths processed per second since the last report"),
+    "restore_http_requests_total": ("counter", "Requests made to the Wayback Machine"),
+    "restore_http_connections": ("gauge", "Pooled connections open to the Wayback Machine"),
+    "restore_rate_limiter_rate": ("gauge", "Current requests per second allowed, by host"),
+    "restore_rate_limiter_wait_seconds_total": ("counter", "Seconds spent waiting for the rate limiter, by host"),
+    "restore_rate_limiter_throttled_total": ("counter", "Throttling responses, by host"),
+    "restore_rate_limiter_errors_total": ("counter", "Connection failures, by host"),
+    "restore_warc_ingest_seconds": ("summary", "Time parsing captures and storing them in the LevelDB"),
+    "restore_leveldb_flush_seconds": ("summary", "LevelDB write batch commit latency"),
+    "restore_leveldb_bytes_written_total": ("counter", "Key and value bytes written to the LevelDB"),
+    "restore_leveldb_paths_total": ("counter", "Paths ingested into the LevelDB"),
+    "restore_leveldb_urls_total": ("counter", "URLs stored in the LevelDB"),
+    "restore_queue_depth": ("gauge", "Items waiting in a pipeline queue, by queue"),
+}
+
+def _family(name):
+    for suffix in ("_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_sample(name, labels, value):
+    """
+    :param name: The sample's name
+    :param labels: A tuple of (label, value) pairs
+    :param value: A number
+    :return: The sample as a line of the Prometheus text format
+    """
+    if labels:
+        name += "{" + ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels) + "}"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        value = int(value)
+    return f"{name} {value}"
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Thread-safe counters and gauges, keyed by name and labels
+        """
+        self.lock = threading.Lock()
+        self.values = {}
+        self.collectors = []
+        self.started = monotonic()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        :param name: The metric name
+        :param value: The amount to add
+        :param labels: The sample's labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set a gauge.
+
+        :param name: The metric name
+        :param value: The new value
+        :param labels: The sample's labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Record one observation of a summary (its _sum and _count).
+
+        :param name: The metric name
+        :param value: The observed value, e.g. a duration in seconds
+        :param labels: The sample's labels
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[(name + "_sum", key)] = self.values.get((name + "_sum", key), 0) + value
+            self.values[(name + "_count", key)] = self.values.get((name + "_count", key), 0) + 1
+
+    def register(self, collector):
+        """
+        :param collector: A callable returning an iterable of (name, labels dict, value), called for each report
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def unregister(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def reset(self):
+        """
+        Forget every value and collector, and restart the run clock
+        """
+        with self.lock:
+            self.values = {}
+            self.collectors = []
+            self.started = monotonic()
+
+    def snapshot(self):
+        """
+        :return: {(name, labels tuple): value} of every sample, collectors included
+        """
+        with self.lock:
+            values = dict(self.values)
+            collectors = list(self.collectors)
+            values[("restore_run_seconds", ())] = monotonic() - self.started
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    values[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                logging.warning(f"Metrics collector {collector} failed: {e}")
+        return values
+
+    def render(self, values=None):
+        """
+        :param values: A snapshot() (a new one if None)
+        :return: The samples in the Prometheus text format
+        """
+        if values is None:
+            values = self.snapshot()
+        families = {}
+        for (name, labels), value in values.items():
+            families.setdefault(_family(name), []).append((name, labels, value))
+        lines = []
+        for family in sorted(families):
+            if family in METRICS:
+                kind, help_text = METRICS[family]
+                lines.append(f"# HELP {family} {help_text}")
+                lines.append(f"# TYPE {family} {kind}")
+            for name, labels, value in sorted(families[family], key=lambda sample: (sample[1], sample[0])):
+                lines.append(format_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set_gauge
+observe = REGISTRY.observe
+register = REGISTRY.register
+unregister = REGISTRY.unregister
+
+def _total(values, name, **match):
+    total = 0
+    for (sample_name, labels), value in values.items():
+        if sample_name == name and all(dict(labels).get(key) == wanted for key, wanted in match.items()):
+            total += value
+    return total
+
+def format_duration(seconds):
+    """
+    :param seconds: A duration
+    :return: It as H:MM:SS
+    """
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class MetricsReporter:
+    def __init__(self, filename=None, interval=DEFAULT_METRICS_INTERVAL, registry=REGISTRY):
+        """
+        Every `interval` seconds, work out the rates and ETAs, write the
+        metrics file, and log a progress line.
+
+        A subdomain's progress is the sum of its restore_captures_total
+        samples other than the transient failures that will be retried,
+        against its restore_subdomain_paths gauge.
+
+        :param filename: The metrics file, replaced atomically each time (None to only log progress)
+        :param interval: Seconds between reports
+        :param registry: The MetricsRegistry to report
+        """
+        self.filename = filename
+        self.interval = interval
+        self.registry = registry
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last = None
+        # {subdomain: deque of (time, paths done)} for the ETA
+        self.progress = {}
+
+    def start(self):
+        """
+        Report in a background thread
+        """
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logging.warning(f"Could not write the metrics: {e}")
+
+    def close(self):
+        """
+        Stop the background thread and write a final report
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+    def report(self):
+        """
+        Write the metrics file and log the progress once
+
+        :return: The snapshot written
+        """
+        values = self.registry.snapshot()
+        now = monotonic()
+        cdx_rows = _total(values, "restore_cdx_rows_total")
+        captures = _total(values, "restore_captures_total")
+        if self.last is not None and now > self.last[0]:
+            elapsed = now - self.last[0]
+            values[("restore_cdx_rows_per_second", ())] = (cdx_rows - self.last[1]) / elapsed
+            values[("restore_captures_per_second", ())] = (captures - self.last[2]) / elapsed
+        self.last = (now, cdx_rows, captures)
+
+        in_progress = []
+        for (name, labels), total in list(values.items()):
+            if name != "restore_subdomain_paths":
+                continue
+            subdomain = dict(labels)['subdomain']
+            done = (_total(values, "restore_captures_total", subdomain=subdomain)
+                    - _total(values, "restore_captures_total", subdomain=subdomain, result="transient"))
+            values[("restore_subdomain_paths_done", labels)] = done
+            eta = self._eta(subdomain, now, done, total)
+            if eta is not None:
+                values[("restore_subdomain_eta_seconds", labels)] = eta
+            if 0 < done < total:
+                in_progress.append((subdomain, done, total, eta))
+
+        if self.filename:
+            tmp_file = self.filename + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as metrics_fd:
+                metrics_fd.write(self.registry.render(values))
+            os.replace(tmp_file, self.filename)
+
+        line = (f"Progress: {values.get(('restore_cdx_rows_per_second', ()), 0.0):.1f} CDX rows/s, "
+                f"{values.get(('restore_captures_per_second', ()), 0.0):.2f} captures/s")
+        for subdomain, done, total, eta in in_progress:
+            line += f"; {subdomain} {done}/{total} paths ({100 * done / total:.1f}%)"
+            if eta is not None:
+                line += f", ETA {format_duration(eta)}"
+        logging.info(line)
+        return values
+
+    def _eta(self, subdomain, now, done, total):
+        samples = self.progress.setdefault(subdomain, deque())
+        if done >= total:
+            return 0.0
+        samples.append((now, done))
+        while len(samples) > 2 and samples[0][0] < now - ETA_WINDOW:
+            samples.popleft()
+        first_time, first_done = samples[0]
+        if now <= first_time or done <= first_done:
+            return None
+        return (total - done) * (now - first_time) / (done - first_done)
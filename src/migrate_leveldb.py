@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Convert an existing cdc_database from per-URL payloads (c-{url}) to
+content-addressed storage (d-{digest} plus a p-{url} pointer), and report
+how much space deduplication saves. It can also train a compression
+dictionary and (re)compress the stored payloads with it, and sweep away the
+chunks and payloads nothing refers to any more.
+"""
+
+import argparse
+import json
+import logging
+from sys import exit
+
+from config_loader import load_config
+from create_leveldb import (
+    WARCLevelDB, CHUNK_PREFIX, CONTENT_PREFIX, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_RECORDS, DIGEST_PREFIX
+)
+from value_codec import parse_manifest
+
+def estimate_dedup(ldb):
+    """
+    Work out what migrating would save, without writing anything.
+
+    :param ldb: An open WARCLevelDB
+    :return: A dict shaped like WARCLevelDB.dedup_report() after a migration
+    """
+    report = ldb.dedup_report()
+    digest_sizes = {}
+    for digest in ldb.digest_db.iterator(include_value=False):
+        digest_sizes[digest] = None
+    stored_bytes = report["stored_bytes"]
+    for _, value in ldb.content_db.iterator():
+        digest = ldb.value_digest(value)
+        stored_bytes -= len(value)
+        if digest not in digest_sizes:
+            digest_sizes[digest] = len(value)
+            stored_bytes += len(value)
+    report.update({
+        "per_url_payloads": 0,
+        "content_addressed_urls": report["urls"],
+        "unique_payloads": len(digest_sizes),
+        "stored_bytes": stored_bytes,
+        "dedup_ratio": report["logical_bytes"] / stored_bytes if stored_bytes else 1.0,
+    })
+    return report
+
+def migrate(ldb):
+    """
+    Move every c-{url} payload to d-{digest}, pointed to by p-{url}.
+    The work is committed in write batches, each URL's pointer together with
+    the deletion of its old copy, so an interrupted migration can simply be
+    run again. Payloads stored in chunks keep their chunks; only the manifest
+    moves. (The chunks of a duplicate are left in place, since other URLs
+    may still point at them until they are migrated too; main() sweeps them
+    with WARCLevelDB.sweep_chunks() once every URL is.)
+
+    :param ldb: A WARCLevelDB opened with content_addressed=True
+    :return: Number of URLs migrated
+    """
+    migrated = 0
+    # The iterator reads from an implicit snapshot, so our own deletes don't disturb it
+    for key, value in ldb.content_db.iterator():
+        if parse_manifest(value):
+            ldb.put_chunked_content([key], value, ldb.value_digest(value), drop_duplicate=False)
+        else:
+            mimetype = ldb.mimetype_db.get(key)
+            ldb.put_content([key], ldb.codec.decode(value), mimetype.decode('utf-8') if mimetype else None)
+        ldb._maybe_flush()
+        migrated += 1
+        if migrated % 10000 == 0:
+            logging.info(f"Migrated {migrated} URLs ({ldb.new_payloads} unique payloads so far)")
+    ldb.flush()
+    return migrated
+
+def recompress(ldb):
+    """
+    Re-encode every stored payload with the DB's current codec and dictionary.
+    Payloads stored per URL are compressed according to their mimetype;
+    content-addressed ones and chunks have no mimetype of their own, so they
+    are kept compressed only where that actually makes them smaller.
+
+    :param ldb: A WARCLevelDB opened with the compression to apply
+    :return: Number of values rewritten
+    """
+    rewritten = 0
+    keyspaces = ((CONTENT_PREFIX, ldb.content_db), (DIGEST_PREFIX, ldb.digest_db), (CHUNK_PREFIX, ldb.chunk_db))
+    for prefix, keyspace in keyspaces:
+        for key, value in keyspace.iterator():
+            if parse_manifest(value):
+                continue
+            mimetype = ldb.mimetype_db.get(key) if prefix == CONTENT_PREFIX else None
+            payload = ldb.codec.decode(value)
+            encoded = ldb._encode(payload, mimetype.decode('utf-8') if mimetype else None)
+            if encoded == value:
+                continue
+            ldb.put(prefix, key, encoded)
+            ldb._maybe_flush()
+            rewritten += 1
+    ldb.flush()
+    return rewritten
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the LevelDB to content-addressed payload storage")
+    parser.add_argument(
+        "--run_mode",
+        choices=["dev", "prod"],
+        default="dev",
+        help="Specify the run mode: 'dev' or 'prod'"
+    )
+    parser.add_argument("--db_folder", help="Folder holding cdc_database (defaults to the config's db_folder)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what the migration would save")
+    parser.add_argument("--report", action="store_true", help="Only report the current dedup ratio")
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Only delete the chunks and content-addressed payloads nothing refers to any more"
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["zstd", "zlib", "none"],
+        help="Recompress the stored payloads with this codec instead of migrating "
+             "(migrations use the config's db_compression)"
+    )
+    parser.add_argument(
+        "--train-dictionary",
+        action="store_true",
+        help="With --compress, train a dictionary on the stored text payloads first"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    db_folder = args.db_folder
+    compression = args.compress
+    if not db_folder:
+        config = load_config()
+        if args.run_mode not in config:
+            logging.error(f"run_mode '{args.run_mode}' not found in config.yaml")
+            exit(1)
+        selected_config = config[args.run_mode]
+        db_folder = selected_config['db_folder']
+        if compression is None:
+            compression = selected_config.get('db_compression')
+
+    ldb = WARCLevelDB(
+        db_folder,
+        batch_records=DEFAULT_BATCH_RECORDS,
+        batch_bytes=DEFAULT_BATCH_BYTES,
+        content_addressed=True,
+        compression=None if compression == "none" else compression
+    )
+    try:
+        if args.report:
+            report = ldb.dedup_report()
+        elif args.dry_run:
+            report = estimate_dedup(ldb)
+        elif args.sweep:
+            swept = ldb.sweep_chunks()
+            report = dict(ldb.dedup_report(), swept=swept)
+        elif args.compress:
+            if args.train_dictionary and args.compress != "none":
+                ldb.train_dictionary()
+            rewritten = recompress(ldb)
+            logging.info(f"Recompressed {rewritten} payloads")
+            report = ldb.dedup_report()
+        else:
+            migrated = migrate(ldb)
+            logging.info(f"Migrated {migrated} URLs: {ldb.new_payloads} new payloads, "
+                         f"{ldb.duplicate_payloads} duplicates")
+            swept = ldb.sweep_chunks()
+            report = dict(ldb.dedup_report(), swept=swept)
+    finally:
+        ldb.close()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
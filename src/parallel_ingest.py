@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Re-ingest the WARC files already downloaded into the LevelDB, using a pool
+of processes to decompress and parse them.
+
+The WARCs to ingest are the ones recorded in each subdomain's fetched state,
+or, with --from-cdxj, the ones the CDXJ indexes of the rolling WARC files list.
+Worker processes parse batches of them into (urls, payload, mimetype,
+timestamp) records; this process is the only one that opens the plyvel.DB,
+and writes the records as they come back, in order, through the usual
+write batches.
+
+Parsing in parallel only pays off with several CPUs to run the workers on:
+with fewer than two workers the files are ingested serially, in this
+process, as the pipeline does.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+from collections import deque
+from sys import exit
+from time import time
+from urllib.parse import urlparse
+
+from clean_urlkey import find_state_file, iter_state_file, read_urls_from_csv
+from config_loader import load_config
+from create_leveldb import (
+    WARCLevelDB, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_RECORDS, DEFAULT_BATCH_SECONDS,
+    DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_THRESHOLD, iter_warc_payloads, open_capture
+)
+from fetch_journal import FetchJournal
+from warc_store import load_cdxj_index
+
+# WARC files handed to a worker at a time
+DEFAULT_BATCH_FILES = 32
+
+_max_payload = DEFAULT_CHUNK_THRESHOLD
+
+def _init_worker(max_payload):
+    global _max_payload
+    _max_payload = max_payload
+    logging.getLogger().setLevel(logging.WARNING)
+
+def parse_warc_batch(batch):
+    """
+    Parse a batch of WARC files. Runs in a worker process.
+    Payloads longer than the chunking threshold aren't sent back; they are
+    marked with a None payload, and the writer streams them from the file itself.
+
+    :param batch: A list of (subdomain, url_data)
+    :return: A list of (subdomain, url_data, records, error), where records
+             is a list of (uri, content_type, payload)
+    """
+    parsed = []
+    for subdomain, url_data in batch:
+        records = []
+        error = None
+        stream = None
+        try:
+            stream, max_records = open_capture(url_data['fetched'])
+            if stream is not None:
+                for uri, content_type, payload, _ in iter_warc_payloads(stream, _max_payload, max_records):
+                    if len(payload) > _max_payload:
+                        payload = None
+                    records.append((uri, content_type, payload))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            if stream is not None:
+                stream.close()
+        parsed.append((subdomain, url_data, records, error))
+    return parsed
+
+def iter_parsed(pool, batches, max_pending):
+    """
+    Submit batches to the pool, keeping at most `max_pending` in flight, and
+    yield their results in submission order.
+
+    :param pool: A multiprocessing.Pool
+    :param batches: An iterable of batches for parse_warc_batch()
+    :param max_pending: Maximum number of batches submitted but not yet consumed
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(parse_warc_batch, (batch,)))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ingest_parallel(ldb, jobs, workers=None, batch_files=DEFAULT_BATCH_FILES, max_pending=None, reingest=False):
+    """
+    Ingest WARC files into the LevelDB, parsing them in a process pool.
+    Files whose capture the ingest ledger already holds are skipped, unless `reingest` is set.
+
+    :param ldb: The WARCLevelDB to write to; only this process writes to it
+    :param jobs: An iterable of (subdomain, url_data) with url_data['fetched']['file'] set
+    :param workers: Number of parsing processes (the number of CPUs if None); with
+                    fewer than two, the files are parsed serially in this process
+    :param batch_files: WARC files per batch handed to a worker
+    :param max_pending: Batches in flight at once (twice the workers if None)
+    :param reingest: Ingest files even if the ingest ledger has them
+    :return: A dict with the number of files ingested, failed, streamed by the writer, and skipped
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    stats = {"files": 0, "failed": 0, "streamed": 0, "skipped": 0}
+    if not reingest:
+        jobs = _skip_ingested(ldb, jobs, stats)
+    if workers < 2:
+        # A single worker only adds pickling and a process hop to a serial ingest
+        for subdomain, url_data in jobs:
+            stats["files"] += 1
+            try:
+                ldb.process_url(subdomain, url_data)
+            except Exception as e:
+                stats["failed"] += 1
+                logging.warning(f"Could not parse {url_data['fetched']['file']}: {type(e).__name__}: {e}")
+        ldb.flush()
+        return stats
+    # Spawned rather than forked, so no worker inherits a copy of the open plyvel handle
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(ldb.chunk_threshold,)) as pool:
+        for subdomain, url_data, records, error in iter_parsed(pool, batched(jobs, batch_files), max_pending):
+            stats["files"] += 1
+            if error:
+                stats["failed"] += 1
+                logging.warning(f"Could not parse {url_data['fetched']['file']}: {error}")
+                continue
+            if any(payload is None for _, _, payload in records):
+                # Too large to ship between processes; stream it into chunks here
+                stats["streamed"] += 1
+                ldb.process_url(subdomain, url_data)
+                continue
+            ldb.store_parsed(subdomain, url_data, records)
+            if stats["files"] % 10000 == 0:
+                logging.info(f"Ingested {stats['files']} WARC files")
+    ldb.flush()
+    return stats
+
+def _skip_ingested(ldb, jobs, stats):
+    for subdomain, url_data in jobs:
+        if ldb.is_ingested(subdomain, url_data):
+            stats["skipped"] += 1
+            continue
+        yield subdomain, url_data
+
+def iter_ingest_jobs(state_folder, subdomains, cdxj_index=None):
+    """
+    The downloaded WARC files of each subdomain, from its url_list and fetched state files.
+
+    :param state_folder: The pipeline's state folder
+    :param subdomains: Subdomains or subdomain URLs, as listed in the CSV file
+    :param cdxj_index: Locate captures with this load_cdxj_index() result instead of the fetched state
+    :return: A generator of (subdomain, url_data)
+    """
+    for sdomain in subdomains:
+        parsed_url = urlparse(sdomain)
+        netloc = parsed_url.netloc or parsed_url.path
+        state_file = find_state_file(state_folder, netloc)
+        if state_file is None:
+            logging.warning(f"No url_list state file for {netloc}; skipping it")
+            continue
+        fetched_state = None
+        if cdxj_index is None:
+            fetched_state = FetchJournal(state_folder, netloc, read_only=True)
+        for url_data in iter_state_file(state_file):
+            if fetched_state is not None:
+                result = fetched_state.get(url_data['path'])
+            else:
+                result = None
+                found = cdxj_index.get((netloc, url_data['path']))
+                if found is not None and found[0] == url_data['timestamp']:
+                    entry = found[1]
+                    result = {"file": entry['filename'], "offset": entry['offset'],
+                              "length": entry['length'], "issues": False}
+            if result is None or result['issues'] or not result['file']:
+                continue
+            url_data['fetched'] = result
+            yield netloc, url_data
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-ingest downloaded WARC files with a process pool")
+    parser.add_argument(
+        "--run_mode",
+        choices=["dev", "prod"],
+        default="dev",
+        help="Specify the run mode: 'dev' or 'prod'"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Parsing processes (default: one per CPU)")
+    parser.add_argument("--batch-files", type=int, default=DEFAULT_BATCH_FILES, help="WARC files per worker task")
+    parser.add_argument(
+        "--from-cdxj",
+        action="store_true",
+        help="Find the captures through the CDXJ indexes in warc_folder instead of the fetched state"
+    )
+    parser.add_argument("--reingest", action="store_true", help="Ingest files the ingest ledger already has")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
+    )
+
+    config = load_config()
+    if args.run_mode not in config:
+        logging.error(f"run_mode '{args.run_mode}' not found in config.yaml")
+        exit(1)
+    selected_config = config[args.run_mode]
+
+    start_time = time()
+    ldb = WARCLevelDB(
+        selected_config['db_folder'],
+        batch_records=selected_config.get('db_batch_records', DEFAULT_BATCH_RECORDS),
+        batch_bytes=selected_config.get('db_batch_bytes', DEFAULT_BATCH_BYTES),
+        batch_seconds=selected_config.get('db_batch_seconds', DEFAULT_BATCH_SECONDS),
+        content_addressed=selected_config.get('db_content_addressed', False),
+        compression=selected_config.get('db_compression'),
+        compression_level=selected_config.get('db_compression_level'),
+        chunk_threshold=selected_config.get('db_chunk_threshold', DEFAULT_CHUNK_THRESHOLD),
+        chunk_size=selected_config.get('db_chunk_size', DEFAULT_CHUNK_SIZE)
+    )
+    subdomains = read_urls_from_csv(selected_config['csv_file'])
+    cdxj_index = None
+    if args.from_cdxj:
+        cdxj_index = load_cdxj_index(selected_config['warc_folder'])
+        logging.info(f"Loaded the CDXJ index of {len(cdxj_index)} captures")
+    jobs = iter_ingest_jobs(selected_config['state_folder'], subdomains, cdxj_index)
+    try:
+        stats = ingest_parallel(ldb, jobs, args.workers, args.batch_files, reingest=args.reingest)
+    finally:
+        ldb.close()
+
+    duration = time() - start_time
+    logging.info(f"Ingested {stats['files']} WARC files ({stats['failed']} failed, "
+                 f"{stats['streamed']} streamed in chunks, {stats['skipped']} already ingested) "
+                 f"for {ldb.total_url} URLs in {duration:.2f} seconds")
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,29 @@ from pathlib import Path
 from sys import exit
 from time import time
 
-from clean_urlkey import detect_urlkeys_from_subdomains, read_urls_from_csv
+from clean_urlkey import (
+    iter_subdomain_urlkeys, read_urls_from_csv,
+    DEFAULT_CDX_FROM, DEFAULT_CDX_PAGE_SIZE, DEFAULT_CDX_TO, DEFAULT_CDX_URL
+)
 from config_loader import load_config
-from retrieve_snapshot import process_cdc_urls
-from create_leveldb import WARCLevelDB
+from retrieve_snapshot import (
+    process_cdc_urls, DEFAULT_REQUESTS_PER_SECOND, DEFAULT_TRANSIENT_RETRIES, DEFAULT_WAYBACK_URL,
+    TRANSIENT_BACKOFF_SECONDS
+)
+from create_leveldb import (
+    WARCLevelDB, DEFAULT_BATCH_BYTES, DEFAULT_BATCH_RECORDS, DEFAULT_BATCH_SECONDS,
+    DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_THRESHOLD
+)
+from fetch_journal import DEFAULT_FSYNC_EVERY, DEFAULT_FSYNC_INTERVAL
+from http_client import (
+    HTTPClient, DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE, DEFAULT_READ_TIMEOUT
+)
+import metrics
+from metrics import DEFAULT_METRICS_INTERVAL, MetricsReporter
+from profiler import PROFILE_MODES, DEFAULT_SAMPLE_INTERVAL, RunProfiler
+from rate_limit import HostRateLimiter
+from scheduler import DownloadScheduler, prefetch
+from warc_store import DEFAULT_WARC_ROLLING_BYTES
 
 # Logging directory setup
 LOG_DIR = Path("../logs")
@@ -19,7 +38,7 @@ if not LOG_DIR.exists():
 
 # Configure logging: logs to both console and a file
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(funcName)s - %(message)s",
     handlers=[
         logging.StreamHandler(),
@@ -27,6 +46,29 @@ logging.basicConfig(
     ]
 )
 
+def run_collector(limiter, client, ldb, scheduler):
+    """
+    :return: A metrics collector reading the counters the run's shared objects keep
+    """
+    def collect():
+        for host, state in limiter.state().items():
+            yield "restore_rate_limiter_rate", {"host": host}, state['rate']
+            yield "restore_rate_limiter_wait_seconds_total", {"host": host}, state['wait_time']
+            yield "restore_rate_limiter_throttled_total", {"host": host}, state['throttled']
+            yield "restore_rate_limiter_errors_total", {"host": host}, state['errors']
+        client_stats = client.stats()
+        yield "restore_http_requests_total", {}, client_stats['requests']
+        yield "restore_http_connections", {}, client_stats['connections']
+        yield "restore_warc_ingest_seconds_sum", {}, ldb.ingest_time
+        yield "restore_warc_ingest_seconds_count", {}, ldb.ingest_count
+        yield "restore_leveldb_flush_seconds_sum", {}, ldb.flush_time
+        yield "restore_leveldb_flush_seconds_count", {}, ldb.flush_count
+        yield "restore_leveldb_bytes_written_total", {}, ldb.bytes_written
+        yield "restore_leveldb_paths_total", {}, ldb.total_path
+        yield "restore_leveldb_urls_total", {}, ldb.total_url
+        yield "restore_queue_depth", {"queue": "downloads"}, scheduler.pending
+    return collect
+
 def main():
     parser = argparse.ArgumentParser(description="Select run mode for configuration")
     parser.add_argument(
@@ -35,21 +77,39 @@ def main():
         default="dev",
         help="Specify the run mode: 'dev' or 'prod'"
     )
+    parser.add_argument("--config", default="../run_config.yaml", help="The configuration file")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
     parser.add_argument("--retry", action="store_true", help="Retry previously failed URLs")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Query the CDX API for captures newer than the existing url_list state files"
+    )
+    parser.add_argument(
+        "--reingest",
+        action="store_true",
+        help="Ingest every fetched WARC again, even those already in the LevelDB"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        default=None,
+        help="Profile the run: 'cprofile' (main thread) or 'sample' (stack samples of every thread); "
+             f"the profile is written to {LOG_DIR}"
+    )
     args = parser.parse_args()
 
     # Then set log level dynamically:
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.getLogger().setLevel(log_level)
 
-    config = load_config()
+    config = load_config(args.config)
     
     if args.run_mode in config:
         selected_config = config[args.run_mode]
         logging.info(f"Running in {args.run_mode} mode with config: {selected_config}")
     else:
-        logging.error(f"run_mode '{args.run_mode}' not found in config.yaml")
+        logging.error(f"run_mode '{args.run_mode}' not found in {args.config}")
         exit(1)
 
     required_keys = [
@@ -78,23 +138,100 @@ def main():
         folder.mkdir(mode=0o755, parents=True)
 
     start_time = time()
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(args.profile, LOG_DIR,
+                               selected_config.get('profile_sample_interval', DEFAULT_SAMPLE_INTERVAL))
+        profiler.start()
+
+    # One limiter for the whole run, so CDX queries and capture downloads
+    # to web.archive.org share (and adapt) the same budget. It never speeds
+    # up past requests_per_second unless max_requests_per_second says so.
+    requests_per_second = selected_config.get('requests_per_second', DEFAULT_REQUESTS_PER_SECOND)
+    max_requests_per_second = selected_config.get('max_requests_per_second')
+    if max_requests_per_second and max_requests_per_second > DEFAULT_REQUESTS_PER_SECOND:
+        logging.warning(f"max_requests_per_second is {max_requests_per_second}, above the documented "
+                        f"Wayback Machine limit of {DEFAULT_REQUESTS_PER_SECOND} requests per second")
+    limiter = HostRateLimiter(
+        requests_per_second,
+        selected_config.get('request_burst', 1),
+        min_rate=selected_config.get('min_requests_per_second'),
+        max_rate=max_requests_per_second
+    )
+    client = HTTPClient(
+        limiter,
+        pool_connections=selected_config.get('http_pool_connections', DEFAULT_POOL_CONNECTIONS),
+        pool_maxsize=selected_config.get('http_pool_maxsize', DEFAULT_POOL_MAXSIZE),
+        connect_timeout=selected_config.get('http_connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=selected_config.get('http_read_timeout', DEFAULT_READ_TIMEOUT),
+        compression=selected_config.get('http_compression', True)
+    )
 
     subdomains = read_urls_from_csv(selected_config['csv_file'])
-    url_list = detect_urlkeys_from_subdomains(selected_config['state_folder'], subdomains)
+    # enumerate + dedup -> fetch -> ingest: each subdomain's URL list is
+    # streamed from its state file as it is fetched, and the next subdomain
+    # is enumerated meanwhile, at most `enumerate_ahead` subdomains ahead.
+    url_lists = iter_subdomain_urlkeys(
+        selected_config['state_folder'],
+        subdomains,
+        client,
+        cdx_url=selected_config.get('cdx_url', DEFAULT_CDX_URL),
+        page_size=selected_config.get('cdx_page_size', DEFAULT_CDX_PAGE_SIZE),
+        refresh=args.refresh,
+        ts_from=str(selected_config.get('cdx_from', DEFAULT_CDX_FROM)),
+        ts_to=str(selected_config.get('cdx_to', DEFAULT_CDX_TO)),
+        url_list_format=selected_config.get('url_list_format', "jsonl")
+    )
+    url_lists = prefetch(url_lists, selected_config.get('enumerate_ahead', 1))
 
     logging.info("Starting create_db")
-    ldb = WARCLevelDB(selected_config['db_folder'])
+    ldb = WARCLevelDB(
+        selected_config['db_folder'],
+        batch_records=selected_config.get('db_batch_records', DEFAULT_BATCH_RECORDS),
+        batch_bytes=selected_config.get('db_batch_bytes', DEFAULT_BATCH_BYTES),
+        batch_seconds=selected_config.get('db_batch_seconds', DEFAULT_BATCH_SECONDS),
+        content_addressed=selected_config.get('db_content_addressed', False),
+        compression=selected_config.get('db_compression'),
+        compression_level=selected_config.get('db_compression_level'),
+        chunk_threshold=selected_config.get('db_chunk_threshold', DEFAULT_CHUNK_THRESHOLD),
+        chunk_size=selected_config.get('db_chunk_size', DEFAULT_CHUNK_SIZE)
+    )
+
+    scheduler = DownloadScheduler(max_workers=selected_config.get('download_workers', 1))
+
+    # Stage metrics, written out periodically, and a progress line with an ETA per subdomain
+    metrics.register(run_collector(limiter, client, ldb, scheduler))
+    reporter = MetricsReporter(
+        selected_config.get('metrics_file'),
+        selected_config.get('metrics_interval', DEFAULT_METRICS_INTERVAL)
+    )
+    reporter.start()
 
     logging.info("Starting process_cdc_urls")
-    failed_urls, url_list_plus = process_cdc_urls(
+    failed_urls = process_cdc_urls(
         selected_config['state_folder'],
         selected_config['warc_folder'],
         selected_config['track_failed_urls'],
         args.retry,
         selected_config['failed_url_list'],
-        url_list,
-        ldb
+        url_lists,
+        ldb,
+        scheduler=scheduler,
+        client=client,
+        wayback_url=selected_config.get('wayback_url', DEFAULT_WAYBACK_URL),
+        transient_retries=selected_config.get('transient_retries', DEFAULT_TRANSIENT_RETRIES),
+        transient_backoff=selected_config.get('transient_backoff', TRANSIENT_BACKOFF_SECONDS),
+        journal_fsync_every=selected_config.get('journal_fsync_every', DEFAULT_FSYNC_EVERY),
+        journal_fsync_interval=selected_config.get('journal_fsync_interval', DEFAULT_FSYNC_INTERVAL),
+        reingest=args.reingest,
+        warc_rolling_bytes=selected_config.get('warc_rolling_bytes', DEFAULT_WARC_ROLLING_BYTES),
+        fetch_mode=selected_config.get('fetch_mode', "warc"),
+        skip_known_digests=selected_config.get('skip_known_digests', True)
     )
+    scheduler.close()
+    logging.info(f"Rate limiter state: {limiter.state()}")
+    logging.info(f"HTTP connections: {client.stats()}")
+    client.close()
 
     if selected_config.get("track_failed_urls") and len(failed_urls) > 0:
         with open(selected_config["failed_url_list"], "w") as f:
@@ -103,7 +240,19 @@ def main():
         logging.info(f"Saved failed URLs to {selected_config['failed_url_list']}")
 
     ldb.close()
+    reporter.close()
+    if profiler is not None:
+        profiler.stop()
     logging.info(f"Inserted {ldb.total_path} paths into the LevelDB, for {ldb.total_url} URL variations")
+    logging.info(f"LevelDB write batches: {ldb.flush_count} flushes in {ldb.flush_time:.2f} seconds")
+    if ldb.codec.codec:
+        logging.info(f"Compressed payloads: {ldb.payload_bytes} bytes stored as {ldb.stored_payload_bytes}")
+    if ldb.chunked_payloads:
+        logging.info(f"Stored {ldb.chunked_payloads} large payloads in {ldb.chunk_size} byte chunks")
+    if ldb.copied_captures:
+        logging.info(f"Copied {ldb.copied_captures} captures from stored payloads with the same CDX digest")
+    if ldb.content_addressed:
+        logging.info(f"Content-addressed payloads: {ldb.new_payloads} stored, {ldb.duplicate_payloads} deduplicated")
     
     duration = time() - start_time
     logging.info(f"Script completed in {duration:.2f} seconds")
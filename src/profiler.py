@@ -0,0 +1,131 @@
+"""
+Optional profiling of a whole run.
+
+"cprofile" runs the standard deterministic profiler, which only sees the
+thread it is started on (the pipeline's main thread: enumeration hand-off,
+journaling and ingest). "sample" takes a stack sample of every thread at a
+fixed interval instead, so the download workers and background writers
+show up too, at a small and constant cost; the samples are written in the
+folded format that flamegraph.pl and speedscope read.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from time import strftime
+
+PROFILE_MODES = ("cprofile", "sample")
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+class StackSampler:
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        Samples the stacks of every other thread every `interval` seconds.
+
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.labels = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, filename):
+        """
+        :param filename: Where to write the samples, one folded stack and its count per line
+        """
+        with open(filename, "w", encoding="utf-8") as folded_fd:
+            for stack, count in self.stacks.most_common():
+                folded_fd.write(f"{stack} {count}\n")
+
+    def top(self, limit=20):
+        """
+        :param limit: Number of functions to list
+        :return: [(function, samples it was running in)] of the functions most often on top of a stack
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+class RunProfiler:
+    def __init__(self, mode, folder, interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        :param mode: One of PROFILE_MODES
+        :param folder: Folder to write the profile to
+        :param interval: Seconds between stack samples, in "sample" mode
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.folder = folder
+        self.interval = interval
+        self.profiler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = StackSampler(self.interval)
+            self.profiler.start()
+
+    def stop(self):
+        """
+        Stop profiling, write the profile, and log its hottest functions
+
+        :return: The profile file
+        """
+        name = f"profile.{strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            filename = os.path.join(self.folder, name + ".prof")
+            self.profiler.dump_stats(filename)
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats("cumulative").print_stats(25)
+            logging.info(f"Profile written to {filename} (read it with python -m pstats):\n{summary.getvalue()}")
+            return filename
+        self.profiler.stop()
+        filename = os.path.join(self.folder, name + ".folded")
+        self.profiler.write(filename)
+        top = "\n".join(f"{count:8d} {function}" for function, count in self.profiler.top())
+        logging.info(f"{self.profiler.samples} stack samples written to {filename}; "
+                     f"functions most often running:\n{top}")
+        return filename
@@ -0,0 +1,262 @@
+"""
+Rate limiting primitives used to pace requests to the Wayback Machine.
+"""
+
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+# Status codes that mean "slow down" or "temporarily unavailable"
+THROTTLE_STATUS_CODES = {429, 500, 502, 503, 504, 509}
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header, which is either a number of seconds or an HTTP date.
+
+    :param value: The header value, or None
+    :return: The number of seconds to wait, or None if it couldn't be parsed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class TransientFetchError(Exception):
+    """
+    A request failed in a way that is expected to go away (throttling,
+    a temporary outage, a dropped connection), as opposed to a 404.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        """
+        A thread-safe token bucket. Tokens refill continuously at `rate`
+        per second, up to `burst` tokens.
+
+        :param rate: Number of requests per second to allow on average
+        :param burst: Number of requests that may start back-to-back
+        """
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def set_rate(self, rate):
+        """
+        Change the refill rate; tokens already accrued are kept.
+
+        :param rate: The new number of requests per second
+        """
+        with self.lock:
+            self._refill(monotonic())
+            self.rate = float(rate)
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the next `seconds` seconds, e.g. to honour a Retry-After.
+
+        :param seconds: How long to pause for
+        """
+        with self.lock:
+            now = monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            # Don't let a burst build up while paused
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = max(self.updated, self.paused_until)
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it.
+
+        :return: The number of seconds spent waiting for the token
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return waited
+                    delay = (1.0 - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+class AdaptiveRateController:
+    def __init__(self, bucket, min_rate, max_rate, increase=0.01, decrease=0.5, window=100):
+        """
+        Additive-increase/multiplicative-decrease control of a TokenBucket's rate.
+        Every healthy response raises the rate by `increase` requests per second,
+        and every throttling response multiplies it by `decrease`.
+
+        :param bucket: The TokenBucket to steer
+        :param min_rate: The rate never drops below this
+        :param max_rate: The rate never rises above this
+        :param increase: Requests per second added after each healthy response
+        :param decrease: Factor the rate is multiplied by after a throttling response
+        :param window: Number of recent responses used for the error ratio
+        """
+        self.bucket = bucket
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max(max_rate, min_rate))
+        self.increase = increase
+        self.decrease = decrease
+        self.outcomes = deque(maxlen=window)
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        waited = self.bucket.acquire()
+        with self.lock:
+            self.wait_time += waited
+        return waited
+
+    def on_success(self):
+        """
+        Record a healthy response and speed up a little
+        """
+        with self.lock:
+            self.successes += 1
+            self.outcomes.append(False)
+            rate = min(self.max_rate, self.bucket.rate + self.increase)
+        self.bucket.set_rate(rate)
+
+    def on_throttle(self, retry_after=None):
+        """
+        Record a 429/503-style response and back off
+
+        :param retry_after: Seconds the server asked us to wait, if it said
+        """
+        with self.lock:
+            self.throttled += 1
+        self._back_off()
+        if retry_after:
+            self.bucket.pause(retry_after)
+
+    def on_error(self):
+        """
+        Record a connection-level failure (timeout, reset) and back off
+        """
+        with self.lock:
+            self.errors += 1
+        self._back_off()
+
+    def _back_off(self):
+        # The rate decrease shared by throttles and errors, each of which keeps its own count
+        with self.lock:
+            self.outcomes.append(True)
+            rate = max(self.min_rate, self.bucket.rate * self.decrease)
+        self.bucket.set_rate(rate)
+
+    def state(self):
+        """
+        :return: A dict describing the current rate and recent error ratio
+        """
+        with self.lock:
+            error_ratio = sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+            return {
+                "rate": self.bucket.rate,
+                "min_rate": self.min_rate,
+                "max_rate": self.max_rate,
+                "error_ratio": error_ratio,
+                "successes": self.successes,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "paused_for": max(0.0, self.bucket.paused_until - monotonic()),
+                "wait_time": self.wait_time,
+            }
+
+class HostRateLimiter:
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None):
+        """
+        Keeps one adaptively-controlled TokenBucket per hostname, all starting
+        with the same budget. With the default `min_rate`/`max_rate` the rate
+        only moves down on throttling and recovers back to `rate`.
+
+        :param rate: Initial requests per second allowed for each host
+        :param burst: Burst size allowed for each host
+        :param min_rate: Lowest rate to back off to (defaults to rate / 20)
+        :param max_rate: Highest rate to speed up to (defaults to rate)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate is not None else rate / 20
+        self.max_rate = max_rate if max_rate is not None else rate
+        # Speed up by 2% of the starting rate per healthy response
+        self.increase = max(0.01, rate * 0.02)
+        self.controllers = {}
+        self.lock = threading.Lock()
+
+    def controller(self, url):
+        """
+        :param url: A full URL or a bare hostname
+        :return: The AdaptiveRateController responsible for the host of that URL
+        """
+        host = urlparse(url).hostname or url
+        with self.lock:
+            if host not in self.controllers:
+                self.controllers[host] = AdaptiveRateController(
+                    TokenBucket(self.rate, self.burst), self.min_rate, self.max_rate, self.increase
+                )
+            return self.controllers[host]
+
+    def acquire(self, url):
+        """
+        Block until the host of `url` has budget for one more request.
+
+        :param url: The URL that is about to be requested
+        :return: The number of seconds spent waiting
+        """
+        return self.controller(url).acquire()
+
+    def record(self, url, status_code, retry_after=None):
+        """
+        Feed the outcome of a request back to its host's controller.
+
+        :param url: The URL that was requested
+        :param status_code: The HTTP status code, or None for a connection failure
+        :param retry_after: The parsed Retry-After header, if any
+        """
+        controller = self.controller(url)
+        if status_code is None:
+            controller.on_error()
+        elif status_code in THROTTLE_STATUS_CODES:
+            controller.on_throttle(retry_after)
+        else:
+            controller.on_success()
+
+    def state(self):
+        """
+        :return: A dict of {hostname: controller state}
+        """
+        with self.lock:
+            controllers = dict(self.controllers)
+        return {host: controller.state() for host, controller in controllers.items()}
@@ -1,170 +1,491 @@
-# Standard library imports
-import copy
-import json
-import logging
-import os
-
-import urllib.parse
-
-# ======================================================================
-# Monkey patching the urllib.parse.quote() function (as an alternative
-# to completely rewriting the fetch_warc_record() function, which I'd
-# like to avoid).
-
-orig_quote = urllib.parse.quote
-
-def customized_quote(url):
-    """
-    If there is a "?" in the URL, only quote what follows after it.
-
-    :param url: a URL path
-    :return: the URL path, appropriately quoted for use with warc.py functions
-    """
-    offset1 = url.find("?")
-    if offset1 == -1:
-        return url
-    pre_q  = url[:offset1+1]
-    post_q = url[offset1+1:]
-
-    # Experiment:
-    return pre_q + orig_quote(post_q)
-
-urllib.parse.quote = customized_quote
-
-# Done with the monkey patching.
-# ======================================================================
-
-# Third-party imports
-import cdx_toolkit
-
-# The documented rate limit is 15 requests per minute, so in theory
-# this should keep us on track for that.
-#
-# https://archive.org/details/toomanyrequests_20191110
-cdx_toolkit.myrequests.retry_info['web.archive.org']['minimum_interval'] = 4.0
-
-# The one thing slowing this down right now is the retry_info settings
-# in cdx_toolkit/myrequests.py which prescribe a minimum interval of 6
-# seconds between requests. A sensible interval, but it means several
-# subdomains are going to take quite some time to collect.
-def download_warc_cdx_toolkit(subdomain, url_data, warc_save_path):
-    """
-    Adapted from example: https://github.com/cocrawler/cdx_toolkit/blob/main/examples/iter-and-warc.py
-    :param url: a URL to find WARC
-    :param best_timestamp: a datetime used to find WARC
-    :param warc_save_path: a path where the WARC will be saved
-    :return: the .warc(.gz) file name, and a flag indicating if we noticed any problems
-    """
-    url = url_data['original']
-    timestamp = url_data['timestamp']
-    warc_file = None
-    logging.debug(f"Attempting to download warc for {url}")
-    cdx = cdx_toolkit.CDXFetcher(source="ia")
-    warcinfo = {
-        "software": "pypi_cdx_toolkit iter-and-warc example",
-        "isPartOf": "CDC", 
-        "description": "warc extraction",
-        "format": "WARC file version 1.0",
-    }
-
-    #logging.debug(f"$warc_save_path: {warc_save_path}")
-
-    writer = cdx_toolkit.warc.get_writer(
-        warc_save_path, "", warcinfo
-    )
-
-    # Copying the 'wb' value that cdx_toolkit.CDXFetcher.__init__()
-    # sets for source="ia":
-    data = copy.deepcopy(url_data)
-    data['url'] = f"https://{subdomain}{data['path']}"
-    # del data['path']
-    # del data['original']
-    data['status'] = data['statuscode']
-    # del data['statuscode']
-    data['mime'] = data['mimetype']
-    # del data['statuscode']
-    obj = cdx_toolkit.CaptureObject(data, wb='https://web.archive.org/web')
-
-    try:
-        record = obj.fetch_warc_record()
-    except RuntimeError:
-        logging.debug("Skipping capture for RuntimeError 404: %s %s", url, timestamp)
-        return None, True
-
-    writer.write_record(record)
-    warc_file = writer.filename
-    logging.info(f"********SUCCESS!********** Wrote warc for {url} at {warc_file}")
-    return warc_file, False
-
-def process_cdc_urls(state_folder, base_dir, track_failed_urls, retry_failed_urls, failed_urls, subdomains, ldb):
-    """
-    Process a list of URLs, download the closest WARC snapshot, and extract resources.
-    :param state_folder: Folder in which to track/cache the URLs we've already processed before
-    :param base_dir: a file location to save the WARC
-    :param track_failed_urls: flag to indicate whether to track failed URLs
-    :param retry_failed_urls: flag to indicate whether to retry previously failed URLs
-    :param failed_urls: a file where failed URLs are logged
-    :param subdomains: a nested list of subdomains and paths to use to find WARC archives
-    :param ldb: a WARCLevelDB instance; to give process_url() calls as we go
-    :return: a list of failed URLs, plus an extended version of the subdomains structure
-    """
-
-    failed_urls = []
-
-    url_list_plus = {}
-
-    for subdomain, paths in subdomains.items():
-        url_list_plus[subdomain] = []
-        fetched_file = f"{state_folder}/fetched.{subdomain}.json"
-        if os.path.exists(fetched_file):
-            with open(fetched_file, "r", encoding="utf-8") as fetched_fd:
-                fetched_state = json.load(fetched_fd)
-                fetched_fd.close()
-        else:
-            fetched_state = {}
-        for url_data in paths:
-            path = url_data['path']
-            timestamp = url_data['timestamp']
-            url = os.path.join(subdomain + path)  
-            if path in fetched_state:
-                logging.info(f"Previous result for {path}: {fetched_state[path]}")
-                if fetched_state[path]['issues'] and retry_failed_urls:
-                    logging.info("Retrying this URL...")
-                else:
-                    if fetched_state[path]['issues'] and track_failed_urls:
-                        failed_urls.append(url)
-                    url_data = copy.deepcopy(url_data)
-                    url_data['fetched'] = fetched_state[path]
-                    url_list_plus[subdomain].append(url_data)
-                    if ldb and not fetched_state[path]['issues'] and fetched_state[path]['file']:
-                        ldb.process_url(subdomain, url_data)
-                    continue
-
-            logging.info(f"========== Processing URL: {url} [{timestamp}] ==========")
-
-            # Define the prefix for saving the WARC segments
-            warc_filename = (
-                url.replace("/", "_") 
-            )
-
-            warc_save_path = os.path.join(base_dir, warc_filename)[:150]# need to truncate to avoid 
-                                                        # filename length errors
-                                                        # doesnt affect actual URL
-
-            warc_file, issues = download_warc_cdx_toolkit(subdomain, url_data, warc_save_path)
-            fetched_state[path] = { "file": warc_file, "issues": issues }
-            if issues and track_failed_urls:
-                failed_urls.append(url)
-
-            url_data = copy.deepcopy(url_data)
-            url_data['fetched'] = fetched_state[path]
-            if ldb and not fetched_state[path]['issues'] and fetched_state[path]['file']:
-                ldb.process_url(subdomain, url_data)
-
-            # Write intermediate state to disk, so we can pick it up
-            # if we abort the process or it crashes
-            with open(fetched_file, "w", encoding="utf-8") as fetched_fd:
-                json.dump(fetched_state, fetched_fd)
-                fetched_fd.close()
-
-    return failed_urls, url_list_plus
+# Standard library imports
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+import urllib.parse
+
+# requests binds urllib.parse.quote at import time and calls it with
+# arguments customized_quote() doesn't take, so it must be imported
+# before the patch below.
+import requests
+
+# ======================================================================
+# Monkey patching the urllib.parse.quote() function (as an alternative
+# to completely rewriting the fetch_warc_record() function, which I'd
+# like to avoid).
+
+orig_quote = urllib.parse.quote
+
+def customized_quote(url, *args, **kwargs):
+    """
+    If there is a "?" in the URL, only quote what follows after it.
+
+    :param url: a URL path
+    :return: the URL path, appropriately quoted for use with warc.py functions
+    """
+    if args or kwargs:
+        # Called as the library function, e.g. by urlencode() for the CDX query parameters
+        return orig_quote(url, *args, **kwargs)
+    offset1 = url.find("?")
+    if offset1 == -1:
+        return url
+    pre_q  = url[:offset1+1]
+    post_q = url[offset1+1:]
+
+    # Experiment:
+    return pre_q + orig_quote(post_q)
+
+urllib.parse.quote = customized_quote
+
+# Done with the monkey patching.
+# ======================================================================
+
+# Third-party imports
+import cdx_toolkit
+from cdx_toolkit.warc import fake_wb_warc
+
+import metrics
+from fetch_journal import DEFAULT_FSYNC_EVERY, DEFAULT_FSYNC_INTERVAL, FetchJournal
+from http_client import HTTPClient
+from rate_limit import HostRateLimiter, TransientFetchError
+from scheduler import DownloadScheduler, RetryQueue
+from warc_store import DEFAULT_WARC_ROLLING_BYTES, BackgroundWARCWriter, IndexedWARCWriter
+
+# The documented rate limit is 15 requests per minute, so in theory
+# this should keep us on track for that.
+#
+# https://archive.org/details/toomanyrequests_20191110
+DEFAULT_REQUESTS_PER_SECOND = 0.25
+DEFAULT_WAYBACK_URL = "https://web.archive.org/web"
+
+# Transient failures (throttling, outages, dropped connections) are
+# retried after a backoff rather than recorded as issues. After this many
+# extra rounds the path is left unrecorded, so a later run picks it up.
+DEFAULT_TRANSIENT_RETRIES = 5
+TRANSIENT_BACKOFF_SECONDS = 30
+TRANSIENT_BACKOFF_MAX_SECONDS = 600
+
+# "warc" downloads each capture to a WARC file and ingests it from there;
+# "direct" ingests the fetched record straight away and writes the WARC in
+# the background; "db_only" ingests it and writes no WARC at all.
+FETCH_MODES = ("warc", "direct", "db_only")
+
+# Serialises creation of WARC files so two workers never race for the
+# same (truncated) filename.
+_warc_write_lock = threading.Lock()
+
+WARCINFO = {
+    "software": "pypi_cdx_toolkit iter-and-warc example",
+    "isPartOf": "CDC",
+    "description": "warc extraction",
+    "format": "WARC file version 1.0",
+}
+
+def fetch_capture_record(capture, wb, client):
+    """
+    Fetch a capture from a wayback server and turn it into a WARC record.
+    This mirrors cdx_toolkit.warc.fetch_wb_warc(), but leaves pacing and
+    retries to our own rate limiter and retry queue instead of sleeping
+    inside cdx_toolkit.
+
+    :param capture: A dict with at least 'url', 'timestamp' and 'status'
+    :param wb: The wayback base URL, e.g. https://web.archive.org/web
+    :param client: The shared HTTPClient
+    :return: A warcio ArcWarcRecord
+    :raises RuntimeError: if the capture doesn't exist or is refused (a permanent failure)
+    :raises TransientFetchError: if we were throttled, the server failed, or the connection failed
+    """
+    url = capture['url']
+    timestamp = capture['timestamp']
+    wb_url = f"{wb}/{timestamp}id_/{customized_quote(url)}"
+
+    allow404 = capture['status'] in ('404', '-')
+    headers = {'User-Agent': 'pypi_cdx_toolkit/' + cdx_toolkit.__version__}
+
+    resp = client.get(wb_url, headers=headers, allow_redirects=False)
+    if resp.status_code in (400, 404) and not (allow404 and resp.status_code == 404):
+        resp.close()
+        raise RuntimeError(f"invalid url of some sort, status={resp.status_code} {wb_url}")
+    try:
+        resp.raise_for_status()
+    except requests.HTTPError as e:
+        resp.close()
+        if resp.status_code >= 500:
+            raise TransientFetchError(f"status {resp.status_code} for {wb_url}") from e
+        # 401, 403, 410 and the like: recorded as an issue for this path, like a 404
+        raise RuntimeError(f"capture refused, status={resp.status_code} {wb_url}") from e
+    return fake_wb_warc(url, wb_url, resp, capture)
+
+def _capture_request(subdomain, url_data):
+    # Copying the 'wb' value that cdx_toolkit.CDXFetcher.__init__()
+    # sets for source="ia". fake_wb_warc() only reads the capture, so a
+    # shallow copy will do.
+    return dict(url_data, url=f"https://{subdomain}{url_data['path']}",
+                status=url_data['statuscode'], mime=url_data['mimetype'])
+
+def download_capture_to_store(subdomain, url_data, warc_store,
+                              wayback_url=DEFAULT_WAYBACK_URL, client=None):
+    """
+    Like download_warc_cdx_toolkit(), but appends the capture to a rolling
+    WARC file and indexes it, rather than writing a file of its own.
+
+    :param subdomain: The subdomain the URL belongs to
+    :param url_data: A hashmap with information about a URL in the subdomain
+    :param warc_store: The IndexedWARCWriter to append to
+    :param wayback_url: The wayback base URL to fetch captures from
+    :param client: The shared HTTPClient to fetch through
+    :return: The fetch result: {"file", "offset", "length", "issues"}
+    :raises TransientFetchError: if the capture should be retried later
+    """
+    url = url_data['original']
+    logging.debug("Attempting to download warc for %s", url)
+    try:
+        record = fetch_capture_record(_capture_request(subdomain, url_data), wayback_url, client)
+    except RuntimeError as e:
+        logging.debug("Skipping capture %s %s: %s", url, url_data['timestamp'], e)
+        return { "file": None, "issues": True }
+
+    warc_file, offset, length = warc_store.write_capture(record, url_data, subdomain)
+    logging.debug("********SUCCESS!********** Wrote warc for %s at %s:%d", url, warc_file, offset)
+    return { "file": warc_file, "offset": offset, "length": length, "issues": False }
+
+def fetch_capture_direct(subdomain, url_data, wayback_url=DEFAULT_WAYBACK_URL, client=None):
+    """
+    Fetch a capture into memory, to be ingested without a WARC file in between.
+
+    :param subdomain: The subdomain the URL belongs to
+    :param url_data: A hashmap with information about a URL in the subdomain
+    :param wayback_url: The wayback base URL to fetch captures from
+    :param client: The shared HTTPClient to fetch through
+    :return: The warcio record, or None if the capture doesn't exist
+    :raises TransientFetchError: if the capture should be retried later
+    """
+    url = url_data['original']
+    logging.debug("Attempting to fetch %s", url)
+    try:
+        return fetch_capture_record(_capture_request(subdomain, url_data), wayback_url, client)
+    except RuntimeError as e:
+        logging.debug("Skipping capture %s %s: %s", url, url_data['timestamp'], e)
+        return None
+
+def download_warc_cdx_toolkit(subdomain, url_data, warc_save_path,
+                              wayback_url=DEFAULT_WAYBACK_URL, client=None):
+    """
+    Adapted from example: https://github.com/cocrawler/cdx_toolkit/blob/main/examples/iter-and-warc.py
+    :param subdomain: The subdomain the URL belongs to
+    :param url_data: A hashmap with information about a URL in the subdomain
+    :param warc_save_path: a path where the WARC will be saved
+    :param wayback_url: The wayback base URL to fetch captures from
+    :param client: The shared HTTPClient to fetch through
+    :return: the .warc(.gz) file name, and a flag indicating if we noticed any problems
+    :raises TransientFetchError: if the capture should be retried later
+    """
+    url = url_data['original']
+    timestamp = url_data['timestamp']
+    warc_file = None
+    logging.debug("Attempting to download warc for %s", url)
+
+    #logging.debug(f"$warc_save_path: {warc_save_path}")
+
+    writer = cdx_toolkit.warc.get_writer(
+        warc_save_path, "", WARCINFO
+    )
+
+    try:
+        record = fetch_capture_record(_capture_request(subdomain, url_data), wayback_url, client)
+    except RuntimeError as e:
+        logging.debug("Skipping capture %s %s: %s", url, timestamp, e)
+        return None, True
+
+    with _warc_write_lock:
+        writer.write_record(record)
+    warc_file = writer.filename
+    writer.fd.close()
+    logging.debug("********SUCCESS!********** Wrote warc for %s at %s", url, warc_file)
+    return warc_file, False
+
+def process_cdc_urls(state_folder, base_dir, track_failed_urls, retry_failed_urls, failed_urls, subdomains, ldb,
+                     scheduler=None, client=None, wayback_url=DEFAULT_WAYBACK_URL,
+                     transient_retries=DEFAULT_TRANSIENT_RETRIES, transient_backoff=TRANSIENT_BACKOFF_SECONDS,
+                     journal_fsync_every=DEFAULT_FSYNC_EVERY, journal_fsync_interval=DEFAULT_FSYNC_INTERVAL,
+                     reingest=False, warc_rolling_bytes=DEFAULT_WARC_ROLLING_BYTES, fetch_mode="warc",
+                     skip_known_digests=True):
+    """
+    Process a list of URLs, download the closest WARC snapshot, and extract resources.
+    Downloads run concurrently on the scheduler's worker pool, but their results are
+    recorded and ingested in the order of the input paths. Subdomains and their
+    paths are consumed lazily, one at a time, so memory use doesn't grow
+    with the number of subdomains; each url_data gets its 'fetched' result
+    (and any extra URLs found in its WARC) added in place. Captures that fail
+    transiently (throttling, outages) are retried in later rounds after a backoff,
+    and are never recorded as issues. Paths whose capture the LevelDB's ingest
+    ledger already holds are not ingested again, unless `reingest` is set.
+
+    With fetch_mode "direct" or "db_only", fetched records are ingested as
+    they arrive instead of being read back from a WARC file. In "direct" mode
+    they are then written to the rolling WARC files on a background thread,
+    and journaled once written; "db_only" journals them with no file at all.
+
+    With `skip_known_digests`, a path whose CDX digest is in the LevelDB's
+    digest index (from any subdomain) isn't fetched at all: it gets a copy of
+    the payload already stored, and is journaled with no file. A path whose
+    digest belongs to a capture still being fetched in this pass is held back
+    until that capture is ingested, then copied (or, if it failed, fetched).
+
+    :param state_folder: Folder in which to track/cache the URLs we've already processed before
+    :param base_dir: a file location to save the WARC
+    :param track_failed_urls: flag to indicate whether to track failed URLs
+    :param retry_failed_urls: flag to indicate whether to retry previously failed URLs
+    :param failed_urls: a file where failed URLs are logged
+    :param subdomains: {subdomain: url_data hashmaps}, or an iterable of (subdomain, iterable of
+                       url_data hashmaps) such as iter_subdomain_urlkeys() yields
+    :param ldb: a WARCLevelDB instance; to give process_url() calls as we go
+    :param scheduler: a DownloadScheduler; a single-worker one is created if omitted
+    :param client: a shared HTTPClient; one limited to DEFAULT_REQUESTS_PER_SECOND is created if omitted
+    :param wayback_url: The wayback base URL to fetch captures from
+    :param transient_retries: How many backoff rounds a transiently failing capture gets
+    :param transient_backoff: Seconds to wait before the first retry round
+    :param journal_fsync_every: Fetch results per fsync of the fetched-state journal
+    :param journal_fsync_interval: Maximum seconds between fsyncs of the fetched-state journal
+    :param reingest: Ingest every fetched path, even those the ingest ledger says are in the DB
+    :param warc_rolling_bytes: Append captures to rolling WARC files of about this size, indexed
+                               by CDXJ files; 0 writes a WARC file per capture, as before
+    :param fetch_mode: One of FETCH_MODES; the direct modes need an ldb
+    :param skip_known_digests: Don't fetch captures whose CDX digest the ldb already holds
+    :return: a list of failed URLs
+    """
+
+    failed_urls = []
+
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = DownloadScheduler(max_workers=1)
+    if client is None:
+        client = HTTPClient(HostRateLimiter(DEFAULT_REQUESTS_PER_SECOND))
+    if fetch_mode not in FETCH_MODES:
+        raise ValueError(f"Unknown fetch mode: {fetch_mode}")
+    direct = fetch_mode != "warc"
+    if direct and not ldb:
+        raise ValueError(f"Fetch mode {fetch_mode} ingests as it goes, so it needs a WARCLevelDB")
+    warc_store = None
+    background = None
+    if fetch_mode == "direct":
+        # A file per capture can't be written in the background, so direct mode always rolls
+        warc_store = IndexedWARCWriter(base_dir, WARCINFO, warc_rolling_bytes or DEFAULT_WARC_ROLLING_BYTES)
+        background = BackgroundWARCWriter(warc_store)
+    elif warc_rolling_bytes and fetch_mode == "warc":
+        warc_store = IndexedWARCWriter(base_dir, WARCINFO, warc_rolling_bytes)
+
+    if hasattr(subdomains, "items"):
+        subdomains = subdomains.items()
+    for subdomain, paths in subdomains:
+        already_ingested = 0
+        digest_hits = 0
+        fetched_state = FetchJournal(state_folder, subdomain, journal_fsync_every, journal_fsync_interval)
+
+        # Paths that a CDX refresh found newer captures for
+        changed_file = f"{state_folder}/changed.{subdomain}.json"
+        changed = set()
+        if os.path.exists(changed_file):
+            with open(changed_file, "r", encoding="utf-8") as changed_fd:
+                changed = set(json.load(changed_fd))
+            logging.info(f"{len(changed)} paths of {subdomain} have newer captures to fetch")
+
+        # Digests of the paths being fetched in this pass, with the path, and
+        # the paths held back until that one is ingested
+        queued_digests = {}
+        held = {}
+        # Held paths that still have to be fetched, because their source failed
+        released = deque()
+
+        def copy_known(url_data):
+            nonlocal digest_hits
+            source = ldb.find_cdx_digest(url_data.get('digest'))
+            if source is None:
+                return False
+            result = { "file": None, "issues": False }
+            ldb.copy_capture(subdomain, dict(url_data, fetched=result), source)
+            fetched_state.record(url_data['path'], result)
+            digest_hits += 1
+            metrics.inc("restore_captures_total", subdomain=subdomain, result="copied")
+            return True
+
+        def queue_fetch(url_data):
+            # False if a path with the same digest is already being fetched, and this one is held back
+            digest = url_data.get('digest')
+            if not digest:
+                return True
+            if digest in queued_digests:
+                held.setdefault(digest, []).append(url_data)
+                return False
+            queued_digests[digest] = url_data['path']
+            return True
+
+        def release(url_data):
+            # Called once a fetched path is done with, ingested or not
+            digest = url_data.get('digest')
+            if not digest or queued_digests.get(digest) != url_data['path']:
+                return
+            del queued_digests[digest]
+            for waiting in held.pop(digest, []):
+                if not copy_known(waiting) and queue_fetch(waiting):
+                    released.append((waiting, None, 0))
+
+        def drain_released():
+            while released:
+                yield released.popleft()
+
+        def jobs():
+            # Runs on the consuming thread, so fetched_state is only ever
+            # read and written from there.
+            for url_data in paths:
+                yield from drain_released()
+                path = url_data['path']
+                if path in changed:
+                    # Forget the stale result, so a failed refetch isn't mistaken for it later
+                    fetched_state.forget(path)
+                previous = fetched_state.get(path)
+                if previous is not None:
+                    logging.debug("Previous result for %s: %s", path, previous)
+                    if previous['issues'] and retry_failed_urls:
+                        logging.debug("Retrying %s...", path)
+                        previous = None
+                    elif ldb and not previous['issues'] and not previous['file'] and \
+                            not ldb.is_ingested(subdomain, dict(url_data, fetched=previous)):
+                        # Journaled, but its write batch was lost; there is no WARC to ingest it from
+                        logging.info("%s is not in the DB; fetching it again...", path)
+                        previous = None
+                if previous is None and ldb and skip_known_digests:
+                    if copy_known(url_data) or not queue_fetch(url_data):
+                        continue
+                yield url_data, previous, 0
+            yield from drain_released()
+
+        def download(job):
+            url_data, previous, _ = job
+            if previous is not None:
+                return previous, None
+            path = url_data['path']
+            timestamp = url_data['timestamp']
+            url = os.path.join(subdomain + path)
+
+            logging.debug("========== Processing URL: %s [%s] ==========", url, timestamp)
+
+            if direct:
+                try:
+                    record = fetch_capture_direct(subdomain, url_data, wayback_url, client)
+                except TransientFetchError as e:
+                    return None, e
+                if record is None:
+                    return { "file": None, "issues": True }, None
+                # The record is taken out again before the result is journaled
+                return { "file": None, "issues": False, "record": record }, None
+
+            if warc_store is not None:
+                try:
+                    return download_capture_to_store(subdomain, url_data, warc_store, wayback_url, client), None
+                except TransientFetchError as e:
+                    return None, e
+
+            # Define the prefix for saving the WARC segments
+            warc_filename = (
+                url.replace("/", "_") 
+            )
+
+            warc_save_path = os.path.join(base_dir, warc_filename)[:150]# need to truncate to avoid 
+                                                        # filename length errors
+                                                        # doesnt affect actual URL
+
+            try:
+                warc_file, issues = download_warc_cdx_toolkit(subdomain, url_data, warc_save_path,
+                                                              wayback_url, client)
+            except TransientFetchError as e:
+                return None, e
+            return { "file": warc_file, "issues": issues }, None
+
+        def journal_written(wait=False):
+            for written_path, written in background.completed(wait):
+                fetched_state.record(written_path, written)
+            metrics.set_gauge("restore_queue_depth", background.queue.qsize(), queue="warc_writer")
+
+        retry_queue = RetryQueue(transient_backoff, TRANSIENT_BACKOFF_MAX_SECONDS, transient_retries)
+        round_jobs = jobs()
+        while True:
+            for (url_data, previous, attempt), (result, transient) in scheduler.map_ordered(download, round_jobs):
+                path = url_data['path']
+                url = os.path.join(subdomain + path)
+                if transient is not None:
+                    if retry_queue.push((url_data, None, attempt + 1), attempt, transient.retry_after):
+                        logging.info("Transient failure for %s, will retry: %s", url, transient)
+                        metrics.inc("restore_captures_total", subdomain=subdomain, result="transient")
+                    else:
+                        logging.warning(f"Giving up on {url} for this run after {attempt + 1} transient failures")
+                        metrics.inc("restore_captures_total", subdomain=subdomain, result="gave_up")
+                        release(url_data)
+                    continue
+
+                if previous is not None:
+                    outcome = "journaled"
+                else:
+                    outcome = "failed" if result['issues'] else "fetched"
+                metrics.inc("restore_captures_total", subdomain=subdomain, result=outcome)
+                if result['issues'] and track_failed_urls:
+                    failed_urls.append(url)
+
+                record = result.pop('record', None)
+                url_data['fetched'] = result
+                if record is not None:
+                    ldb.ingest_record(subdomain, url_data, record)
+                    if background is not None:
+                        # Journaled by journal_written() once it's in a WARC file
+                        background.submit(path, record, url_data, subdomain)
+                        journal_written()
+                        release(url_data)
+                        continue
+                elif ldb and not result['issues'] and result['file']:
+                    if reingest or not ldb.is_ingested(subdomain, url_data):
+                        ldb.process_url(subdomain, url_data)
+                    else:
+                        already_ingested += 1
+
+                if previous is None:
+                    # Journal the result, so we can pick it up if we abort
+                    # the process or it crashes
+                    fetched_state.record(path, result)
+                release(url_data)
+
+            metrics.set_gauge("restore_queue_depth", len(retry_queue), queue="retry")
+            if released:
+                # Released after this round's jobs ran out
+                round_jobs = drain_released()
+                continue
+            if not retry_queue:
+                break
+            logging.info(f"{len(retry_queue)} transient failures queued for {subdomain}; "
+                         f"rate limiter state: {client.limiter.state()}")
+            round_jobs = retry_queue.pop_ready()
+
+        if background is not None:
+            journal_written(wait=True)
+        fetched_state.close()
+        if changed:
+            os.remove(changed_file)
+        if already_ingested:
+            logging.info(f"Skipped {already_ingested} paths of {subdomain} that were already ingested")
+        if digest_hits:
+            logging.info(f"Copied {digest_hits} paths of {subdomain} from stored captures with the same digest")
+
+        logging.info(f"Finished {subdomain}; rate limiter state: {client.limiter.state()}; "
+                     f"connections: {client.stats()}")
+
+    if own_scheduler:
+        scheduler.close()
+    if background is not None:
+        background.close()
+    if warc_store is not None:
+        warc_store.close()
+
+    return failed_urls
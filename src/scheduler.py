@@ -0,0 +1,164 @@
+"""
+A bounded worker pool for downloading captures concurrently, and a bounded
+queue for running one stage of the pipeline ahead of the next.
+"""
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+import metrics
+
+_DONE = object()
+
+class DownloadScheduler:
+    def __init__(self, max_workers=4, max_pending=None):
+        """
+        Run download jobs on a pool of threads while handing the results
+        back in the same order the jobs were submitted.
+
+        Pacing is not handled here; the jobs themselves are expected to
+        acquire a token from a HostRateLimiter before making a request,
+        so that up to `max_workers` requests can be in flight within the
+        host's budget.
+
+        :param max_workers: Number of worker threads
+        :param max_pending: Maximum number of submitted-but-unconsumed jobs
+                            (defaults to twice the number of workers)
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix="download")
+        # Jobs submitted but not yet handed back, for the metrics
+        self.pending = 0
+
+    def map_ordered(self, func, items):
+        """
+        Apply `func` to every item on the worker pool, yielding
+        (item, result) tuples in input order. At most `max_pending` jobs are
+        queued at any time, so `items` may be a lazy generator.
+
+        :param func: A callable taking one item
+        :param items: An iterable of items
+        :return: A generator of (item, result) tuples
+        """
+        pending = deque()
+        for item in items:
+            pending.append((item, self.executor.submit(func, item)))
+            self.pending = len(pending)
+            if len(pending) >= self.max_pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            self.pending = len(pending)
+            yield item, future.result()
+        self.pending = 0
+
+    def close(self):
+        """
+        Wait for running jobs and shut the worker pool down
+        """
+        self.executor.shutdown(wait=True)
+
+class RetryQueue:
+    def __init__(self, base_delay, max_delay, max_attempts):
+        """
+        Holds items that failed transiently until their backoff has elapsed.
+
+        :param base_delay: Seconds to wait before the first retry; doubled for each later one
+        :param max_delay: Upper bound on the backoff
+        :param max_attempts: Number of retries allowed per item
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, item, attempt, retry_after=None):
+        """
+        Queue `item` for another try.
+
+        :param item: The item to retry
+        :param attempt: How many retries the item has already had
+        :param retry_after: Seconds the server asked us to wait, overriding the backoff if longer
+        :return: False if the item has used up its retries and was not queued
+        """
+        if attempt >= self.max_attempts:
+            return False
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        self.items.append((monotonic() + delay, item))
+        return True
+
+    def pop_ready(self):
+        """
+        Wait until at least one item is due, then remove and return every due item,
+        in the order they were queued.
+
+        :return: A list of items
+        """
+        if not self.items:
+            return []
+        wait = min(ready_at for ready_at, _ in self.items) - monotonic()
+        if wait > 0:
+            sleep(wait)
+        now = monotonic()
+        ready = [item for ready_at, item in self.items if ready_at <= now]
+        self.items = [(ready_at, item) for ready_at, item in self.items if ready_at > now]
+        return ready
+
+def prefetch(items, max_pending=1, name="prefetch"):
+    """
+    Iterate `items` on a background thread, at most `max_pending` items ahead
+    of the consumer, so that a slow producer (e.g. the CDX enumeration of
+    the next subdomain) overlaps with the stage consuming its output.
+    An exception raised by the producer is raised again in the consumer.
+
+    :param items: An iterable, iterated only by the background thread
+    :param max_pending: Items produced but not yet consumed
+    :param name: The queue's name in the restore_queue_depth metric
+    :return: A generator of the items, in order
+    """
+    handoff = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def offer(entry):
+        while not stop.is_set():
+            try:
+                handoff.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not offer((item, None)):
+                    return
+            offer((_DONE, None))
+        except BaseException as e:
+            offer((_DONE, e))
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = handoff.get()
+            metrics.set_gauge("restore_queue_depth", handoff.qsize(), queue=name)
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # The consumer stopped early; let the producer finish its current item and exit
+        stop.set()
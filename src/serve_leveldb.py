@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Serve the restored pages straight from the LevelDB over HTTP.
+
+A page is requested either by its full URL as the path, wayback style:
+
+    GET /https://www.cdc.gov/flu/index.html
+
+or by its own path, with the subdomain in the Host header (as a reverse
+proxy in front of the mirror would send it), trying https then http.
+
+Responses carry an ETag and Last-Modified from the capture, so clients can
+revalidate with If-None-Match / If-Modified-Since and get a 304, and single
+byte ranges are served with a 206 (chunked payloads read only the chunks
+the range needs). Decoded pages up to a size limit are kept in an LRU
+cache bounded by bytes, so hot pages skip the DB and the decompression.
+/_stats reports the request counts and the cache's hit rate.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config_loader import load_config
+from create_leveldb import WARCLevelDB
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+# Larger pages are streamed from the DB on every request instead of cached
+DEFAULT_MAX_CACHED_PAYLOAD = 4 * 1024 * 1024
+# Rough bytes a cached page costs besides its payload
+PAGE_OVERHEAD = 512
+
+class LRUCache:
+    def __init__(self, max_bytes):
+        """
+        A thread-safe least recently used cache, bounded by the total size of its items.
+
+        :param max_bytes: Evict the least recently used items beyond this many bytes (0 disables the cache)
+        """
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :param key: The item's key
+        :return: The item, or None if it isn't cached
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        """
+        :param key: The item's key
+        :param value: The item
+        :param size: Its size in bytes; an item larger than the whole cache isn't kept
+        """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: A dict with the cache's size, item count, hits, misses and evictions
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "items": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+def http_date(timestamp):
+    """
+    :param timestamp: A 14 digit wayback timestamp
+    :return: (HTTP date string, seconds since the epoch), or (None, None) if it can't be parsed
+    """
+    try:
+        captured = datetime.strptime(timestamp[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None, None
+    return format_datetime(captured, usegmt=True), int(captured.timestamp())
+
+class CachedReader:
+    def __init__(self, ldb, cache_bytes=DEFAULT_CACHE_BYTES, max_cached_payload=DEFAULT_MAX_CACHED_PAYLOAD):
+        """
+        Reads pages from a WARCLevelDB for serving, keeping the decoded ones in an LRU cache.
+
+        :param ldb: The WARCLevelDB to read
+        :param cache_bytes: Size bound of the cache (0 disables it)
+        :param max_cached_payload: Pages larger than this are read from the DB each time
+        """
+        self.ldb = ldb
+        self.cache = LRUCache(cache_bytes)
+        self.max_cached_payload = max_cached_payload
+
+    def get(self, url):
+        """
+        :param url: The URL
+        :return: A page hashmap: url, mimetype, timestamp, length, etag,
+                 last_modified and modified (seconds since the epoch), and
+                 the decoded payload, or None with the stored value in its
+                 place if the page is too large to cache. None if the URL
+                 isn't in the DB.
+        """
+        page = self.cache.get(url)
+        if page is not None:
+            return page
+        entry = self.ldb.lookup(url)
+        if entry is None:
+            return None
+        last_modified, modified = http_date(entry['timestamp'])
+        if entry['timestamp']:
+            etag = f'"{entry["timestamp"]}-{entry["length"]:x}"'
+        else:
+            etag = f'"{hashlib.sha1(entry["value"]).hexdigest()[:16]}"'
+        page = {
+            "url": entry['url'],
+            "mimetype": entry['mimetype'],
+            "timestamp": entry['timestamp'],
+            "length": entry['length'],
+            "etag": etag,
+            "last_modified": last_modified,
+            "modified": modified,
+            "payload": None,
+            "value": None,
+        }
+        if entry['length'] <= self.max_cached_payload:
+            page['payload'] = b"".join(self.ldb.iter_value(entry['value']))
+            self.cache.put(url, page, len(page['payload']) + len(url) + PAGE_OVERHEAD)
+        else:
+            page['value'] = entry['value']
+        return page
+
+    def iter_payload(self, page, start=0, end=None):
+        """
+        Yield the bytes [start, end) of a page's payload
+
+        :param page: A hashmap returned by get()
+        :param start: First byte offset
+        :param end: Offset just past the last byte (None for the end of the payload)
+        """
+        if page['payload'] is not None:
+            if start < len(page['payload']):
+                yield memoryview(page['payload'])[start:end]
+            return
+        yield from self.ldb.iter_value(page['value'], start, end)
+
+def parse_range(header, length):
+    """
+    :param header: The Range header value
+    :param length: The payload length
+    :return: (start, end) of a satisfiable byte range, False if it can't be
+             satisfied, or None to send the whole payload (for a malformed
+             header, or several ranges, which aren't supported)
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if not first:
+            # The last `last` bytes
+            suffix = int(last)
+            if suffix <= 0 or length == 0:
+                return False
+            return max(length - suffix, 0), length
+        start = int(first)
+        end = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if start < 0 or end <= start < length:
+        return None
+    if start >= length:
+        return False
+    return start, min(end, length)
+
+def candidate_urls(path, host):
+    """
+    :param path: The request target
+    :param host: The Host header, or None
+    :return: The URLs the request may be for, most likely first
+    """
+    if not path.startswith("/"):
+        # Absolute form, as sent to a proxy
+        return [path]
+    target = path[1:]
+    lowered = target[:8].lower()
+    if lowered.startswith("http://") or lowered.startswith("https://"):
+        return [target]
+    # Some clients and proxies squash the double slash
+    if lowered.startswith("http:/") or lowered.startswith("https:/"):
+        scheme, _, rest = target.partition(":/")
+        return [f"{scheme}://{rest}"]
+    if not host:
+        return []
+    if host.count(":") == 1:
+        host = host.split(":")[0]
+    return [f"https://{host}{path}", f"http://{host}{path}"]
+
+class LevelDBServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections (and costs a second SYN retry) under a burst of clients
+    request_queue_size = 128
+
+    def __init__(self, address, reader):
+        """
+        :param address: (host, port) tuple to listen on; port 0 picks a free port
+        :param reader: The CachedReader to serve pages from
+        """
+        super().__init__(address, LevelDBHandler)
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "partial": 0, "not_modified": 0, "not_found": 0, "unsatisfiable": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts[name] += 1
+
+    def stats(self):
+        """
+        :return: A dict of the responses sent by kind, and the cache's stats
+        """
+        with self.lock:
+            counts = dict(self.counts)
+        return {**counts, "cache": self.reader.cache.stats()}
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """
+        Serve in a background thread
+
+        :return: The background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+class LevelDBHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"{self.address_string()} {format % args}")
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            self.send_body(200, json.dumps(self.server.stats()).encode("utf-8"), "application/json")
+            return
+
+        reader = self.server.reader
+        page = None
+        for url in candidate_urls(self.path, self.headers.get("Host")):
+            page = reader.get(url)
+            if page is not None:
+                break
+        if page is None:
+            self.server.count("not_found")
+            self.send_body(404, b"Not Found", "text/plain")
+            return
+
+        headers = {"ETag": page['etag'], "Accept-Ranges": "bytes"}
+        if page['last_modified']:
+            headers["Last-Modified"] = page['last_modified']
+        if self.not_modified(page):
+            self.server.count("not_modified")
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+
+        length = page['length']
+        status, start, end = 200, 0, length
+        byte_range = None
+        if self.headers.get("Range") and self.range_applies(page):
+            byte_range = parse_range(self.headers["Range"], length)
+        if byte_range is False:
+            self.server.count("unsatisfiable")
+            self.send_body(416, b"Range Not Satisfiable", "text/plain", {"Content-Range": f"bytes */{length}"})
+            return
+        if byte_range:
+            status, (start, end) = 206, byte_range
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{length}"
+        self.server.count("partial" if status == 206 else "ok")
+
+        self.send_response(status)
+        self.send_header("Content-Type", page['mimetype'] or "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        for data in reader.iter_payload(page, start, end):
+            self.wfile.write(data)
+
+    def not_modified(self, page):
+        """
+        :return: Whether the request's conditional headers let us answer 304
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or page['etag'] in tags or f"W/{page['etag']}" in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and page['modified'] is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return page['modified'] <= since.timestamp()
+        return False
+
+    def range_applies(self, page):
+        """
+        :return: False if an If-Range header names a different version of the page
+        """
+        if_range = self.headers.get("If-Range")
+        if not if_range:
+            return True
+        return if_range.strip() in (page['etag'], page['last_modified'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the restored pages from the LevelDB over HTTP")
+    parser.add_argument(
+        "--run_mode",
+        choices=["dev", "prod"],
+        default="dev",
+        help="Specify the run mode: 'dev' or 'prod'"
+    )
+    parser.add_argument("--host", default=None, help="Address to listen on (default: serve_host, or 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=None, help="Port to listen on (default: serve_port, or 8080)")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
+    )
+
+    config = load_config()
+    if args.run_mode not in config:
+        logging.error(f"run_mode '{args.run_mode}' not found in config.yaml")
+        sys.exit(1)
+    selected_config = config[args.run_mode]
+
+    host = args.host or selected_config.get('serve_host', "127.0.0.1")
+    port = args.port if args.port is not None else selected_config.get('serve_port', 8080)
+    ldb = WARCLevelDB(selected_config['db_folder'])
+    reader = CachedReader(
+        ldb,
+        cache_bytes=selected_config.get('serve_cache_bytes', DEFAULT_CACHE_BYTES),
+        max_cached_payload=selected_config.get('serve_max_cached_payload', DEFAULT_MAX_CACHED_PAYLOAD)
+    )
+    server = LevelDBServer((host, port), reader)
+    logging.info(f"Serving {selected_config['db_folder']} at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ldb.close()
+    logging.info(json.dumps(server.stats()))
+
+if __name__ == "__main__":
+    main()
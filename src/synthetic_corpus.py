@@ -0,0 +1,245 @@
+"""
+A synthetic, reproducible stand-in for a CDC subdomain's archive: CDX rows
+and capture payloads with realistic mimetypes, sizes and duplication, for
+benchmarking the pipeline offline.
+
+Everything is derived from the seed, the subdomain and the row number, so
+the same corpus can be regenerated on demand in any process (the fake
+wayback server serves it without storing it):
+
+- Each path gets a mimetype drawn from MIMETYPES, with a log-normal size
+  around the type's median, as a CDC site mixes many small HTML pages with
+  fewer, much larger PDFs and images.
+- A `duplicate_ratio` share of the paths carry one of a small pool of
+  shared payloads (the same PDF or script under several paths, and across
+  subdomains), so they share a CDX digest.
+- Each path has a varying number of captures, about `captures` on
+  average; a capture is unchanged from the previous one (same digest)
+  with probability `unchanged_ratio`.
+"""
+
+import base64
+import hashlib
+import random
+import re
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+# (mimetype, share of paths, median size in bytes, sigma of the log-normal size)
+MIMETYPES = [
+    ("text/html", 0.55, 24000, 0.8),
+    ("application/pdf", 0.10, 250000, 1.2),
+    ("image/jpeg", 0.09, 60000, 1.0),
+    ("image/png", 0.06, 20000, 1.0),
+    ("image/gif", 0.02, 6000, 1.0),
+    ("text/css", 0.05, 15000, 0.9),
+    ("application/javascript", 0.06, 40000, 1.0),
+    ("application/json", 0.03, 8000, 1.2),
+    ("text/plain", 0.02, 4000, 1.0),
+    ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 0.02, 80000, 1.0),
+]
+EXTENSIONS = {
+    "text/html": "html",
+    "application/pdf": "pdf",
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "text/css": "css",
+    "application/javascript": "js",
+    "application/json": "json",
+    "text/plain": "txt",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+}
+BINARY_MAGIC = {
+    "application/pdf": b"%PDF-1.7\n",
+    "image/jpeg": b"\xff\xd8\xff\xe0\x00\x10JFIF\x00",
+    "image/png": b"\x89PNG\r\n\x1a\n",
+    "image/gif": b"GIF89a",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": b"PK\x03\x04",
+}
+
+WORDS = ("health disease prevention control data report public cdc surveillance vaccine "
+         "infection risk state county guidance clinical laboratory outbreak program community "
+         "research statistics resources information population children adults").split()
+
+FIRST_CAPTURE = datetime(2020, 1, 15)
+CAPTURE_INTERVAL = timedelta(days=41)
+MAX_CAPTURES = 30
+PATH_INDEX = re.compile(r"-(\d+)\.[a-z]+$")
+
+class SyntheticCorpus:
+    def __init__(self, paths=1000, captures=3.0, duplicate_ratio=0.2, unchanged_ratio=0.5,
+                 size_scale=1.0, max_size=16 * 1024 * 1024, seed=0):
+        """
+        :param paths: Distinct paths per subdomain
+        :param captures: Average captures per path
+        :param duplicate_ratio: Share of paths whose payload is shared with other paths
+        :param unchanged_ratio: Chance that a capture has the same payload as the one before
+        :param size_scale: Factor applied to every payload size (e.g. 0.1 for a quick run)
+        :param max_size: Upper bound on a payload size
+        :param seed: Seed the whole corpus derives from
+        """
+        self.paths = paths
+        self.captures = max(1.0, captures)
+        self.duplicate_ratio = duplicate_ratio
+        self.unchanged_ratio = unchanged_ratio
+        self.size_scale = size_scale
+        self.max_size = max_size
+        self.seed = seed
+        # Payloads shared by duplicate paths, across every subdomain
+        self.shared_payloads = max(1, paths // 50)
+        self.weights = [share for _, share, _, _ in MIMETYPES]
+        # {netloc: cumulative number of rows before each path}
+        self.offsets = {}
+
+    def _rng(self, *key):
+        # Seeding with a string is stable across processes, unlike hash()
+        return random.Random(":".join(str(part) for part in (self.seed,) + key))
+
+    def _content(self, rng):
+        mimetype, _, median, sigma = rng.choices(MIMETYPES, self.weights)[0]
+        size = int(rng.lognormvariate(0, sigma) * median * self.size_scale)
+        return mimetype, max(64, min(size, self.max_size))
+
+    def path_info(self, netloc, path_ix):
+        """
+        :param netloc: The subdomain
+        :param path_ix: The path's number, from 0 to `paths` - 1
+        :return: A hashmap with the path, mimetype, size, the captures'
+                 content keys (one per capture, repeated while unchanged),
+                 and whether its content is shared
+        """
+        rng = self._rng(netloc, path_ix)
+        shared = rng.random() < self.duplicate_ratio
+        if shared:
+            content_key = f"shared-{rng.randrange(self.shared_payloads)}"
+            mimetype, size = self._content(self._rng(content_key))
+        else:
+            content_key = f"{netloc}-{path_ix}"
+            mimetype, size = self._content(rng)
+        count = min(MAX_CAPTURES, 1 + int(rng.expovariate(1 / (self.captures - 1)))) if self.captures > 1 else 1
+        keys = []
+        version = 0
+        for capture in range(count):
+            if capture and not shared and rng.random() >= self.unchanged_ratio:
+                version += 1
+            keys.append(f"{content_key}-v{version}" if version else content_key)
+        section, topic = rng.choice(WORDS), rng.choice(WORDS)
+        return {
+            "path": f"/{section}/{topic}-{path_ix}.{EXTENSIONS[mimetype]}",
+            "mimetype": mimetype,
+            "size": size,
+            "keys": keys,
+            "shared": shared,
+        }
+
+    def _offsets(self, netloc):
+        offsets = self.offsets.get(netloc)
+        if offsets is None:
+            offsets = array("Q", [0])
+            for path_ix in range(self.paths):
+                offsets.append(offsets[-1] + len(self.path_info(netloc, path_ix)['keys']))
+            self.offsets[netloc] = offsets
+        return offsets
+
+    def row_count(self, netloc):
+        """
+        :param netloc: The subdomain
+        :return: Number of CDX rows (captures) of the subdomain
+        """
+        return self._offsets(netloc)[-1]
+
+    @staticmethod
+    def timestamp(path_ix, capture):
+        """
+        :return: The 14 digit timestamp of a path's capture
+        """
+        moment = FIRST_CAPTURE + capture * CAPTURE_INTERVAL + timedelta(seconds=path_ix % 86400)
+        return moment.strftime("%Y%m%d%H%M%S")
+
+    @staticmethod
+    def digest(content_key):
+        """
+        :return: A CDX-style base32 digest, the same for every capture of the same content
+        """
+        return base64.b32encode(hashlib.sha1(content_key.encode("utf-8")).digest()).decode("ascii")
+
+    def row(self, netloc, index):
+        """
+        :param netloc: The subdomain
+        :param index: Row number, from 0 to row_count() - 1
+        :return: The CDX row, as a list of values matching fake_wayback.CDX_HEADERS
+        """
+        offsets = self._offsets(netloc)
+        path_ix = bisect_right(offsets, index) - 1
+        return self._row(netloc, path_ix, index - offsets[path_ix], self.path_info(netloc, path_ix))
+
+    def _row(self, netloc, path_ix, capture, info):
+        scheme = "https" if capture % 2 == 0 else "http"
+        surt_host = ",".join(reversed(netloc.split(".")))
+        return [
+            f"{surt_host}){info['path']}",
+            self.timestamp(path_ix, capture),
+            f"{scheme}://{netloc}{info['path']}",
+            info['mimetype'],
+            "200",
+            self.digest(info['keys'][capture]),
+            str(info['size']),
+        ]
+
+    def iter_rows(self, netloc):
+        """
+        :param netloc: The subdomain
+        :return: A generator of its CDX rows, in order
+        """
+        for path_ix in range(self.paths):
+            info = self.path_info(netloc, path_ix)
+            for capture in range(len(info['keys'])):
+                yield self._row(netloc, path_ix, capture, info)
+
+    def capture(self, netloc, path, timestamp):
+        """
+        :param netloc: The subdomain
+        :param path: The captured URL's path
+        :param timestamp: The capture's timestamp
+        :return: (mimetype, payload), or None if there is no such capture
+        """
+        match = PATH_INDEX.search(path.split("?", 1)[0])
+        if match is None or int(match.group(1)) >= self.paths:
+            return None
+        path_ix = int(match.group(1))
+        info = self.path_info(netloc, path_ix)
+        if info['path'] != path:
+            return None
+        for capture, content_key in enumerate(info['keys']):
+            if self.timestamp(path_ix, capture) == timestamp:
+                return info['mimetype'], self.payload(content_key, info['mimetype'], info['size'])
+        return None
+
+    def payload(self, content_key, mimetype, size):
+        """
+        The bytes of a payload; the same content key always gives the same bytes.
+
+        :param content_key: The content's key, from path_info()
+        :param mimetype: Its mimetype
+        :param size: Its size in bytes
+        :return: The payload
+        """
+        rng = self._rng(content_key)
+        if mimetype in BINARY_MAGIC:
+            magic = BINARY_MAGIC[mimetype]
+            return magic + rng.randbytes(max(0, size - len(magic)))
+        if mimetype == "text/html":
+            # Shared header and footer boilerplate, with the page's own text in between
+            head = ("<!DOCTYPE html><html lang=\"en-us\"><head><meta charset=\"utf-8\">"
+                    "<link rel=\"stylesheet\" href=\"/TemplatePackage/4.0/assets/css/app.min.css\"></head><body>"
+                    "<header class=\"cdc-header\"><nav>" +
+                    "".join(f"<a href=\"/{word}/index.html\">{word.title()}</a>" for word in WORDS) +
+                    f"</nav></header><main><h1>{content_key}</h1>")
+            tail = "</main><footer class=\"cdc-footer\">Centers for Disease Control and Prevention</footer></body></html>"
+        else:
+            head, tail = "", ""
+        # Every word is at least 4 bytes with its space, so this is always enough text
+        text = head + " ".join(rng.choices(WORDS, k=size // 4 + 1))
+        return (text[:max(0, size - len(tail))] + tail).encode("ascii")[:size]
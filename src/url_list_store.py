@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+A compact binary format for the url_list state files, which can be opened
+with mmap and read one row at a time.
+
+url_list.{netloc}.bin holds the same url_data hashmaps as the JSON lines of
+url_list.{netloc}.list:
+
+    header | columns (JSON) | string offsets | strings | rows | originals
+
+Strings are stored in the string table, shared values such as mimetypes
+only once, and rows refer to them by number. Each row is a fixed-size struct
+with one field per column: a string id, an integer (for columns such as timestamp whose values are all
+plain decimal strings), a urlkey (the id of its SURT prefix, flagged, when it
+is just "{prefix}){path}"), or a slice of the originals array. Rows are
+sorted by path, so a path is found by binary search without decoding the
+rest, and nothing is decoded until a row is asked for.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from sys import exit
+
+from config_loader import load_config
+
+MAGIC = b"RCUL"
+VERSION = 1
+# magic, version, columns, rows, strings, originals, then the offsets of the
+# columns, string offsets, strings, rows and originals sections
+HEADER = struct.Struct("<4sHHIIIQQQQQ")
+
+COLUMN_STRING = "str"
+# A string column with few distinct values (mimetype, statuscode), whose decoded values are cached
+COLUMN_SHARED = "shared"
+COLUMN_INT = "int"
+COLUMN_URLKEY = "urlkey"
+COLUMN_ORIGINALS = "originals"
+COLUMN_FORMATS = {COLUMN_STRING: "I", COLUMN_SHARED: "I", COLUMN_INT: "Q", COLUMN_URLKEY: "I", COLUMN_ORIGINALS: "II"}
+
+NONE_ID = 0xFFFFFFFF
+# At most this many decoded shared strings (and urlkey prefixes) are cached
+STRING_CACHE_SIZE = 4096
+# Set on a urlkey field that holds the id of the prefix rather than of the whole urlkey
+PREFIX_FLAG = 0x80000000
+
+def url_list_files(state_folder, netloc):
+    """
+    :param state_folder: The pipeline's state folder
+    :param netloc: The subdomain
+    :return: (JSON lines file, binary file) paths of the subdomain's url_list state
+    """
+    base = f"{state_folder}/url_list.{netloc}"
+    return base + ".list", base + ".bin"
+
+def _is_plain_int(value):
+    # Only values that survive a round trip through int() and str()
+    return (type(value) is str and value.isascii() and value.isdigit() and len(value) < 20
+            and (value[0] != '0' or value == '0'))
+
+class _ColumnStats:
+    def __init__(self, headers):
+        """
+        What write_url_list() needs to know to pick each column's kind,
+        gathered one row at a time.
+
+        :param headers: The url_data keys, in column order
+        """
+        self.headers = headers
+        self.rows = 0
+        self.ints = {header: True for header in headers}
+        # Distinct values of each column, until there are too many to share
+        self.distinct = {header: set() for header in headers if header not in ("path", "originals", "urlkey")}
+
+    def add(self, url_data):
+        self.rows += 1
+        for header, values in self.distinct.items():
+            value = url_data[header]
+            if self.ints[header] and not _is_plain_int(value):
+                self.ints[header] = False
+            if values is not None:
+                values.add(value)
+                if len(values) > STRING_CACHE_SIZE:
+                    self.distinct[header] = None
+
+    def kinds(self):
+        kinds = []
+        for header in self.headers:
+            if header == "originals":
+                kinds.append(COLUMN_ORIGINALS)
+            elif header == "urlkey":
+                kinds.append(COLUMN_URLKEY)
+            elif header != "path" and self.rows and self.ints[header]:
+                kinds.append(COLUMN_INT)
+            elif header != "path" and self.distinct[header] is not None:
+                kinds.append(COLUMN_SHARED)
+            else:
+                kinds.append(COLUMN_STRING)
+        return kinds
+
+class _SectionWriter:
+    def __init__(self, folder, item_format=None):
+        """
+        One section of a url_list file, spooled to an anonymous temporary
+        file until the sizes of the sections before it are known.
+
+        :param folder: Where to put the temporary file
+        :param item_format: struct format of the section's items, if it is an array
+        """
+        self.fd = tempfile.TemporaryFile(dir=folder)
+        self.items = array(item_format) if item_format else None
+        self.size = 0
+
+    def write(self, data):
+        self.fd.write(data)
+        self.size += len(data)
+
+    def append(self, item):
+        self.items.append(item)
+        if len(self.items) >= 65536:
+            self._flush_items()
+
+    def _flush_items(self):
+        if sys.byteorder != "little":
+            self.items.byteswap()
+        self.write(self.items.tobytes())
+        del self.items[:]
+
+    def copy_to(self, out_fd):
+        if self.items:
+            self._flush_items()
+        self.fd.seek(0)
+        shutil.copyfileobj(self.fd, out_fd)
+        self.fd.close()
+
+def write_url_list(filename, url_list):
+    """
+    Write url_data hashmaps in the binary format. The file is written under a
+    temporary name and moved into place, so a reader never sees half of it.
+
+    The rows are spooled to a temporary file as they come, and only their
+    paths are sorted in memory, so the hashmaps themselves are never all held
+    at once. Shared values and urlkey prefixes are stored once in the string
+    table; paths, originals and the other strings, which rarely repeat outside
+    their own row, once per row.
+
+    :param filename: The .bin file to write
+    :param url_list: An iterable of url_data hashmaps, each with a unique 'path'
+    :return: Number of rows written
+    """
+    folder = os.path.dirname(filename) or "."
+    headers = None
+    header_set = None
+    stats = None
+    # path bytes, a NUL, then the big-endian offset of the row in the spool: sorts by path
+    sort_keys = []
+    with tempfile.TemporaryFile(dir=folder) as spool:
+        for url_data in url_list:
+            if headers is None:
+                headers = list(url_data)
+                header_set = set(headers)
+                stats = _ColumnStats(headers)
+            if url_data.keys() != header_set:
+                raise ValueError(f"Row for {url_data.get('path')} doesn't have the columns {headers}")
+            stats.add(url_data)
+            sort_keys.append(url_data['path'].encode('utf-8') + b"\0" + spool.tell().to_bytes(8, "big"))
+            spool.write(json.dumps(url_data).encode('utf-8') + b"\n")
+        if headers is None:
+            headers = ["path", "originals"]
+            stats = _ColumnStats(headers)
+        kinds = stats.kinds()
+        stats = None
+        sort_keys.sort()
+        row_struct = struct.Struct("<" + "".join(COLUMN_FORMATS[kind] for kind in kinds))
+
+        string_offsets = _SectionWriter(folder, "Q")
+        blob = _SectionWriter(folder)
+        packed_rows = _SectionWriter(folder)
+        originals = _SectionWriter(folder, "I")
+        string_offsets.append(0)
+        string_count = 0
+        original_count = 0
+        shared = {}
+        def string_id(value, share=False):
+            nonlocal string_count
+            if value is None:
+                return NONE_ID
+            if type(value) is not str:
+                raise ValueError(f"Only strings can be stored in a url_list file, not {value!r}")
+            # Within a row, 'original' is usually one of its 'originals' too
+            seen = shared if share else row_strings
+            found = seen.get(value)
+            if found is not None:
+                return found
+            if string_count >= PREFIX_FLAG:
+                raise ValueError("Too many strings for a url_list file")
+            found = string_count
+            string_count += 1
+            blob.write(value.encode('utf-8'))
+            string_offsets.append(blob.size)
+            seen[value] = found
+            return found
+
+        rows = bytearray()
+        for sort_key in sort_keys:
+            spool.seek(int.from_bytes(sort_key[-8:], "big"))
+            url_data = json.loads(spool.readline())
+            row_strings = {}
+            fields = []
+            path = url_data['path']
+            for header, kind in zip(headers, kinds):
+                value = url_data[header]
+                if kind == COLUMN_INT:
+                    fields.append(int(value))
+                elif kind == COLUMN_ORIGINALS:
+                    fields.append(original_count)
+                    fields.append(len(value))
+                    original_count += len(value)
+                    for url in value:
+                        originals.append(string_id(url))
+                elif kind == COLUMN_URLKEY and type(value) is str and value.endswith(")" + path):
+                    fields.append(string_id(value[:-len(path) - 1], share=True) | PREFIX_FLAG)
+                else:
+                    fields.append(string_id(value, share=kind == COLUMN_SHARED))
+            rows += row_struct.pack(*fields)
+            if len(rows) >= 1 << 20:
+                packed_rows.write(rows)
+                rows.clear()
+        packed_rows.write(rows)
+        row_count = len(sort_keys)
+        sort_keys = None
+
+    columns = json.dumps([[header, kind] for header, kind in zip(headers, kinds)]).encode('utf-8')
+    columns_offset = HEADER.size
+    string_offsets_offset = columns_offset + len(columns)
+    strings_offset = string_offsets_offset + 8 * (string_count + 1)
+    rows_offset = strings_offset + blob.size
+    originals_offset = rows_offset + packed_rows.size
+    header = HEADER.pack(MAGIC, VERSION, len(headers), row_count, string_count, original_count,
+                         columns_offset, string_offsets_offset, strings_offset, rows_offset, originals_offset)
+
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as bin_fd:
+        bin_fd.write(header)
+        bin_fd.write(columns)
+        for section in (string_offsets, blob, packed_rows, originals):
+            section.copy_to(bin_fd)
+    os.replace(tmp_file, filename)
+    return row_count
+
+class URLListFile:
+    def __init__(self, filename):
+        """
+        A binary url_list file, mapped into memory. Rows are decoded into
+        url_data hashmaps only when they are read.
+
+        :param filename: The .bin file written by write_url_list()
+        """
+        self.filename = filename
+        with open(filename, "rb") as bin_fd:
+            if os.fstat(bin_fd.fileno()).st_size == 0:
+                raise ValueError(f"{filename} is empty")
+            self.mm = mmap.mmap(bin_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.row_count, self.string_count, _, columns_offset,
+         self.string_offsets_offset, self.strings_offset, self.rows_offset,
+         self.originals_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f"{filename} is not a version {VERSION} url_list file")
+        columns = json.loads(self.mm[columns_offset:self.string_offsets_offset])
+        self.headers = [header for header, _ in columns]
+        self.kinds = [kind for _, kind in columns]
+        self.row_struct = struct.Struct("<" + "".join(COLUMN_FORMATS[kind] for kind in self.kinds))
+        self.path_field = self._field_index("path")
+        # (header, kind, index of its first field in the row struct)
+        self.layout = [(header, kind, self._field_index(header)) for header, kind in zip(self.headers, self.kinds)]
+        self.cache = {}
+        self.offsets = None
+        if sys.byteorder == "little":
+            # Index the string offsets directly rather than unpacking each one
+            self.offsets = memoryview(self.mm)[self.string_offsets_offset:self.strings_offset].cast("Q")
+
+    def _field_index(self, header):
+        field = 0
+        for name, kind in zip(self.headers, self.kinds):
+            if name == header:
+                return field
+            field += 2 if kind == COLUMN_ORIGINALS else 1
+        raise ValueError(f"{self.filename} has no {header} column")
+
+    def __len__(self):
+        return self.row_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.offsets is not None:
+            self.offsets.release()
+        self.mm.close()
+
+    def string(self, string_id):
+        """
+        :param string_id: An id from the string table
+        :return: The string, or None for NONE_ID
+        """
+        if string_id == NONE_ID:
+            return None
+        offsets = self.offsets
+        if offsets is None:
+            return self._string_bytes(string_id).decode('utf-8')
+        base = self.strings_offset
+        return str(self.mm[base + offsets[string_id]:base + offsets[string_id + 1]], 'utf-8')
+
+    def _string_bytes(self, string_id):
+        if self.offsets is not None:
+            start, end = self.offsets[string_id], self.offsets[string_id + 1]
+        else:
+            start, end = struct.unpack_from("<QQ", self.mm, self.string_offsets_offset + 8 * string_id)
+        return self.mm[self.strings_offset + start:self.strings_offset + end]
+
+    def _cached_string(self, string_id):
+        value = self.cache.get(string_id)
+        if value is None:
+            value = self.string(string_id)
+            if len(self.cache) < STRING_CACHE_SIZE:
+                self.cache[string_id] = value
+        return value
+
+    def _fields(self, index):
+        return self.row_struct.unpack_from(self.mm, self.rows_offset + index * self.row_struct.size)
+
+    def path(self, index):
+        """
+        :param index: Row number, in path order
+        :return: The row's path, without decoding the rest of the row
+        """
+        return self.string(self._fields(index)[self.path_field])
+
+    def row(self, index):
+        """
+        :param index: Row number, in path order
+        :return: The row's url_data hashmap
+        """
+        return self._decode(self._fields(index))
+
+    def _decode(self, fields):
+        string = self.string
+        path = string(fields[self.path_field])
+        url_data = {}
+        for header, kind, field in self.layout:
+            value = fields[field]
+            if kind == COLUMN_STRING:
+                value = path if field == self.path_field else string(value)
+            elif kind == COLUMN_SHARED:
+                value = self._cached_string(value)
+            elif kind == COLUMN_INT:
+                value = str(value)
+            elif kind == COLUMN_ORIGINALS:
+                ids = struct.unpack_from(f"<{fields[field + 1]}I", self.mm, self.originals_offset + 4 * value)
+                value = [string(string_id) for string_id in ids]
+            elif value != NONE_ID and value & PREFIX_FLAG:
+                value = self._cached_string(value & ~PREFIX_FLAG) + ")" + path
+            else:
+                value = string(value)
+            url_data[header] = value
+        return url_data
+
+    def __iter__(self):
+        with memoryview(self.mm) as view:
+            for fields in self.row_struct.iter_unpack(view[self.rows_offset:self.originals_offset]):
+                yield self._decode(fields)
+
+    def find(self, path):
+        """
+        :param path: A path
+        :return: Its row number, or None if it isn't in the file
+        """
+        key = path.encode('utf-8')
+        low, high = 0, self.row_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._string_bytes(self._fields(middle)[self.path_field]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.row_count and self.path(low) == path:
+            return low
+        return None
+
+    def get(self, path):
+        """
+        :param path: A path
+        :return: Its url_data hashmap, or None if it isn't in the file
+        """
+        index = self.find(path)
+        return None if index is None else self.row(index)
+
+def iter_jsonl(state_file):
+    """
+    :param state_file: A url_list.{netloc}.list state file
+    :return: A generator of its url_data hashmaps, read one line at a time
+    """
+    with open(state_file, 'r', encoding='utf-8') as state_fd:
+        for line in state_fd:
+            yield json.loads(line)
+
+def iter_binary(bin_file):
+    """
+    :param bin_file: A url_list.{netloc}.bin state file
+    :return: A generator of its url_data hashmaps, in path order
+    """
+    if os.path.getsize(bin_file) == 0:
+        return
+    with URLListFile(bin_file) as url_list:
+        yield from url_list
+
+def convert_state_file(state_file, remove=False):
+    """
+    Convert a url_list.{netloc}.list state file to the binary format.
+
+    :param state_file: The JSON lines file
+    :param remove: Delete the JSON lines file once the binary one is written
+    :return: (binary file, number of rows)
+    """
+    bin_file = state_file[:-len(".list")] + ".bin" if state_file.endswith(".list") else state_file + ".bin"
+    count = write_url_list(bin_file, iter_jsonl(state_file))
+    if remove:
+        os.remove(state_file)
+    return bin_file, count
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert url_list state files to the binary format")
+    parser.add_argument(
+        "--run_mode",
+        choices=["dev", "prod"],
+        default="dev",
+        help="Specify the run mode: 'dev' or 'prod'"
+    )
+    parser.add_argument("--state_folder", help="Folder holding the state files (defaults to the config's)")
+    parser.add_argument("--keep", action="store_true", help="Keep the JSON lines files after converting")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    state_folder = args.state_folder
+    if not state_folder:
+        config = load_config()
+        if args.run_mode not in config:
+            logging.error(f"run_mode '{args.run_mode}' not found in config.yaml")
+            exit(1)
+        state_folder = config[args.run_mode]['state_folder']
+
+    for state_file in sorted(glob.glob(f"{state_folder}/url_list.*.list")):
+        bin_file, count = convert_state_file(state_file, remove=not args.keep)
+        logging.info(f"Converted {count} URLs: {state_file} ({os.path.getsize(bin_file)} bytes as {bin_file})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Optional compression of the payloads stored in the LevelDB.
+
+A compressed value starts with a small header:
+
+    MAGIC (4 bytes) | codec (1 byte) | dictionary id (4 bytes) | raw length (8 bytes)
+
+Values without the header are raw payloads, as every payload was stored
+before compression existed, so old databases read unchanged. A raw payload
+that happens to start with MAGIC is stored behind an identity header so it
+can't be mistaken for a compressed one.
+
+zstd is used when the zstandard package is installed; zlib (which can use
+the same kind of preset dictionary) is always available.
+
+The same header also marks the manifest of a payload that was stored in
+chunks: codec CODEC_CHUNKED, the chunk size in place of the dictionary id,
+the payload length, and the id of the chunked object as the body.
+"""
+
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"\x00RCV"
+HEADER = struct.Struct(">4sBIQ")
+
+CODEC_IDENTITY = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_CHUNKED = 3
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+DEFAULT_LEVELS = {CODEC_ZLIB: 6, CODEC_ZSTD: 9}
+DEFAULT_DICTIONARY_SIZE = 112640
+# Below this, the header and the codec's framing eat most of the gain
+MIN_COMPRESS_SIZE = 128
+
+# Types that are worth compressing, besides text/* and the +xml/+json families
+COMPRESSIBLE_MIMETYPES = {
+    "application/javascript",
+    "application/x-javascript",
+    "application/ecmascript",
+    "application/json",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/rss+xml",
+    "application/atom+xml",
+    "application/csv",
+    "application/x-sh",
+    "application/postscript",
+    "application/rtf",
+    "image/svg+xml",
+    "image/bmp",
+}
+
+def is_compressible(mimetype):
+    """
+    Whether a payload of this type is worth compressing. PDFs, images,
+    archives and media are already compressed and are stored as they are.
+    An unknown type is attempted, and kept raw if it doesn't shrink.
+
+    :param mimetype: The Content-Type of the payload, or None
+    """
+    if not mimetype:
+        return True
+    base = mimetype.split(";", 1)[0].strip().lower()
+    return (base.startswith("text/") or base in COMPRESSIBLE_MIMETYPES
+            or base.endswith("+xml") or base.endswith("+json"))
+
+def codec_id(name):
+    """
+    :param name: "zstd", "zlib", or None for no compression
+    :return: The codec number used in value headers. zstd falls back to
+             zlib when the zstandard package isn't installed.
+    """
+    if not name:
+        return CODEC_IDENTITY
+    if name not in CODEC_NAMES:
+        raise ValueError(f"Unknown compression codec: {name}")
+    codec = CODEC_NAMES[name]
+    if codec == CODEC_ZSTD and zstandard is None:
+        return CODEC_ZLIB
+    return codec
+
+def chunk_manifest(object_id, chunk_size, length):
+    """
+    :param object_id: Id the payload's chunks are stored under
+    :param chunk_size: Raw bytes per chunk (the last one may be shorter)
+    :param length: Total payload length
+    :return: The manifest value
+    """
+    return HEADER.pack(MAGIC, CODEC_CHUNKED, chunk_size, length) + object_id
+
+def parse_manifest(value):
+    """
+    :param value: A stored value
+    :return: (object id, chunk size, length) if it's a chunk manifest, else None
+    """
+    if value is None or not value.startswith(MAGIC) or len(value) < HEADER.size:
+        return None
+    _, codec, chunk_size, length = HEADER.unpack_from(value)
+    if codec != CODEC_CHUNKED:
+        return None
+    return value[HEADER.size:], chunk_size, length
+
+class ValueCodec:
+    def __init__(self, compression=None, level=None, dictionaries=None):
+        """
+        :param compression: "zstd", "zlib", or None to store new values raw
+        :param level: Compression level (the codec's default if None)
+        :param dictionaries: {dictionary id: bytes} of the dictionaries
+                             values may have been compressed with. New values
+                             use the one with the highest id.
+        """
+        self.codec = codec_id(compression)
+        self.level = level if level is not None else DEFAULT_LEVELS.get(self.codec, 0)
+        self.dictionaries = dict(dictionaries or {})
+        self.dict_id = max(self.dictionaries) if self.dictionaries else 0
+        # zstd (de)compressors aren't thread safe, and are worth reusing
+        self.local = threading.local()
+
+    def add_dictionary(self, dict_id, data):
+        """
+        Make a dictionary available, and compress new values with it.
+
+        :param dict_id: Its id, as stored in value headers (non-zero)
+        :param data: The dictionary bytes
+        """
+        self.dictionaries[dict_id] = data
+        self.dict_id = max(self.dict_id, dict_id)
+        self.local = threading.local()
+
+    def _zstd_dict(self, dict_id):
+        if not dict_id:
+            return None
+        return zstandard.ZstdCompressionDict(self.dictionaries[dict_id])
+
+    def _compress(self, payload):
+        if self.codec == CODEC_ZLIB:
+            if self.dict_id:
+                compressor = zlib.compressobj(self.level, zdict=self.dictionaries[self.dict_id])
+                return compressor.compress(payload) + compressor.flush()
+            return zlib.compress(payload, self.level)
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._zstd_dict(self.dict_id))
+            self.local.compressor = compressor
+        return compressor.compress(payload)
+
+    def encode(self, payload, mimetype=None):
+        """
+        :param payload: The raw payload bytes
+        :param mimetype: The payload's Content-Type, if known
+        :return: The value to store: compressed behind a header when that is
+                 smaller, otherwise the payload itself
+        """
+        if self.codec != CODEC_IDENTITY and len(payload) >= MIN_COMPRESS_SIZE and is_compressible(mimetype):
+            body = self._compress(payload)
+            if HEADER.size + len(body) < len(payload):
+                return HEADER.pack(MAGIC, self.codec, self.dict_id, len(payload)) + body
+        if payload.startswith(MAGIC):
+            return HEADER.pack(MAGIC, CODEC_IDENTITY, 0, len(payload)) + payload
+        return payload
+
+    def decode(self, value):
+        """
+        :param value: A stored value, compressed or not
+        :return: The raw payload bytes
+        """
+        if value is None or not value.startswith(MAGIC) or len(value) < HEADER.size:
+            return value
+        _, codec, dict_id, raw_length = HEADER.unpack_from(value)
+        body = memoryview(value)[HEADER.size:]
+        if codec == CODEC_IDENTITY:
+            return bytes(body)
+        if codec == CODEC_CHUNKED:
+            raise RuntimeError("Value is a chunk manifest; read it through WARCLevelDB")
+        if dict_id and dict_id not in self.dictionaries:
+            raise RuntimeError(f"Value was compressed with dictionary {dict_id}, which isn't in the DB")
+        if codec == CODEC_ZLIB:
+            if dict_id:
+                decompressor = zlib.decompressobj(zdict=self.dictionaries[dict_id])
+                return decompressor.decompress(body) + decompressor.flush()
+            return zlib.decompress(body)
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("Value is zstd compressed, but the zstandard package isn't installed")
+            decompressors = getattr(self.local, "decompressors", None)
+            if decompressors is None:
+                decompressors = self.local.decompressors = {}
+            decompressor = decompressors.get(dict_id)
+            if decompressor is None:
+                decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict(dict_id))
+                decompressors[dict_id] = decompressor
+            return decompressor.decompress(body, max_output_size=raw_length)
+        raise RuntimeError(f"Unknown codec {codec} in stored value")
+
+    def decoded_length(self, value):
+        """
+        :param value: A stored value, compressed or not
+        :return: The length of the raw payload, read from the header when there is one
+        """
+        if not value.startswith(MAGIC) or len(value) < HEADER.size:
+            return len(value)
+        return HEADER.unpack_from(value)[3]
+
+    def train_dictionary(self, samples, size=DEFAULT_DICTIONARY_SIZE):
+        """
+        Build a dictionary from sample payloads. With zstd this is a trained
+        dictionary; zlib can only use a preset dictionary of up to 32KB, so it
+        gets the start of each sample, which is where the sites' shared page
+        boilerplate lives.
+
+        :param samples: A list of payload bytes
+        :param size: Target dictionary size in bytes
+        :return: The dictionary bytes
+        """
+        if self.codec == CODEC_ZSTD:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        size = min(size, 32 * 1024)
+        dictionary = b""
+        # zlib favours the end of the dictionary, so put the common prefixes last
+        for sample in samples:
+            if len(dictionary) >= size:
+                break
+            dictionary = sample[:4096] + dictionary
+        return dictionary[-size:]
@@ -0,0 +1,208 @@
+"""
+Rolling, size-capped WARC output with a CDXJ index of where each capture is.
+
+Captures are appended to .warc.gz files of up to a configured size, one gzip
+member per record, instead of one small file per capture. Next to each WARC
+a .cdxj file gets a line per capture:
+
+    {urlkey} {timestamp} {"url": ..., "subdomain": ..., "path": ..., "filename": ..., "offset": ..., "length": ...}
+
+so a record can be read by seeking straight to it.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+from time import strftime
+
+from cdx_toolkit.warc import CDXToolkitWARCWriter
+
+DEFAULT_WARC_ROLLING_BYTES = 1000000000
+
+def cdxj_filename(warc_filename):
+    """
+    :param warc_filename: A .warc.gz file written by IndexedWARCWriter
+    :return: Its sidecar CDXJ index
+    """
+    if warc_filename.endswith(".warc.gz"):
+        return warc_filename[:-len(".warc.gz")] + ".cdxj"
+    return warc_filename + ".cdxj"
+
+class IndexedWARCWriter(CDXToolkitWARCWriter):
+    def __init__(self, folder, info, size=DEFAULT_WARC_ROLLING_BYTES, prefix="cdc"):
+        """
+        cdx_toolkit's rolling WARC writer, which starts a new file (with its
+        own warcinfo record) once the current one passes `size` bytes, plus
+        thread safety and a CDXJ line per capture.
+
+        :param folder: Folder to write the WARC and CDXJ files in
+        :param info: The warcinfo fields for each file
+        :param size: Start a new file once a file passes this many bytes
+        :param prefix: File name prefix
+        """
+        # Files from different runs never share a name, so no file is ever appended to
+        subprefix = f"{strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        super().__init__(os.path.join(folder, prefix), subprefix, info, size=size, gzip=True)
+        self.lock = threading.Lock()
+        self.index_fd = None
+
+    def write_capture(self, record, url_data, subdomain):
+        """
+        Append a record and index it.
+
+        :param record: The warcio record to write
+        :param url_data: A hashmap with information about the URL in the subdomain
+        :param subdomain: The subdomain the URL belongs to
+        :return: (filename, offset, length) of the record's gzip member
+        """
+        with self.lock:
+            if self.writer is None:
+                if self.warc_version is None:
+                    self.warc_version = '1.0'
+                self._start_new_warc()
+                self.index_fd = open(cdxj_filename(self.filename), "a", encoding="utf-8")
+
+            offset = self.fd.tell()
+            self.writer.write_record(record)
+            # Flushed, so the record can be read back (and ingested) right away
+            self.fd.flush()
+            length = self.fd.tell() - offset
+            filename = self.filename
+
+            entry = {
+                "url": url_data['original'],
+                "subdomain": subdomain,
+                "path": url_data['path'],
+                "mime": url_data.get('mimetype'),
+                "status": url_data.get('statuscode'),
+                "digest": url_data.get('digest'),
+                "filename": os.path.basename(filename),
+                "offset": offset,
+                "length": length,
+            }
+            urlkey = url_data.get('urlkey') or f"{subdomain}{url_data['path']}"
+            self.index_fd.write(f"{urlkey} {url_data['timestamp']} {json.dumps(entry)}\n")
+            self.index_fd.flush()
+
+            if offset + length > self.size:
+                self._close_file()
+        return filename, offset, length
+
+    def _close_file(self):
+        logging.info(f"Closing WARC file {self.filename}")
+        self.fd.close()
+        self.index_fd.close()
+        self.writer = None
+        self.index_fd = None
+        self.segment += 1
+
+    def close(self):
+        """
+        Close the current WARC and CDXJ files
+        """
+        with self.lock:
+            if self.writer is not None:
+                self._close_file()
+
+def iter_cdxj(folder):
+    """
+    Read every CDXJ index in a folder.
+
+    :param folder: The folder the WARC and CDXJ files were written to
+    :return: A generator of (urlkey, timestamp, entry), with entry['filename'] made a full path
+    """
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".cdxj"):
+            continue
+        with open(os.path.join(folder, name), "r", encoding="utf-8") as index_fd:
+            for line in index_fd:
+                urlkey, timestamp, fields = line.rstrip("\n").split(" ", 2)
+                try:
+                    entry = json.loads(fields)
+                except ValueError:
+                    # A line torn by a crash
+                    logging.warning(f"Skipping damaged CDXJ line in {name}")
+                    continue
+                entry['filename'] = os.path.join(folder, entry['filename'])
+                yield urlkey, timestamp, entry
+
+def load_cdxj_index(folder):
+    """
+    :param folder: The folder the WARC and CDXJ files were written to
+    :return: {(subdomain, path): (timestamp, entry)} for the newest capture of each path
+    """
+    index = {}
+    for _, timestamp, entry in iter_cdxj(folder):
+        key = (entry['subdomain'], entry['path'])
+        if key not in index or timestamp >= index[key][0]:
+            index[key] = (timestamp, entry)
+    return index
+
+class BackgroundWARCWriter:
+    def __init__(self, warc_store, max_pending=256):
+        """
+        Writes records to an IndexedWARCWriter on a background thread, so the
+        fetch and ingest loop never waits on WARC output. Once written, each
+        capture's fetch result (with its file, offset and length) is handed
+        back through completed(), to be journaled by the caller's thread.
+
+        :param warc_store: The IndexedWARCWriter to write to
+        :param max_pending: Records queued before submit() blocks
+        """
+        self.warc_store = warc_store
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.done = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="warc-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                key, record, url_data, subdomain = item
+                try:
+                    filename, offset, length = self.warc_store.write_capture(record, url_data, subdomain)
+                    result = { "file": filename, "offset": offset, "length": length, "issues": False }
+                except Exception as e:
+                    # The capture is in the DB already; it just has no WARC copy
+                    logging.error(f"Could not write the WARC record for {url_data['original']}: {e}")
+                    result = { "file": None, "issues": False }
+                self.done.put((key, result))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, key, record, url_data, subdomain):
+        """
+        Queue a record to be written.
+
+        :param key: Handed back with the fetch result (e.g. the path)
+        :param record: The warcio record
+        :param url_data: A hashmap with information about the URL in the subdomain
+        :param subdomain: The subdomain the URL belongs to
+        """
+        self.queue.put((key, record, url_data, subdomain))
+
+    def completed(self, wait=False):
+        """
+        :param wait: First wait for every queued record to be written
+        :return: A list of (key, fetch result) for the records written since the last call
+        """
+        if wait:
+            self.queue.join()
+        results = []
+        while True:
+            try:
+                results.append(self.done.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """
+        Write out the queue and stop the thread. The warc_store is left open.
+        """
+        self.queue.put(None)
+        self.thread.join()